@@ -1,14 +1,55 @@
 import time
 import os
 import re
+import uuid
+import hashlib
+import tempfile
+from loguru import logger
 from .utils import join_path
-from .nrfjprog import NRFJProg
+from .sync import local_tree
+from .nrfjprog import NRFJProg, NRFJProgException, DEFAULT_RTT_START_TIMEOUT
+
+UPLOAD_MODE_AUTO = 'auto'
+UPLOAD_MODE_BULK = 'bulk'
+UPLOAD_MODE_LEGACY = 'legacy'
+UPLOAD_MODES = (UPLOAD_MODE_AUTO, UPLOAD_MODE_BULK, UPLOAD_MODE_LEGACY)
+
+FS_WRITE_CHUNK_SIZE = 17  # CONFIG_SHELL_ARGC_MAX=20
+FS_WRITE_BATCH_SIZE = 4096
+FS_WRITE_TIMEOUT = 5
+
+FS_READ_TIMEOUT = 2
+FS_READ_RETRIES = 3
+FS_READ_BATCH_LINES = 256
+
+SHELL_TIMEOUT = 1
+SHELL_DRAIN_IDLE = 0.5    # seconds without output to consider the shell settled
+SHELL_DRAIN_MAX = 3       # seconds at most spent draining
+
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]')
+SHELL_PROMPT = re.compile(r'^(?:[\w-]+:~\$ )+')
+FS_ECHO = re.compile(r'^fs (?:read|write|trunc) ')
+
+
+def clean_shell_line(line):
+    '''Remove ANSI escape sequences, prompt prefix and trailing whitespace of shell output line.'''
+    return SHELL_PROMPT.sub('', ANSI_ESCAPE.sub('', line)).rstrip()
+
+
+def is_fs_echo(line):
+    '''Check whether cleaned line is echo of fs command sent by file transfer.'''
+    return FS_ECHO.match(line) is not None
+
+
+class FsReadException(Exception):
+    pass
 
 
 class App:
-    def __init__(self, prog: NRFJProg):
+    def __init__(self, prog: NRFJProg, require_logger=True, rtt_timeout=DEFAULT_RTT_START_TIMEOUT):
         self._prog = prog
-        self._read_data = {'Terminal': '', 'Logger': ''}
+        self._require_logger = require_logger
+        self._rtt_timeout = rtt_timeout
 
         if not self._prog.is_opened:
             raise Exception('Open the device first')
@@ -17,21 +58,37 @@ class App:
         if self._prog.rtt_is_running():
             return
 
-        channels = self._prog.rtt_start()
+        channels = self._prog.rtt_start(self._rtt_timeout)
 
         if 'Terminal' not in channels:
             raise Exception('Not found RTT Terminal channel')
 
-        if 'Logger' not in channels:
+        if self._require_logger and 'Logger' not in channels:
             raise Exception('Not found RTT Logger channel')
 
         # Clear the read data
-        while line := self.terminal_read_line(0.2):
-            pass
+        self._drain('Terminal')
+
+    def _drain(self, channel, idle=SHELL_DRAIN_IDLE, timeout=SHELL_DRAIN_MAX):
+        '''Discard output of channel until it is idle for idle seconds (or timeout elapses).'''
+        reader = self._prog.rtt_reader(channel)
+        poller = self._prog.rtt_poller()
+        now = time.time()
+        end = now + timeout
+        idle_end = now + idle
+        while True:
+            data = reader.read()
+            now = time.time()
+            if data:
+                idle_end = now + idle
+            if now >= min(idle_end, end):
+                return
+            poller.wait(data, min(idle_end, end))
 
     def reset(self, go=True):
-        for k in self._read_data:
-            self._read_data[k] = ''
+        if self._prog.rtt_is_running():
+            for channel in ('Terminal', 'Logger'):
+                self._prog.rtt_reader(channel).clear()
         self._prog.reset()
         if go:
             self._prog.go()
@@ -42,50 +99,80 @@ class App:
 
     def terminal_write(self, data):
         self._rtt_start()
-        self._prog.rtt_write('Terminal', data)
+        self._terminal_write_all(data)
 
-    def logger_read_line(self, timeout):
-        self._rtt_start()
-        return self._rtt_read_line('Logger', timeout)
+    def _terminal_write_all(self, data, check=None):
+        '''Write all data to Terminal as fast as the firmware consumes the down buffer.'''
+        data = data.encode() if isinstance(data, str) else bytes(data)
+        poller = self._prog.rtt_poller()
+        timeout = time.time() + FS_WRITE_TIMEOUT
+        while True:
+            n = self._prog.rtt_write('Terminal', data, encoding=None)
+            if n:
+                data = data[n:]
+                timeout = time.time() + FS_WRITE_TIMEOUT
+            if check:
+                check()
+            if not data:
+                return
+            if time.time() > timeout:
+                raise Exception('Timeout waiting on shell to consume data')
+            poller.wait(n)
 
-    def _rtt_read_line(self, channel, timeout):
-        c = self._read_data[channel]
-        i = c.find('\n')
-        if i > -1:
-            line = c[:i]
-            self._read_data[channel] = c[i + 1:]
-            return line.rstrip()
+    def shell(self, command, timeout=SHELL_TIMEOUT):
+        '''Run shell command and return its response lines.
 
-        timeout = time.time() + timeout
-        while time.time() < timeout:
+        The command is followed by unique unknown command, the response is complete once
+        the shell reports it as not found. timeout is the longest time without a received line,
+        NRFJProgException is raised when the response does not end within it.
+        Echo, prompt and ANSI escape sequences are removed from the response.
+        '''
+        self._rtt_start()
+        self._prog.rtt_reader('Terminal').read()  # Discard stale output
 
-            data = self._prog.rtt_read(channel)
-            if data:
-                self._read_data[channel] += data
+        lines = []
+        echo = command.strip()
+        for line in self._shell_response(f'{command}\n', timeout):
+            if echo and line == echo:
+                echo = None
+                continue
+            lines.append(line)
+        return lines
+
+    def _shell_response(self, data, timeout):
+        '''Send data followed by unique unknown command and yield cleaned lines until the shell
+        reports the command as not found, so all output of data was received.'''
+        sentinel = f'_{uuid.uuid4().hex[:12]}'
+        self._terminal_write_all(f'{data}{sentinel}\n')
 
-            c = self._read_data[channel]
-            i = c.find('\n')
-            if i < 0:
+        while True:
+            line = self.terminal_read_line(timeout)
+            if line is None:
+                raise NRFJProgException(f'Timeout waiting on end of response to: {data.strip()}')
+            line = clean_shell_line(line)
+            if sentinel in line:
+                if line != sentinel:  # Not the echo but "command not found" response
+                    return
                 continue
-            line = c[:i]
-            self._read_data[channel] = c[i + 1:]
+            yield line
+
+    def logger_read_line(self, timeout):
+        self._rtt_start()
+        return self._rtt_read_line('Logger', timeout)
+
+    def _rtt_read_line(self, channel, timeout):
+        line = self._prog.rtt_reader(channel).readline(timeout)
+        if line is not None:
             return line.rstrip()
 
     def fs_ls(self, path: str = ''):
-        self.terminal_write(f'fs ls {path}\n')
-        lines = []
-        while True:
-            line = self.terminal_read_line(0.5)
-            if not line:
-                break
-            lines.append(line)
-        return lines
+        return [line for line in self.shell(f'fs ls {path}') if line]
 
     def fs_stat(self, mount_point='/lfs1'):
-        self.terminal_write(f'fs statvfs {mount_point}\n')
-        line = self.terminal_read_line(0.5)
-        if not line:
+        lines = [line for line in self.shell(f'fs statvfs {mount_point}') if line]
+        if not lines:
             raise Exception('Timeout waiting on response')
+        line = lines[0]
         m = re.match(r'bsize (\d+), frsize (\d+), blocks (\d+), bfree (\d+)', line)
         if not m:
             raise Exception(line)
@@ -96,12 +183,91 @@ class App:
         return {'size': frsize * blocks, 'free': frsize * bfree, 'used': frsize * (blocks - bfree)}
 
     def fs_mkdir(self, path: str):
-        self.terminal_write(f'fs mkdir {path}\n')
-        line = self.terminal_read_line(0.5)
-        if line:
-            raise Exception(line)
+        lines = [line for line in self.shell(f'fs mkdir {path}') if line]
+        if lines:
+            raise Exception(lines[0])
+
+    def fs_walk(self, path: str):
+        '''Return (dirs, files) sets of absolute paths of path itself and everything below it,
+        both empty if path does not exist.'''
+        dirs = set()
+        files = set()
+        ls = self.fs_ls(path)
+        if ls and ls[0].startswith('Unable to open'):
+            return dirs, files
+        dirs.add(path)
+        for name in ls:
+            if name.endswith('/'):
+                d = join_path(path, name.rstrip('/'))
+                sub_dirs, sub_files = self.fs_walk(d)
+                dirs |= sub_dirs
+                files |= sub_files
+                dirs.add(d)
+            else:
+                files.add(join_path(path, name))
+        return dirs, files
+
+    def fs_sync(self, src, dst, manifest, delete=False, dry_run=False, mode=UPLOAD_MODE_AUTO):
+        '''Upload only files which differ from the device state, returns dict of lists of
+        uploaded, skipped and deleted paths.
+
+        File is up to date when it exists on device, has the local size and manifest
+        records the same size and SHA-256 as uploaded to this device.
+        '''
+        if not os.path.isdir(src):
+            raise Exception(f'Source {src} is not a directory')
+        dst = dst.rstrip('/') or '/'
 
-    def fs_download(self, src: str, dst: str, recursive: bool = False):
+        local_dirs, local_files = local_tree(src)
+        dirs, files = self.fs_walk(dst)
+        result = {'upload': [], 'skip': [], 'delete': []}
+
+        try:
+            for rel, (size, sha256) in sorted(local_files.items()):
+                path = join_path(dst, rel)
+                if path in files and manifest.match(path, size, sha256) and self.fs_file_size(path) == size:
+                    result['skip'].append(path)
+                    continue
+                result['upload'].append(path)
+                if dry_run:
+                    continue
+                self._fs_makedirs(dst, rel.rsplit('/', 1)[0] if '/' in rel else '', dirs)
+                self.fs_write_file(os.path.join(src, *rel.split('/')), path, mode)
+                manifest.set(path, size, sha256)
+
+            for rel in sorted(local_dirs):
+                if not dry_run:
+                    self._fs_makedirs(dst, rel, dirs)
+
+            if delete:
+                keep = {join_path(dst, rel) for rel in local_files}
+                keep_dirs = {join_path(dst, rel) for rel in local_dirs} | {dst}
+                for path in sorted(files - keep) + sorted(dirs - keep_dirs, reverse=True):
+                    result['delete'].append(path)
+                    if not dry_run:
+                        self.fs_rm(path)
+                        manifest.remove(path)
+        finally:
+            if not dry_run:
+                manifest.save()
+
+        return result
+
+    def _fs_makedirs(self, dst, rel, dirs):
+        paths = [dst]
+        for name in rel.split('/') if rel else ():
+            paths.append(join_path(paths[-1], name))
+        for path in paths:
+            if path not in dirs:
+                self.fs_mkdir(path)
+                dirs.add(path)
+
+    def fs_rm(self, path: str):
+        lines = [line for line in self.shell(f'fs rm {path}') if line]
+        if lines:
+            raise Exception(lines[0])
+
+    def fs_download(self, src: str, dst: str, recursive: bool = False, resume: bool = False, progress=None):
         if recursive:
             if os.path.isfile(dst):
                 raise Exception(f'Destination {dst} is existing file')
@@ -111,38 +277,108 @@ class App:
             ls = self.fs_ls(src)
             for f in ls:
                 if f.endswith('/'):
-                    self.fs_download(join_path(src, f), os.path.join(dst, f), recursive)
+                    self.fs_download(join_path(src, f), os.path.join(dst, f), recursive, resume, progress)
                 else:
                     print(f'Copy {join_path(src, f)} -> {os.path.join(dst, f)}')
-                    self.fs_read_file(join_path(src, f), os.path.join(dst, f))
+                    self.fs_read_file(join_path(src, f), os.path.join(dst, f), resume, progress)
         else:
-            self.fs_read_file(src, dst)
+            self.fs_read_file(src, dst, resume, progress)
+
+    def fs_read_file(self, src: str, dst: str, resume: bool = False, progress=None):
+        '''Download file, completion is given by reported file size, interrupted transfer
+        is retried by ranged read from the last received offset.
 
-    def fs_read_file(self, src: str, dst: str):
+        progress is called with (received, size) after each decoded batch.
+        '''
         if dst.endswith('/'):
             dst += os.path.basename(src)
         elif dst == '.':
             dst = os.path.basename(src)
 
-        self.terminal_write(f'fs read {src}\n')
+        self._rtt_start()
+        # Discard output of previously sent commands (e.g. queued echo), not just what arrived so far
+        for _ in self._shell_response('', FS_WRITE_TIMEOUT):
+            pass
+
+        offset = os.path.getsize(dst) if resume and os.path.isfile(dst) else 0
+        size = None
+        retries = 0
+        start = time.time()
+        with open(dst, 'r+b' if offset else 'wb', buffering=1 << 16) as f:
+            f.seek(offset)
+            while size is None or f.tell() < size:
+                offset = f.tell()
+                try:
+                    size = self._fs_read_request(src, f.tell(), size)
+                    if progress:
+                        progress(f.tell(), size)
+                    self._fs_read_data(f, size, progress)
+                except FsReadException as e:
+                    retries = retries + 1 if f.tell() == offset else 1
+                    if retries > FS_READ_RETRIES:
+                        raise Exception(f'Download of {src} failed at offset {f.tell()}: {e}')
+                    logger.warning(f'Download of {src} interrupted at offset {f.tell()} ({e}), retrying')
+                    # Wait for the rest of the interrupted response
+                    while self.terminal_read_line(0.5) is not None:
+                        pass
+            f.truncate(size)
+
+        elapsed = time.time() - start
+        logger.debug(f'Downloaded {src} {size} B in {elapsed:.2f} s ({size / (elapsed or 1e-9):.0f} B/s)')
+        return size
+
+    def _fs_read_request(self, src, offset, size):
+        '''Request file content from offset, returns reported file size.'''
+        if offset:
+            self.terminal_write(f'fs read {src} {size - offset if size else 0x7fffffff} {offset}\n')
+        else:
+            self.terminal_write(f'fs read {src}\n')
+
         while True:
-            line = self.terminal_read_line(0.5)
-            if not line:
-                continue
-            print(line)
-            if 'File size' not in line:
+            line = self.terminal_read_line(FS_READ_TIMEOUT)
+            if line is None:
+                raise FsReadException('Timeout waiting on response')
+            line = clean_shell_line(line)
+            m = re.match(r'File size: (\d+)', line)
+            if m:
+                break
+            if line and not is_fs_echo(line):  # Skip echo of commands
                 raise Exception(line)
-            break
-        with open(dst, 'wb') as f:
-            while True:
-                line = self.terminal_read_line(0.5)
-                if not line:
-                    break
-                line = line.split('  ', 2)
-                data = bytes.fromhex(line[1])
-                f.write(data)
 
-    def fs_upload(self, src, dst, recursive):
+        if size is not None and int(m.group(1)) != size:
+            raise Exception(f'File {src} changed during download')
+        return int(m.group(1))
+
+    def _fs_read_data(self, f, size, progress):
+        '''Decode hex dump lines in batches until size is reached, on error everything
+        received in order is written so the retry continues from f.tell().'''
+        batch = []
+        offset = f.tell()
+        try:
+            while offset < size:
+                line = self.terminal_read_line(FS_READ_TIMEOUT)
+                if line is None:
+                    raise FsReadException('Timeout waiting on data')
+                if line[8:10] != '  ':
+                    continue
+                address, data = line.split('  ', 2)[:2]
+                if int(address, 16) != offset:
+                    raise FsReadException(f'Unexpected offset {address}')
+                batch.append(data)
+                offset += len(data.replace(' ', '')) // 2
+                if len(batch) >= FS_READ_BATCH_LINES:
+                    self._fs_read_flush(f, batch, size, progress)
+        finally:
+            self._fs_read_flush(f, batch, size, progress)
+
+    def _fs_read_flush(self, f, batch, size, progress):
+        if batch:
+            f.write(bytes.fromhex(''.join(batch)))
+            batch.clear()
+            if progress:
+                progress(f.tell(), size)
+
+    def fs_upload(self, src, dst, recursive, mode=UPLOAD_MODE_AUTO, checksum=False):
         if recursive:
             if not os.path.isdir(src):
                 raise Exception(f'Source {src} is not a directory')
@@ -160,23 +396,98 @@ class App:
                         pass
                 for f in files:
                     print(f'Copy {os.path.join(root, f)} -> {join_path(dst, root, f)}')
-                    self.fs_write_file(os.path.join(root, f), join_path(dst, root, f))
+                    self.fs_write_file(os.path.join(root, f), join_path(dst, root, f), mode, checksum)
         else:
-            self.fs_write_file(src, dst)
+            self.fs_write_file(src, dst, mode, checksum)
 
-    def fs_write_file(self, src, dst):
+    def fs_write_file(self, src, dst, mode=UPLOAD_MODE_AUTO, checksum=False):
         if dst.endswith('/'):
             dst += os.path.basename(src)
 
+        if mode != UPLOAD_MODE_LEGACY:
+            try:
+                self._fs_write_file_bulk(src, dst, checksum)
+                return
+            except Exception as e:
+                if mode == UPLOAD_MODE_BULK:
+                    raise
+                logger.warning(f'Bulk upload of {dst} failed ({e}), falling back to legacy mode')
+
+        self._fs_write_file_legacy(src, dst)
+
+    def _fs_write_file_legacy(self, src, dst):
         self.terminal_write(f'fs trunc {dst}\n')
 
         cmd = f'fs write {dst}'
-        chunk_size = 17  # CONFIG_SHELL_ARGC_MAX=20
         with open(src, 'rb') as f:
             while True:
-                data = f.read(chunk_size)
+                data = f.read(FS_WRITE_CHUNK_SIZE)
                 if not data:
                     break
                 data_hex = ' '.join([f'{b:02X}' for b in data])
                 self.terminal_write(f'{cmd} {data_hex}\n')
                 time.sleep(0.02)
+
+    def _fs_write_file_bulk(self, src, dst, checksum=False):
+        '''Upload paced by the firmware consuming the RTT down buffer, verified by file size (and content).'''
+        self._rtt_start()
+        self._prog.rtt_reader('Terminal').read()  # Discard stale output
+
+        start = time.time()
+        cmd = f'fs write {dst} '.encode()
+        sha = hashlib.sha256()
+        size = 0
+        batch = bytearray(f'fs trunc {dst}\n'.encode())
+        with open(src, 'rb') as f:
+            while True:
+                data = f.read(FS_WRITE_CHUNK_SIZE)
+                if data:
+                    sha.update(data)
+                    size += len(data)
+                    batch += cmd + data.hex(' ').upper().encode() + b'\n'
+                if len(batch) >= FS_WRITE_BATCH_SIZE or (batch and not data):
+                    self._terminal_write_all(batch, self._check_upload_output)
+                    batch = bytearray()
+                if not data:
+                    break
+
+        # Output of all batches (echo or errors) must be processed before the size check
+        for line in self._shell_response('', FS_WRITE_TIMEOUT):
+            self._check_upload_line(line)
+
+        remote_size = self.fs_file_size(dst)
+        if remote_size != size:
+            raise Exception(f'Size mismatch, local {size} B, remote {remote_size} B')
+
+        if checksum:
+            fd, tmp = tempfile.mkstemp(prefix='chester-')
+            os.close(fd)
+            try:
+                self.fs_read_file(dst, tmp)
+                with open(tmp, 'rb') as f:
+                    if hashlib.sha256(f.read()).digest() != sha.digest():
+                        raise Exception('Checksum mismatch')
+            finally:
+                os.remove(tmp)
+
+        elapsed = time.time() - start
+        logger.debug(f'Uploaded {dst} {size} B in {elapsed:.2f} s ({size / (elapsed or 1e-9):.0f} B/s)')
+
+    def _check_upload_output(self):
+        for line in self._prog.rtt_reader('Terminal').readlines():
+            self._check_upload_line(clean_shell_line(line))
+
+    def _check_upload_line(self, line):
+        # Echo and prompt are fine, anything else is error reported by the shell
+        if line and not is_fs_echo(line):
+            raise Exception(line)
+
+    def fs_file_size(self, path):
+        # Long timeout, the shell may be still processing previously queued commands
+        lines = [line for line in self.shell(f'fs read {path} 1', FS_WRITE_TIMEOUT) if line and not is_fs_echo(line)]
+        if not lines:
+            raise Exception('Timeout waiting on response')
+        m = re.match(r'File size: (\d+)', lines[0])
+        if not m:
+            raise Exception(lines[0])
+        return int(m.group(1))
@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import random
+import tempfile
+from loguru import logger
+from .sim import SimNRFJProg, clear_targets
+from .app import App
+from .trace import TracePipeline, FileSink
+
+BENCHMARKS = ('rtt_read', 'rtt_write', 'read_line', 'fs_write', 'fs_read', 'console', 'scrollback', 'trace')
+
+SCROLLBACK_SIZES = (1000, 10000, 100000)  # lines of full scrollback in scrollback benchmark
+
+
+def scenario(latency=0, data_rate=10000000, replay=None):
+    '''Simulated firmware used by the benchmarks, deterministic for given arguments.'''
+    script = {
+        'latency': latency,
+        'data_rate': data_rate,
+        'shell_delay': 0,
+        'pib': None,
+        'log': {
+            'rate': 20000,
+            'lines': [
+                '<inf> app: Measurement {} temperature: 21.5 C humidity: 45.2 %',
+                '<dbg> ctr_lte: Modem state: registered, RSRP: -95 dBm, counter: {}',
+                '<wrn> ctr_lrw: Retransmission of uplink frame {}',
+            ],
+        },
+        'trace': {'rate': 2000000},
+    }
+    if replay:
+        script['log'] = None
+        script['trace'] = None
+        script['replay'] = {'file': replay, 'speed': 0, 'loop': True}
+    return script
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Meter:
+    '''Collects per operation latency, transferred bytes/lines and host CPU time.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.bytes = 0
+        self.lines = 0
+        self.latency = []
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.elapsed = time.perf_counter() - self._wall
+        self.cpu = time.process_time() - self._cpu
+
+    def op(self, start, nbytes=0, nlines=0):
+        self.latency.append(time.perf_counter() - start)
+        self.bytes += nbytes
+        self.lines += nlines
+
+    def result(self):
+        elapsed = self.elapsed or 1e-9
+        return {
+            'name': self.name,
+            'ops': len(self.latency),
+            'bytes': self.bytes,
+            'lines': self.lines,
+            'elapsed': round(self.elapsed, 6),
+            'bytes_per_s': round(self.bytes / elapsed, 1),
+            'lines_per_s': round(self.lines / elapsed, 1),
+            'p50_ms': round(percentile(self.latency, 50) * 1000, 4),
+            'p99_ms': round(percentile(self.latency, 99) * 1000, 4),
+            'cpu_percent': round(self.cpu / elapsed * 100, 1),
+        }
+
+
+def bench_rtt_read(prog, duration, **kwargs):
+    with Meter('rtt_read') as m:
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            t = time.perf_counter()
+            data = prog.rtt_read('Logger', encoding=None)
+            m.op(t, len(data))
+    return m
+
+
+def bench_rtt_write(prog, duration, **kwargs):
+    msg = ' ' * 63 + '\n'
+    with Meter('rtt_write') as m:
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            t = time.perf_counter()
+            n = prog.rtt_write('Terminal', msg)
+            m.op(t, n)
+    return m
+
+
+def bench_read_line(prog, duration, **kwargs):
+    app = App(prog)
+    with Meter('read_line') as m:
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            t = time.perf_counter()
+            line = app.logger_read_line(1)
+            if line is not None:
+                m.op(t, len(line) + 1, 1)
+    return m
+
+
+def _random_bytes(size):
+    return random.Random(size).getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def _bench_file(size):
+    fd, path = tempfile.mkstemp(prefix='chester-bench-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(_random_bytes(size))
+    return path
+
+
+def bench_fs_write(prog, duration, size=2048, **kwargs):
+    app = App(prog)
+    src = _bench_file(size)
+    try:
+        with Meter('fs_write') as m:
+            t = time.perf_counter()
+            app.fs_write_file(src, '/lfs1/bench.bin')
+            m.op(t, size)
+    finally:
+        os.remove(src)
+    return m
+
+
+def bench_fs_read(prog, duration, size=2048, **kwargs):
+    app = App(prog)
+    prog.target.files['/lfs1/bench.bin'] = bytearray(_random_bytes(size))
+    fd, dst = tempfile.mkstemp(prefix='chester-bench-')
+    os.close(fd)
+    try:
+        with Meter('fs_read') as m:
+            t = time.perf_counter()
+            app.fs_read_file('/lfs1/bench.bin', dst)
+            m.op(t, os.path.getsize(dst))
+    finally:
+        os.remove(dst)
+    return m
+
+
+def bench_console(prog, duration, **kwargs):
+    from prompt_toolkit.buffer import Buffer
+    from .scrollback import Scrollback, DEFAULT_SCROLLBACK, parse_scrollback
+
+    scrollback = Scrollback(Buffer(), *parse_scrollback(DEFAULT_SCROLLBACK))
+    with Meter('console') as m:
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            data = prog.rtt_read('Logger')
+            if not data:
+                continue
+            t = time.perf_counter()
+            scrollback.append(data.replace('\r', ''))
+            scrollback.refresh()
+            m.op(t, len(data), data.count('\n'))
+    return m
+
+
+def bench_scrollback(prog, duration, **kwargs):
+    '''Append and refresh of full scrollback for each of SCROLLBACK_SIZES, one result per size.'''
+    from prompt_toolkit.buffer import Buffer
+    from .scrollback import Scrollback
+
+    chunk = ''.join(f'[00:00:{i:02d}.000,000] <inf> app: Measurement {i} temperature: 21.5 C\n' for i in range(20))
+    meters = []
+    for size in SCROLLBACK_SIZES:
+        scrollback = Scrollback(Buffer(), size)
+        for _ in range(size // 20):
+            scrollback.append(chunk)
+        scrollback.refresh()
+        with Meter(f'scroll_{size // 1000}k') as m:
+            end = time.perf_counter() + duration / len(SCROLLBACK_SIZES)
+            while time.perf_counter() < end:
+                t = time.perf_counter()
+                scrollback.append(chunk)
+                scrollback.refresh()
+                m.op(t, len(chunk), 20)
+        meters.append(m)
+    return meters
+
+
+def bench_trace(prog, duration, **kwargs):
+    fd, path = tempfile.mkstemp(prefix='chester-bench-')
+    os.close(fd)
+    try:
+        with Meter('trace') as m:
+            pipeline = TracePipeline([FileSink(path)])
+            end = time.perf_counter() + duration
+            while time.perf_counter() < end:
+                t = time.perf_counter()
+                data = prog.rtt_read('modem_trace', encoding=None)
+                pipeline.feed(data)
+                m.op(t, len(data))
+            pipeline.close()
+    finally:
+        os.remove(path)
+    return m
+
+
+def run(names=BENCHMARKS, duration=2.0, size=2048, latency=0, data_rate=10000000, replay=None):
+    results = []
+    for name in names:
+        clear_targets()
+        mcu = 'lte' if name == 'trace' else 'app'
+        prog = SimNRFJProg(mcu, script=scenario(latency, data_rate, replay))
+        logger.debug('Benchmark {}', name)
+        with prog:
+            prog.rtt_start()
+            m = globals()[f'bench_{name}'](prog, duration, size=size)
+            prog.rtt_stop()
+        results.extend(x.result() for x in (m if isinstance(m, list) else [m]))
+    return results
+
+
+def record(prog, file, channels, duration):
+    '''Record RTT up channels to JSON lines file usable as sim replay source.'''
+    prog.rtt_start()
+    poller = prog.rtt_poller()
+    start = time.time()
+    total = 0
+    while time.time() - start < duration:
+        received = 0
+        for channel in channels:
+            data = prog.rtt_read(channel, encoding=None)
+            if data:
+                received += len(data)
+                file.write(json.dumps({'t': round(time.time() - start, 6), 'channel': channel, 'data': data.hex()}) + '\n')
+        total += received
+        poller.wait(received)
+    prog.rtt_stop()
+    return total
+
+
+def compare(results, baseline):
+    '''Return list of (name, metric, baseline, current, change %) of matching results.'''
+    base = {r['name']: r for r in baseline}
+    rows = []
+    for r in results:
+        b = base.get(r['name'])
+        if not b:
+            continue
+        for key in ('bytes_per_s', 'lines_per_s', 'p50_ms', 'p99_ms', 'cpu_percent'):
+            if b.get(key):
+                rows.append((r['name'], key, b[key], r[key], (r[key] - b[key]) / b[key] * 100))
+    return rows
@@ -1,15 +1,24 @@
 import click
-from . import app, lte
+from . import app, lte, bench, serve
+from ..nrfjprog import BACKEND_JLINK, BACKEND_SIM, DEFAULT_RTT_LATENCY_MS
 
 
 @click.group(name='chester', help='Commands for CHESTER (configurable IoT gateway).')
+@click.option('--backend', type=click.Choice([BACKEND_JLINK, BACKEND_SIM]), envvar='CHESTER_BACKEND', help='Probe backend.', default=BACKEND_JLINK, show_default=True)
+@click.option('--sim-script', type=click.Path(exists=True, dir_okay=False), envvar='CHESTER_SIM_SCRIPT', help='Scripted firmware behaviour for the sim backend (JSON).')
+@click.option('--rtt-latency', type=click.IntRange(1), metavar='MS', envvar='CHESTER_RTT_LATENCY', help='Maximum RTT polling interval when idle in ms.', default=DEFAULT_RTT_LATENCY_MS, show_default=True)
 @click.pass_context
-def cli(ctx):
-    pass
+def cli(ctx, backend, sim_script, rtt_latency):
+    ctx.obj['backend'] = backend
+    ctx.obj['sim_script'] = sim_script
+    ctx.obj['rtt_latency'] = rtt_latency
 
 
 cli.add_command(app.cli)
 cli.add_command(lte.cli)
+cli.add_command(bench.cli)
+cli.add_command(serve.command_serve)
+cli.add_command(serve.command_job)
 
 
 def main():
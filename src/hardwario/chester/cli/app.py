@@ -2,18 +2,25 @@ import click
 import os
 import json
 import sys
+import signal
 import string
 import re
 import time
 from datetime import datetime
 from loguru import logger
 from ..pib import PIB, PIBException
-from ..nrfjprog import NRFJProg, HighNRFJProg, DEFAULT_JLINK_SPEED_KHZ
-from ..console import Console
+from ..nrfjprog import NRFJProgException, DEFAULT_JLINK_SPEED_KHZ, VERIFY_MODES, VERIFY_FULL, create_prog, get_probes, image_ranges, parse_range
+from ..multiflash import flash_probes, format_summary
+from ..console import Console, parse_color_rule
+from ..scrollback import DEFAULT_SCROLLBACK, ScrollbackException, parse_scrollback
 from ..firmwareapi import FirmwareApi, DEFAULT_API_URL
-from ..utils import find_hex, download_url, bytes_to_human
+from ..utils import find_hex, download_url, bytes_to_human, Coredump
 from ..build import build
-from ..app import App
+from ..app import App, UPLOAD_MODES, UPLOAD_MODE_AUTO
+from ..sync import SyncManifest, DEFAULT_MANIFEST_PATH
+from ..logfile import LogWriter, LogFileException, DEFAULT_LOG_KEEP, parse_size
+from ..logindex import LogIndex, LEVELS
+from ..logstream import stream_log, FORMATS, FORMAT_TEXT, CHANNELS
 
 
 @click.group(name='app')
@@ -21,7 +28,7 @@ from ..app import App
 @click.pass_context
 def cli(ctx, nrfjprog_log):
     '''Application SoC commands.'''
-    ctx.obj['prog'] = NRFJProg('app', log=nrfjprog_log)
+    ctx.obj['prog'] = create_prog('app', ctx.obj.get('backend'), ctx.obj.get('sim_script'), log=nrfjprog_log, rtt_latency=ctx.obj.get('rtt_latency'))
 
 
 def validate_hex_file(ctx, param, value):
@@ -35,15 +42,47 @@ def validate_hex_file(ctx, param, value):
     raise click.BadParameter(f'Path \'{value}\' does not exist.')
 
 
+def flash_parallel(ctx, mcu, jlink_sn, all_probes, jlink_speed, files, halt=False, diff=False, verify=VERIFY_FULL, modem=None):
+    '''Flash files to many probes at once, returns False if not requested (single probe).'''
+    if all_probes:
+        jlink_sn = get_probes(ctx.obj.get('backend'), ctx.obj.get('sim_script'))
+        if not jlink_sn:
+            raise click.ClickException('No J-Link found (check USB cable)')
+    if len(jlink_sn) < 2 and not all_probes:
+        return False
+
+    click.echo(f'Probes: {", ".join(str(sn) for sn in jlink_sn)}')
+
+    def progress(serial_number, text):
+        click.echo(f'[{serial_number}] {text}')
+
+    results = flash_probes(mcu, jlink_sn, files, halt, jlink_speed,
+                           ctx.obj.get('backend'), ctx.obj.get('sim_script'), progress, diff, verify, modem)
+    click.echo()
+    for line in format_summary(results):
+        click.echo(line)
+    failed = sum(1 for r in results if r[1])
+    if failed:
+        raise click.ClickException(f'Failed {failed} of {len(results)} probes')
+    return True
+
+
 @cli.command('flash')
 @click.option('--halt', is_flag=True, help='Halt program.')
-@click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='JLink serial number')
+@click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', multiple=True, help='JLink serial number (repeat to flash more probes in parallel)')
+@click.option('--all-probes', is_flag=True, help='Flash all connected probes in parallel.')
+@click.option('--diff', is_flag=True, help='Erase and write only flash pages which differ from the image.')
+@click.option('--verify', type=click.Choice(VERIFY_MODES), default=VERIFY_FULL, help='Verification of written flash (sampled reads back first, last and random pages).', show_default=True)
 @click.option('--jlink-speed', type=int, metavar="SPEED", help='JLink clock speed in kHz', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
 @click.argument('hex_file', metavar='HEX_FILE_OR_ID', callback=validate_hex_file, default=find_hex('.', no_exception=True))
 @click.pass_context
-def command_flash(ctx, halt, jlink_sn, jlink_speed, hex_file):
+def command_flash(ctx, halt, jlink_sn, all_probes, diff, verify, jlink_speed, hex_file):
     '''Flash application firmware (preserves UICR area).'''
     click.echo(f'File: {hex_file}')
+    click.echo(f'Verify: {verify}')
+
+    if flash_parallel(ctx, 'app', jlink_sn, all_probes, jlink_speed, [hex_file], halt, diff, verify):
+        return
 
     def progress(text, ctx={'len': 0}):
         if ctx['len']:
@@ -53,27 +92,46 @@ def command_flash(ctx, halt, jlink_sn, jlink_speed, hex_file):
         ctx['len'] = len(text)
         click.echo(text, nl=text == 'Successfully completed')
 
-    ctx.obj['prog'].set_serial_number(jlink_sn)
+    ctx.obj['prog'].set_serial_number(jlink_sn[0] if jlink_sn else None)
     ctx.obj['prog'].set_speed(jlink_speed)
 
     with ctx.obj['prog'] as prog:
-        prog.program(hex_file, halt, progress=progress)
+        prog.program(hex_file, halt, progress=progress, diff=diff, verify=verify)
 
 
 @cli.command('erase')
-@click.option('--all', is_flag=True, help='Erase application firmware incl. UICR area.')
+@click.option('--all', is_flag=True, help='Erase application firmware incl. UICR area (full chip erase).')
+@click.option('--range', 'ranges', metavar='START-END', multiple=True, help='Erase only pages of address range, START-END or START+SIZE (repeatable).')
+@click.option('--file', 'hex_file', metavar='HEX_FILE', type=click.Path(exists=True), help='Erase only pages used by the image.')
+@click.option('--blank-check/--no-blank-check', default=None, help='Skip pages which are already blank (default with --range or --file).')
 @click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='JLink serial number')
 @click.option('--jlink-speed', type=int, metavar="SPEED", help='JLink clock speed in kHz', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
 @click.pass_context
-def command_erase(ctx, all, jlink_sn, jlink_speed):
+def command_erase(ctx, all, ranges, hex_file, blank_check, jlink_sn, jlink_speed):
     '''Erase application firmware w/o UICR area.'''
+    if all and (ranges or hex_file):
+        raise click.UsageError('Option --all can not be combined with --range or --file.')
+    try:
+        ranges = [parse_range(r) for r in ranges]
+    except NRFJProgException as e:
+        raise click.BadParameter(str(e), param_hint='--range')
+    if hex_file:
+        ranges += image_ranges(hex_file)
+
+    def progress(text, ctx={'len': 0}):
+        if ctx['len']:
+            click.echo('\r' + (' ' * ctx['len']) + '\r', nl=False)
+        ctx['len'] = len(text)
+        click.echo(text, nl=False)
+
     ctx.obj['prog'].set_serial_number(jlink_sn)
     ctx.obj['prog'].set_speed(jlink_speed)
     with ctx.obj['prog'] as prog:
         if all:
             prog.erase_all()
         else:
-            prog.erase_flash()
+            prog.erase_flash(ranges or None, progress, blank_check)
+            progress('')
     click.echo('Successfully completed')
 
 
@@ -95,30 +153,65 @@ def command_reset(ctx, halt, jlink_sn, jlink_speed):
 
 default_history_file = os.path.expanduser("~/.chester_history")
 default_console_file = os.path.expanduser("~/.chester_console")
+default_log_index = os.path.expanduser("~/.chester_console.db")
 default_coredump_file = os.path.expanduser("~/.chester_coredump.bin")
 
 
+def validate_scrollback(ctx, param, value):
+    try:
+        parse_scrollback(value)
+    except ScrollbackException as e:
+        raise click.BadParameter(str(e))
+    return value
+
+
+def validate_size(ctx, param, value):
+    try:
+        return parse_size(value)
+    except LogFileException as e:
+        raise click.BadParameter(str(e))
+
+
+def validate_color_rules(ctx, param, value):
+    try:
+        return dict(parse_color_rule(rule) for rule in value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
 @cli.command('console')
 @click.option('--reset', is_flag=True, help='Reset application firmware.')
-@click.option('--latency', type=int, help='Latency for RTT readout in ms.', show_default=True, default=50)
+@click.option('--latency', type=click.IntRange(1), help='Latency for RTT readout in ms (overrides chester --rtt-latency).')
+@click.option('--scrollback', type=str, metavar='LIMIT', help='Scrollback limit per pane in lines or size with K/M suffix.', show_default=True, default=DEFAULT_SCROLLBACK, callback=validate_scrollback)
+@click.option('--module-color', 'module_colors', type=str, metavar='MODULE=COLOR', multiple=True, help='Color of log module name, e.g. app=#00ffff or app=Cyan (repeatable).', callback=validate_color_rules)
 @click.option('--history-file', type=click.Path(writable=True), show_default=True, default=default_history_file)
-@click.option('--console-file', type=click.File('a', 'utf-8'), show_default=True, default=default_console_file)
-@click.option('--coredump-file', type=click.File('wb', 'utf-8', lazy=True), show_default=True, default=default_coredump_file)
+@click.option('--console-file', type=click.Path(writable=True, dir_okay=False), show_default=True, default=default_console_file)
+@click.option('--console-file-size', type=str, metavar='SIZE', help='Rotate console file at size with K/M/G suffix (0 = never).', show_default=True, default='64M', callback=validate_size)
+@click.option('--console-file-rotate', type=click.IntRange(1), metavar='SECONDS', help='Rotate console file after time.')
+@click.option('--console-file-keep', type=click.IntRange(0), metavar='COUNT', help='Rotated console files kept (0 = all).', show_default=True, default=DEFAULT_LOG_KEEP)
+@click.option('--console-file-gzip', is_flag=True, help='Compress rotated console files with gzip.')
+@click.option('--log-index', type=click.Path(writable=True, dir_okay=False), help='SQLite index of log lines in console file (see app log query).', show_default=True, default=default_log_index)
+@click.option('--no-log-index', is_flag=True, help='Do not index log lines.')
+@click.option('--coredump-file', type=click.Path(writable=True, dir_okay=False), help='Coredump file, each coredump is saved with date/time suffix.', show_default=True, default=default_coredump_file)
 @click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='JLink serial number')
 @click.option('--jlink-speed', type=int, metavar="SPEED", help='JLink clock speed in kHz', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
 @click.pass_context
-def command_console(ctx, reset, latency, history_file, console_file, coredump_file, jlink_sn, jlink_speed):
+def command_console(ctx, reset, latency, scrollback, module_colors, history_file, console_file, console_file_size, console_file_rotate,
+                    console_file_keep, console_file_gzip, log_index, no_log_index, coredump_file, jlink_sn, jlink_speed):
     '''Start interactive console for shell and logging.'''
     logger.remove(2)  # Remove stderr logger
 
     ctx.obj['prog'].set_serial_number(jlink_sn)
     ctx.obj['prog'].set_speed(jlink_speed)
 
-    with ctx.obj['prog'] as prog:
+    index = None if no_log_index else LogIndex(log_index)
+    console_file = LogWriter(console_file, console_file_size, console_file_rotate, console_file_keep, console_file_gzip, index=index)
+
+    with ctx.obj['prog'] as prog, console_file:
         if reset:
             prog.reset()
             prog.go()
-        c = Console(prog, history_file, console_file, coredump_file, latency=latency)
+        c = Console(prog, history_file, console_file, coredump_file, latency=latency, scrollback=scrollback, module_colors=module_colors)
 
         click.echo('TIP: After J-Link connection, it is crucial to power cycle the target device; otherwise, the CPU debug mode results in a permanently increased power consumption.')
 
@@ -126,6 +219,87 @@ def command_console(ctx, reset, latency, history_file, console_file, coredump_fi
             raise c.exception
 
 
+@cli.group(name='log', invoke_without_command=True)
+@click.option('--reset', is_flag=True, help='Reset application firmware.')
+@click.option('--output', '-o', type=click.Path(writable=True, dir_okay=False, allow_dash=True), help='Output file (rotated as console file).', show_default=True, default='-')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help='Output format.', show_default=True, default=FORMAT_TEXT)
+@click.option('--channel', 'channels', type=click.Choice(CHANNELS), multiple=True, help='RTT channel (repeatable, default all).')
+@click.option('--duration', type=click.FloatRange(0, min_open=True), metavar='SECONDS', help='Stop after time.')
+@click.option('--output-size', type=str, metavar='SIZE', help='Rotate output file at size with K/M/G suffix (0 = never).', show_default=True, default='64M', callback=validate_size)
+@click.option('--output-keep', type=click.IntRange(0), metavar='COUNT', help='Rotated output files kept (0 = all).', show_default=True, default=DEFAULT_LOG_KEEP)
+@click.option('--log-index', type=click.Path(writable=True, dir_okay=False), help='SQLite index of log lines in text output file (see app log query).')
+@click.option('--coredump-file', type=click.Path(writable=True, dir_okay=False), help='Coredump file, each coredump is saved with date/time suffix.', show_default=True, default=default_coredump_file)
+@click.option('--latency', type=click.IntRange(1), help='Latency for RTT readout in ms (overrides chester --rtt-latency).')
+@click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='JLink serial number')
+@click.option('--jlink-speed', type=int, metavar="SPEED", help='JLink clock speed in kHz', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
+@click.pass_context
+def group_log(ctx, reset, output, fmt, channels, duration, output_size, output_keep, log_index, coredump_file, latency, jlink_sn, jlink_speed):
+    '''Stream device log (Terminal and Logger channels) without interactive console.'''
+    if ctx.invoked_subcommand is not None:
+        return
+
+    if log_index and (output == '-' or fmt != FORMAT_TEXT):
+        raise click.UsageError('Option --log-index needs --output file in text format.')
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    if output == '-':
+        def write(text):
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        out = None
+    else:
+        out = LogWriter(output, output_size, None, output_keep, index=LogIndex(log_index) if log_index else None)
+        write = out.write
+
+    def on_coredump(coredump):
+        click.echo(f'Coredump saved to {coredump.output_path}, size: {coredump.size} B, {"failed" if coredump.has_error else "ok"}', err=True)
+
+    ctx.obj['prog'].set_serial_number(jlink_sn)
+    ctx.obj['prog'].set_speed(jlink_speed)
+    if latency is not None:
+        ctx.obj['prog'].set_rtt_latency(latency)
+
+    try:
+        with ctx.obj['prog'] as prog:
+            if reset:
+                prog.reset()
+                prog.go()
+            stream_log(prog, write, channels or None, fmt, Coredump(coredump_file), duration, on_coredump)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if out:
+            out.close()
+
+
+@group_log.command('query')
+@click.option('--db', 'db_path', type=click.Path(exists=True, dir_okay=False), help='Log index created by console.', show_default=True, default=default_log_index)
+@click.option('--level', 'levels', type=click.Choice(LEVELS), multiple=True, help='Log level (repeatable).')
+@click.option('--module', 'modules', type=str, metavar='MODULE', multiple=True, help='Log module (repeatable).')
+@click.option('--since', type=click.DateTime(), help='Start of time window (local host time).')
+@click.option('--until', type=click.DateTime(), help='End of time window (local host time).')
+@click.option('--regex', type=str, metavar='REGEX', help='Regular expression the line must contain.')
+@click.option('--limit', type=click.IntRange(1), metavar='COUNT', help='Maximum number of lines.')
+@click.option('--json', 'out_json', is_flag=True, help='Output JSON lines.')
+def command_log_query(db_path, levels, modules, since, until, regex, limit, out_json):
+    '''Search indexed log lines by level, module, time and text.'''
+    try:
+        re.compile(regex or '')
+    except re.error as e:
+        raise click.BadParameter(str(e), param_hint='--regex')
+    index = LogIndex(db_path)
+    try:
+        for host_time, device_time, level, module, line in index.query(
+                levels, modules, since.timestamp() if since else None, until.timestamp() if until else None, regex, limit):
+            if out_json:
+                click.echo(json.dumps({'host_time': host_time, 'device_time': device_time, 'level': level, 'module': module, 'line': line}))
+            else:
+                click.echo(line)
+    finally:
+        index.close()
+
+
 def validate_pib_param(ctx, param, value):
     # print('validate_pib_param', ctx.obj, param.name, value)
     try:
@@ -341,7 +515,7 @@ def command_fw_info(ctx, id, show_all):
 
 @cli.command('command')
 @click.option('--reset', is_flag=True, help='Reset application firmware.')
-@click.option('--timeout', '-t', type=float, metavar='TIMEOUT', help='Read line timeout in seconds.', default=1, show_default=True)
+@click.option('--timeout', '-t', type=float, metavar='TIMEOUT', help='Response timeout in seconds.', default=1, show_default=True)
 @click.argument('command', type=str)
 @click.pass_context
 def command_pokus(ctx, reset, timeout, command):
@@ -350,11 +524,7 @@ def command_pokus(ctx, reset, timeout, command):
         if reset:
             ch.reset()
             time.sleep(1)
-        ch.terminal_write(f'{command}\n')
-        while True:
-            line = ch.terminal_read_line(timeout)
-            if line is None:
-                break
+        for line in ch.shell(command, timeout):
             print(line)
 
 
@@ -410,28 +580,75 @@ def command_fs_stats(ctx):
         click.echo(f'Free: {f.rjust(len(s))} ({stat["free"] / stat["size"] * 100:>4.1f}%)')
 
 
+class TransferProgress:
+    '''Status line with transferred size and throughput, one line per file.'''
+
+    def __init__(self):
+        self.start = None
+
+    def __call__(self, done, size):
+        if self.start is None:
+            self.start = (time.time(), done)
+        elapsed = time.time() - self.start[0]
+        rate = (done - self.start[1]) / elapsed if elapsed else 0
+        click.echo(f'\r{bytes_to_human(done)} / {bytes_to_human(size)} ({bytes_to_human(rate)}/s)   ', nl=done >= size, err=True)
+        if done >= size:
+            self.start = None
+
+
 @group_fs.command('download')
 @click.option('--recursive', '-r', is_flag=True, help='Copy directories recursively.')
+@click.option('--resume', is_flag=True, help='Continue partially downloaded destination file(s).')
+@click.option('--quiet', '-q', is_flag=True, help='Do not show progress.')
 @click.argument('src', type=str)
 @click.argument('dst', type=str)
 @click.pass_context
-def command_fs_download(ctx, recursive, src, dst):
+def command_fs_download(ctx, recursive, resume, quiet, src, dst):
     '''Download file or directory from file system.'''
     with ctx.obj['prog'] as prog:
         ch = App(prog)
-        ch.fs_download(src, dst, recursive)
+        ch.fs_download(src, dst, recursive, resume, None if quiet else TransferProgress())
 
 
 @group_fs.command('upload')
 @click.option('--recursive', '-r', is_flag=True, help='Copy directories recursively.')
+@click.option('--mode', type=click.Choice(UPLOAD_MODES), help='Transfer mode, auto falls back to legacy if bulk fails.', default=UPLOAD_MODE_AUTO, show_default=True)
+@click.option('--checksum', is_flag=True, help='Read back uploaded file and compare SHA-256.')
 @click.argument('src', type=str)
 @click.argument('dst', type=str)
 @click.pass_context
-def command_fs_upload(ctx, recursive, src, dst):
+def command_fs_upload(ctx, recursive, mode, checksum, src, dst):
     '''Upload file or directory to file system.'''
     with ctx.obj['prog'] as prog:
         ch = App(prog)
-        ch.fs_upload(src, dst, recursive)
+        ch.fs_upload(src, dst, recursive, mode, checksum)
+
+
+@group_fs.command('sync')
+@click.option('--delete', is_flag=True, help='Delete files and directories in destination which are not in source.')
+@click.option('--dry-run', is_flag=True, help='Only show what would be transferred or deleted.')
+@click.option('--mode', type=click.Choice(UPLOAD_MODES), help='Transfer mode, auto falls back to legacy if bulk fails.', default=UPLOAD_MODE_AUTO, show_default=True)
+@click.option('--serial-number', type=str, help='Device serial number for the manifest (default is read from PIB).')
+@click.option('--manifest-path', type=click.Path(file_okay=False), help='Directory with per device manifests.', default=DEFAULT_MANIFEST_PATH, show_default=True)
+@click.argument('src', type=click.Path(exists=True, file_okay=False))
+@click.argument('dst', type=str)
+@click.pass_context
+def command_fs_sync(ctx, delete, dry_run, mode, serial_number, manifest_path, src, dst):
+    '''Upload only changed files from directory to file system.'''
+    with ctx.obj['prog'] as prog:
+        if serial_number is None:
+            try:
+                serial_number = PIB(prog.read_uicr()).get_serial_number()
+            except PIBException as e:
+                raise click.ClickException(f'Can not read serial number from PIB ({e}), use --serial-number')
+        ch = App(prog)
+        result = ch.fs_sync(src, dst, SyncManifest(serial_number, manifest_path), delete, dry_run, mode)
+
+    for path in result['upload']:
+        click.echo(f'Upload {path}')
+    for path in result['delete']:
+        click.echo(f'Delete {path}')
+    click.echo(f'Uploaded: {len(result["upload"])}, up to date: {len(result["skip"])}, deleted: {len(result["delete"])}')
 
 
 @group_fs.command('rm')
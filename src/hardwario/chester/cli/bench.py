@@ -0,0 +1,58 @@
+import click
+import json
+from .. import bench
+
+
+@click.group(name='bench')
+def cli():
+    '''Benchmarks of RTT, shell and file transfer hot paths.'''
+
+
+@cli.command('run')
+@click.option('--only', '-o', 'names', type=click.Choice(bench.BENCHMARKS), multiple=True, help='Run only selected benchmark (repeatable).')
+@click.option('--duration', type=float, metavar='SECONDS', help='Duration of streaming benchmarks.', default=2.0, show_default=True)
+@click.option('--size', type=int, metavar='BYTES', help='File size for fs benchmarks.', default=2048, show_default=True)
+@click.option('--latency', type=float, metavar='SECONDS', help='Simulated probe call latency.', default=0, show_default=True)
+@click.option('--data-rate', type=int, metavar='BPS', help='Simulated SWD data rate in B/s.', default=10000000, show_default=True)
+@click.option('--replay', type=click.Path(exists=True, dir_okay=False), help='Use RTT recording as data source instead of generated logs.')
+@click.option('--baseline', type=click.File('r'), help='Compare with results of previous run (JSON).')
+@click.option('--output', type=click.File('w'), help='Save results in JSON format.')
+@click.option('--json', 'out_json', is_flag=True, help='Output in JSON format.')
+def command_run(names, duration, size, latency, data_rate, replay, baseline, output, out_json):
+    '''Run benchmarks against simulated device.'''
+    results = bench.run(names or bench.BENCHMARKS, duration=duration, size=size,
+                        latency=latency, data_rate=data_rate, replay=replay)
+
+    if output:
+        json.dump(results, output, indent=2)
+
+    if out_json:
+        click.echo(json.dumps(results, indent=2))
+        return
+
+    click.echo(f'{"Benchmark":12} {"Bytes/s":>12} {"Lines/s":>10} {"p50 ms":>9} {"p99 ms":>9} {"CPU %":>6}')
+    for r in results:
+        click.echo(f'{r["name"]:12} {r["bytes_per_s"]:>12.0f} {r["lines_per_s"]:>10.0f} {r["p50_ms"]:>9.3f} {r["p99_ms"]:>9.3f} {r["cpu_percent"]:>6.1f}')
+
+    if baseline:
+        click.echo()
+        click.echo(f'{"Benchmark":12} {"Metric":12} {"Baseline":>12} {"Current":>12} {"Change":>8}')
+        for name, key, b, c, change in bench.compare(results, json.load(baseline)):
+            click.echo(f'{name:12} {key:12} {b:>12.3f} {c:>12.3f} {change:>+7.1f}%')
+
+
+@cli.command('record')
+@click.option('--channel', '-c', 'channels', type=str, multiple=True, help='RTT up channel (repeatable).', default=['Terminal', 'Logger'], show_default=True)
+@click.option('--duration', type=float, metavar='SECONDS', help='Recording duration.', default=60, show_default=True)
+@click.option('--mcu', type=click.Choice(['app', 'lte']), help='Target SoC.', default='app', show_default=True)
+@click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='JLink serial number')
+@click.argument('file', type=click.File('w'))
+@click.pass_context
+def command_record(ctx, channels, duration, mcu, jlink_sn, file):
+    '''Record RTT channels to <FILE> for replay in benchmarks.'''
+    from ..nrfjprog import create_prog
+
+    prog = create_prog(mcu, ctx.obj.get('backend'), ctx.obj.get('sim_script'), jlink_sn=jlink_sn, rtt_latency=ctx.obj.get('rtt_latency'))
+    with prog:
+        total = bench.record(prog, file, channels, duration)
+    click.echo(f'Recorded {total} B')
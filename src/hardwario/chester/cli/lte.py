@@ -1,12 +1,12 @@
 import click
-import tempfile
-import zipfile
-import os
-import socket
 import time
-from loguru import logger
 from ..pib import PIB, PIBException
-from ..nrfjprog import NRFJProg, DEFAULT_JLINK_SPEED_KHZ
+from ..nrfjprog import DEFAULT_JLINK_SPEED_KHZ, VERIFY_MODES, VERIFY_FULL, create_prog
+from ..trace import TracePipeline, FileSink, SegmentedFileSink, SocketSink, TraceServer, StatusLine, DEFAULT_SINK_BUFFER, \
+    DEFAULT_REPLAY_BACKLOG, COMPRESS_SUFFIX, COMPRESS_NONE, extract_trace
+from ..utils import bytes_to_human
+from ..modem import ModemException, extract_package, is_package, modem_info, modem_up_to_date
+from .app import flash_parallel
 
 
 @click.group(name='lte')
@@ -16,20 +16,40 @@ from ..nrfjprog import NRFJProg, DEFAULT_JLINK_SPEED_KHZ
 @click.pass_context
 def cli(ctx, jlink_sn, jlink_speed, nrfjprog_log):
     '''LTE Modem SoC commands.'''
-    ctx.obj['prog'] = NRFJProg(
-        'lte', log=nrfjprog_log, jlink_sn=jlink_sn, jlink_speed=jlink_speed)
+    ctx.obj['prog'] = create_prog(
+        'lte', ctx.obj.get('backend'), ctx.obj.get('sim_script'), log=nrfjprog_log, jlink_sn=jlink_sn, jlink_speed=jlink_speed,
+        rtt_latency=ctx.obj.get('rtt_latency'))
 
 
 @cli.command('flash')
 @click.argument('file', metavar='FILE', type=click.Path(exists=True))
-@click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='Specify J-Link serial number.')
+@click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', multiple=True, help='Specify J-Link serial number (repeat to flash more probes in parallel).')
+@click.option('--all-probes', is_flag=True, help='Flash all connected probes in parallel.')
+@click.option('--diff', is_flag=True, help='Erase and write only flash pages which differ from the application image.')
+@click.option('--verify', type=click.Choice(VERIFY_MODES), default=VERIFY_FULL, help='Verification of written flash (sampled reads back first, last and random pages).', show_default=True)
+@click.option('--force-modem', is_flag=True, help='Update modem firmware even if the device already runs the same version.')
 @click.option('--jlink-speed', type=int, metavar="SPEED", help='Specify J-Link clock speed in kHz.', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
 @click.pass_context
-def command_flash(ctx, jlink_sn, jlink_speed, file):
+def command_flash(ctx, jlink_sn, all_probes, diff, verify, force_modem, jlink_speed, file):
     '''Flash modem firmware.'''
+    click.echo(f'Verify: {verify}')
+
+    package = None
+    if is_package(file):
+        try:
+            package = extract_package(file)
+        except ModemException as e:
+            raise click.ClickException(str(e))
+        click.echo(f'Modem firmware: {package["info"]["version"] or "unknown version"}')
+
+    if len(jlink_sn) > 1 or all_probes:
+        files = [package['modem.zip'], package['application.hex']] if package else [file]
+        modem = None if force_modem or not package else package['info']
+        flash_parallel(ctx, 'lte', jlink_sn, all_probes, jlink_speed, files, diff=diff, verify=verify, modem=modem)
+        return
 
     if jlink_sn:
-        ctx.obj['prog'].set_serial_number(jlink_sn)
+        ctx.obj['prog'].set_serial_number(jlink_sn[0])
 
     if jlink_speed != DEFAULT_JLINK_SPEED_KHZ:
         ctx.obj['prog'].set_speed(jlink_speed)
@@ -43,27 +63,23 @@ def command_flash(ctx, jlink_sn, jlink_speed, file):
         ctx['len'] = len(text)
         click.echo(text, nl=text == 'Successfully completed')
 
-    if file.endswith('.zip'):
-        zf = zipfile.ZipFile(file)
-        namelist = zf.namelist()
-        if len(namelist) == 2:
-            if 'modem.zip' not in namelist or 'application.hex' not in namelist:
-                raise Exception('Invalid file.')
-
-            with tempfile.TemporaryDirectory() as temp_dir:
-                zf.extractall(temp_dir)
-                with ctx.obj['prog'] as prog:
-                    click.echo(f'Flash: modem.zip')
-                    prog.program(os.path.join(
-                        temp_dir, 'modem.zip'), progress=progress)
-                    progress(None)
-                    click.echo(f'Flash: application.hex')
-                    prog.program(os.path.join(
-                        temp_dir, 'application.hex'), progress=progress)
+    if package:
+        with ctx.obj['prog'] as prog:
+            if not force_modem and modem_up_to_date(prog, package['info']):
+                click.echo(f'Flash: modem.zip (up to date, skipped)')
+            else:
+                click.echo(f'Flash: modem.zip')
+                prog.program(package['modem.zip'], progress=progress, verify=verify)
+                progress(None)
+            click.echo(f'Flash: application.hex')
+            prog.program(package['application.hex'], progress=progress, diff=diff, verify=verify)
     else:
         with ctx.obj['prog'] as prog:
-            click.echo(f'Flash: {file}')
-            prog.program(file, progress=progress)
+            if file.endswith('.zip') and not force_modem and modem_up_to_date(prog, modem_info(file)):
+                click.echo(f'Flash: {file} (up to date, skipped)')
+            else:
+                click.echo(f'Flash: {file}')
+                prog.program(file, progress=progress, diff=diff, verify=verify)
 
     progress(None)
     click.echo('Successfully completed')
@@ -108,11 +124,27 @@ def command_reset(ctx, jlink_sn, jlink_speed):
 @click.option('--jlink-speed', type=int, metavar="SPEED", help='Specify J-Link clock speed in kHz.', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
 @click.option('--file', '-f', 'filename', metavar='FILE', type=click.Path(writable=True))
 @click.option('--tcp', '-t', 'tcpconnect', metavar='TCP', type=str, help='TCP connect to server, format: <host>:<port>')
+@click.option('--listen', '-l', metavar='HOST:PORT', type=str, help='Listen for TCP clients (e.g. Wireshark, Trace Collector), any number can attach and detach.')
+@click.option('--backlog', type=click.IntRange(0), metavar='BYTES', default=DEFAULT_REPLAY_BACKLOG, show_default=True, help='Recent trace sent to newly attached --listen client.')
+@click.option('--rotate-size', type=click.IntRange(4096), metavar='BYTES', help='Start new file segment when it reaches size.')
+@click.option('--rotate-time', type=click.IntRange(1), metavar='SECONDS', help='Start new file segment after time.')
+@click.option('--compress', type=click.Choice(list(COMPRESS_SUFFIX)), default=COMPRESS_NONE, show_default=True, help='Compression of file segments.')
+@click.option('--keep', type=click.IntRange(1), metavar='COUNT', help='Keep only last file segments.')
+@click.option('--buffer-size', type=click.IntRange(65536), metavar='BYTES', default=DEFAULT_SINK_BUFFER, show_default=True, help='Data queued for each output before it is dropped.')
 @click.pass_context
-def command_trace(ctx, jlink_sn, jlink_speed, filename, tcpconnect):
+def command_trace(ctx, jlink_sn, jlink_speed, filename, tcpconnect, listen, backlog, rotate_size, rotate_time, compress, keep, buffer_size):
     '''Modem trace.'''
 
-    # sudo socat -d -d pty,link=/dev/virtual_serial_port,raw,echo=0,group-late=dialout,perm=0777 TCP-LISTEN:5555,reuseaddr,fork
+    # With --listen, a pty for tools reading a serial port can be created by connecting socat as a client:
+    # sudo socat -d -d pty,link=/dev/virtual_serial_port,raw,echo=0,group-late=dialout,perm=0777 TCP:localhost:5555
+
+    if not filename:
+        for name, used in (('--rotate-size', rotate_size), ('--rotate-time', rotate_time), ('--keep', keep),
+                           ('--compress', compress != COMPRESS_NONE)):
+            if used:
+                raise click.BadParameter('Requires --file.', param_hint=name)
+    if keep and not (rotate_size or rotate_time):
+        raise click.BadParameter('Requires --rotate-size or --rotate-time.', param_hint='--keep')
 
     if jlink_sn:
         ctx.obj['prog'].set_serial_number(jlink_sn)
@@ -120,72 +152,94 @@ def command_trace(ctx, jlink_sn, jlink_speed, filename, tcpconnect):
     if jlink_speed != DEFAULT_JLINK_SPEED_KHZ:
         ctx.obj['prog'].set_speed(jlink_speed)
 
-    fd = None
-    client_socket = None
+    sinks = []
 
-    if filename:
-        fd = open(filename, 'wb')
+    if filename and (rotate_size or rotate_time or keep or compress != COMPRESS_NONE):
+        # Segments FILE.0001 ... with index FILE.index usable by trace-extract, single one without rotation
+        sinks.append(SegmentedFileSink(filename, compress, rotate_size, rotate_time, keep, max_buffer=buffer_size))
+    elif filename:
+        sinks.append(FileSink(filename, max_buffer=buffer_size))
 
     if tcpconnect:
         host, port = tcpconnect.split(':')
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((host, int(port)))
-
-    while True:
-        print('Starting modem trace...')
-
-        text_len = 0
-        last_text = ''
-
-        try:
-            with ctx.obj['prog'] as prog:
-
-                channels = prog.rtt_start()
-
-                if 'modem_trace' not in channels:
-                    raise Exception('Not found modem_trace channel in RTT.')
+        sinks.append(SocketSink(host, int(port), max_buffer=buffer_size))
+
+    server = None
+    if listen:
+        host, _, port = listen.rpartition(':')
+        if not port.isdigit():
+            raise click.BadParameter('Expected HOST:PORT', param_hint='--listen')
+        server = TraceServer(host or '0.0.0.0', int(port), backlog, buffer_size)
+        sinks.append(server)
+        print(f'Listening on {server.address[0]}:{server.address[1]}')
+
+    # Outputs are written by own threads, the RTT reader only queues data
+    pipeline = TracePipeline(sinks)
+    status = StatusLine()
+
+    try:
+        while True:
+            print('Starting modem trace...')
+
+            try:
+                with ctx.obj['prog'] as prog:
 
-                print('Started modem trace')
-                recv_len = 0
-                text_len = 0
+                    channels = prog.rtt_start()
 
-                e_cnt = 0
-                while True:
-                    try:
-                        data = prog.rtt_read('modem_trace', encoding=None)
-                    except Exception as e:
-                        e_cnt += 1
-                        if e_cnt > 10:
-                            raise
-                        continue
+                    if 'modem_trace' not in channels:
+                        raise Exception('Not found modem_trace channel in RTT.')
 
-                    if fd:
-                        fd.write(data)
-                        fd.flush()
+                    print('Started modem trace')
+                    poller = prog.rtt_poller()
 
-                    if client_socket:
+                    e_cnt = 0
+                    while True:
                         try:
-                            client_socket.send(data)
+                            data = prog.rtt_read('modem_trace', encoding=None)
                         except Exception as e:
-                            if text_len:
-                                print()
-                                text_len = 0
-                            print(e)
-
-                    if text_len:
-                        print(f"\r{' ' * text_len}\r", end='')
-                    if data:
-                        recv_len += len(data)
-
-                    last_text = f'Receive: {recv_len} B'
-                    text_len = len(last_text)
-                    print(last_text, end='')
-
-        except Exception as e:
-            if last_text:
-                print()
-            print('Restart exception:', str(e))
-            time.sleep(0.5)
+                            e_cnt += 1
+                            if e_cnt > 10:
+                                raise
+                            continue
+
+                        pipeline.feed(data)
+
+                        if pipeline.update_rate():
+                            text = f'Receive: {pipeline.received} B, {bytes_to_human(pipeline.rate)}/s, dropped: {pipeline.dropped} B'
+                            if server:
+                                text += f', clients: {len(server.clients)}'
+                            status.update(text)
+
+                        poller.wait(data)
+
+            except Exception as e:
+                status.newline()
+                print('Restart exception:', str(e))
+                time.sleep(0.5)
+    finally:
+        pipeline.close()
+        status.newline()
+        for sink in pipeline.sinks:
+            print(f'{sink.name}: written {sink.written} B, dropped {sink.dropped} B, errors {sink.errors}')
+
+
+@cli.command('trace-extract')
+@click.argument('index_file', metavar='INDEX_FILE', type=click.Path(exists=True, dir_okay=False))
+@click.option('--output', '-o', metavar='FILE', type=click.File('wb'), default='-', help='Output file (default stdout).')
+@click.option('--since', type=click.DateTime(), help='Start of time window (local time).')
+@click.option('--until', type=click.DateTime(), help='End of time window (local time).')
+def command_trace_extract(index_file, output, since, until):
+    '''Extract time window of segmented modem trace (FILE.index of lte trace --rotate-*/--compress).
+
+    Precision is given by index blocks (1 second), the window is extended to whole blocks.
+    '''
+    start = since.timestamp() if since else None
+    end = until.timestamp() if until else None
+    total = 0
+    for data in extract_trace(index_file, start, end):
+        output.write(data)
+        total += len(data)
+    click.echo(f'Extracted {total} B', err=True)
 
 
 def main():
@@ -0,0 +1,64 @@
+import os
+import sys
+import json
+import click
+from ..nrfjprog import DEFAULT_JLINK_SPEED_KHZ
+from ..server import DEFAULT_SERVE_ADDRESS, JOB_OPS, Server, ServerException, serve, request
+
+
+@click.command('serve')
+@click.option('--listen', '-l', type=str, metavar='ADDRESS', help='HOST:PORT or unix:PATH to listen on.', default=DEFAULT_SERVE_ADDRESS, show_default=True)
+@click.option('--jlink-speed', type=int, metavar="SPEED", help='JLink clock speed in kHz', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
+@click.pass_context
+def command_serve(ctx, listen, jlink_speed):
+    '''Run daemon keeping probe sessions open and executing jobs from clients.'''
+    server = Server(ctx.obj.get('backend'), ctx.obj.get('sim_script'), jlink_speed)
+    try:
+        serve(listen, server)
+    except KeyboardInterrupt:
+        pass
+
+
+def parse_params(ctx, param, value):
+    params = {}
+    for item in value:
+        key, sep, val = item.partition('=')
+        if not sep:
+            raise click.BadParameter(f'Expected KEY=VALUE: {item}')
+        try:
+            params[key] = json.loads(val)
+        except ValueError:
+            params[key] = val
+    return params
+
+
+@click.command('job')
+@click.option('--connect', '-c', type=str, metavar='ADDRESS', envvar='CHESTER_SERVE', help='Address of chester serve.', default=DEFAULT_SERVE_ADDRESS, show_default=True)
+@click.option('--mcu', type=click.Choice(['app', 'lte']), help='Target MCU.', default='app', show_default=True)
+@click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='JLink serial number')
+@click.argument('op', type=click.Choice(JOB_OPS + ('status',)))
+@click.argument('params', nargs=-1, metavar='[KEY=VALUE]...', callback=parse_params)
+def command_job(connect, mcu, jlink_sn, op, params):
+    '''Submit job to chester serve and print JSON result.
+
+    \b
+    Examples:
+      chester job flash file=/path/firmware.hex
+      chester job -n 123456 shell command="kernel uptime"
+      chester job pib_write fields='{"serial_number": "2159000001"}'
+    '''
+    if 'file' in params:
+        # Resolved here, the daemon runs in another working directory
+        params['file'] = os.path.abspath(params['file'])
+        if not os.path.isfile(params['file']):
+            raise click.BadParameter(f'File not found: {params["file"]}', param_hint='file')
+    try:
+        if op == 'status':
+            result = request(connect, 'GET', '/status')
+        else:
+            result = request(connect, 'POST', '/jobs', dict(params, op=op, mcu=mcu, jlink_sn=jlink_sn))
+    except ServerException as e:
+        raise click.ClickException(str(e))
+    click.echo(json.dumps(result, indent=2))
+    if result.get('ok') is False:
+        sys.exit(1)
@@ -1,6 +1,5 @@
 import threading
 import os
-import asyncio
 import logging
 import sys
 import re
@@ -29,12 +28,26 @@ from prompt_toolkit.styles.named_colors import NAMED_COLORS
 from prompt_toolkit.filters import Condition
 from prompt_toolkit.validation import Validator, ValidationError
 from prompt_toolkit.layout.dimension import LayoutDimension
-from .nrfjprog import NRFJProg, NRFJProgRTTNoChannels, NRFJProgException
+from .nrfjprog import NRFJProg, RTTPump
 from .utils import Coredump
+from .logfile import Timestamp
+from .logindex import LOG_PATTERN, LOG_PATTERN_OLD
+from .scrollback import Scrollback, LogScrollback, ScrollbackException, DEFAULT_SCROLLBACK, parse_scrollback
 
 
-def get_time():
-    return datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:23]
+def parse_color_rule(rule):
+    '''Parse MODULE=COLOR rule, color is #rrggbb or named color.'''
+    module, sep, color = rule.partition('=')
+    if not sep or not module or not color:
+        raise ValueError(f'Invalid color rule: {rule}')
+    if color in NAMED_COLORS:
+        color = NAMED_COLORS[color]
+    elif not re.match(r'^#[0-9a-fA-F]{6}$', color):
+        raise ValueError(f'Invalid color: {color}')
+    return module, color
+
+
+get_time = Timestamp()
 
 
 log_level_color_lut = {
@@ -52,21 +65,44 @@ log_level_color_lut = {
 
 class LogLexer(Lexer):
 
-    def __init__(self, patern, colors=log_level_color_lut) -> None:
+    CACHE_SIZE = 10000
+
+    def __init__(self, patern, colors=log_level_color_lut, module_colors=None) -> None:
         super().__init__()
-        self.patern = patern
+        self.patern = re.compile(patern)
         self.colors = colors
+        self.module_colors = module_colors or {}
+        self._module_patern = re.compile(r'^(\s*)([\w.-]+)(:.*)$', re.S)
+        self._cache = {}
 
-    def lex_document(self, document):
-        def get_line(lineno):
-            line = document.lines[lineno]
+    def _lex_line(self, line):
+        g = self.patern.match(line)
+        if not g:
+            return [('#eeeeee', line)]
 
-            g = re.match(self.patern, line)
-            if g:
-                color = self.colors.get(g.group(2), '#eeeeee')
-                return [(color, g.group(1)), ('#eeeeee', g.group(3))]
+        color = self.colors.get(g.group(2), '#eeeeee')
+        rest = g.group(3)
+        if self.module_colors:
+            m = self._module_patern.match(rest)
+            if m and m.group(2) in self.module_colors:
+                return [(color, g.group(1)), ('#eeeeee', m.group(1)),
+                        (self.module_colors[m.group(2)], m.group(2)), ('#eeeeee', m.group(3))]
+        return [(color, g.group(1)), ('#eeeeee', rest)]
 
-            return [('#eeeeee', line)]
+    def lex_document(self, document):
+        # Cache is keyed by line text, it stays valid when lines are evicted or filtered out
+        cache = self._cache
+        lines = document.lines
+
+        def get_line(lineno):
+            line = lines[lineno]
+            tokens = cache.get(line)
+            if tokens is None:
+                tokens = self._lex_line(line)
+                cache[line] = tokens
+                if len(cache) > self.CACHE_SIZE:
+                    del cache[next(iter(cache))]  # Oldest
+            return tokens
 
         return get_line
 
@@ -80,11 +116,12 @@ class InputValidator(Validator):
 
 class Console:
 
-    def __init__(self, prog: NRFJProg, history_file, console_file, coredump_file, latency=50):
+    def __init__(self, prog: NRFJProg, history_file, console_file, coredump_file, latency=None, scrollback=DEFAULT_SCROLLBACK, module_colors=None):
         self.exception = None
         self.show_status_bar = True
         self.scroll_to_end = True
         self.zoom = None
+        self.coredump = coredump = Coredump(coredump_file)
 
         channels = prog.rtt_start()
 
@@ -109,6 +146,8 @@ class Console:
             search_field=shell_search,
         )
         self.shell_buffer = shell_window.buffer
+        scrollback_lines, scrollback_bytes = parse_scrollback(scrollback)
+        self.shell_scrollback = Scrollback(self.shell_buffer, scrollback_lines, scrollback_bytes)
 
         logger_search = SearchToolbar(ignore_case=True, vi_mode=True)
         logger_window = TextArea(
@@ -119,9 +158,11 @@ class Console:
             read_only=True,
             search_field=logger_search,
             lexer=LogLexer(
-                r'^(#.*?\d(?:\.\d+)? <(\w)\>)(.*)' if is_old else r'^(\[.*?\].*?<(\w+)\>)(.*)')
+                LOG_PATTERN_OLD if is_old else LOG_PATTERN,
+                module_colors=module_colors)
         )
         self.logger_buffer = logger_window.buffer
+        self.logger_scrollback = LogScrollback(self.logger_buffer, scrollback_lines, scrollback_bytes)
         logger.debug(f'history_file: {history_file}')
 
         os.makedirs(os.path.dirname(history_file), exist_ok=True)
@@ -149,10 +190,21 @@ class Console:
                 ('class:title', ' <F3> Focus '),
                 ('class:title', ' <F5> Pause ') if self.scroll_to_end else (
                     'class:yellow', ' <F5> Pause '),
+                ('class:title', ' <F6> Level ') if self.logger_scrollback.level is None else (
+                    'class:yellow', ' <F6> Level '),
+                ('class:title', ' <F7> No Filter '),
                 ('class:title', ' <F8> Clear '),
                 ('class:title', ' <F10> Exit (or Ctrl-<F10>) '),
                 ('class:title', ' [Shift-]<Tab> Cycle '),
-            ]
+            ] + ([
+                ('class:yellow', f' Coredump {self.coredump.size} B ({self.coredump.rate / 1024:.1f} KB/s) ')
+            ] if self.coredump.in_progress else [])
+
+        def get_logger_title():
+            title = 'Device Log'
+            if self.logger_scrollback.filtering:
+                title += f' [{self.logger_scrollback.filter_text()}, {self.logger_scrollback.hidden} hidden]'
+            return [('class:cyan', title)] if self.has_focus(logger_window) else title
 
         def get_statusbar_scroll_text():
             return [
@@ -204,8 +256,7 @@ class Console:
                             [
                                 Frame(hs_schell,
                                       title=lambda: [('class:cyan', 'Interactive Shell')] if self.has_focus(shell_window) else 'Interactive Shell'),
-                                Frame(hs_logger, title=lambda: [('class:cyan', 'Device Log')] if self.has_focus(
-                                    logger_window) else 'Device Log')
+                                Frame(hs_logger, title=get_logger_title)
                             ]
                         ),
                         filter=Condition(lambda: not self.zoom)),
@@ -266,10 +317,18 @@ class Console:
                 self.logger_buffer.cursor_position = len(
                     self.logger_buffer.text)
 
+        @bindings.add("f6", eager=True)
+        def _(event):
+            self.logger_scrollback.cycle_level()
+
+        @bindings.add("f7", eager=True)
+        def _(event):
+            self.logger_scrollback.set_filter(level=None, modules=None, regex=None)
+
         @bindings.add("f8", eager=True)
         def _(event):
-            self.shell_buffer.set_document(Document(''), True)
-            self.logger_buffer.set_document(Document(''), True)
+            self.shell_scrollback.clear()
+            self.logger_scrollback.clear()
 
         @bindings.add("f3", eager=True)
         def _(event):
@@ -296,6 +355,8 @@ class Console:
             mouse_support=Condition(lambda: not self.zoom),
             full_screen=True,
             refresh_interval=1,
+            min_redraw_interval=0.05,
+            before_render=lambda _: self.refresh(),
             enable_page_navigation_bindings=True,
             clipboard=PyperclipClipboard(),
             style=Style.from_dict({
@@ -305,135 +366,119 @@ class Console:
             }, priority=Priority.MOST_PRECISE)
         )
 
-        coredump = Coredump()
-
-        rtt_read_delay = latency / 1000.0
-
-        if is_old:
-            async def task_rtt_read():
-                while prog.rtt_is_running:
-                    with logger.catch(message='task_rtt_read', reraise=True):
-                        try:
-                            lines = prog.rtt_read('Terminal')
-                        except NRFJProgRTTNoChannels:
-                            return
-                        except NRFJProgException as e:
-                            self.exit(e)
-                            return
-
-                        if lines:
-                            shell = ''
-                            log = ''
-                            for line in lines.splitlines():
-                                if line.startswith('#'):
-                                    log += line + '\n'
-                                    console_file.write(get_time() + ' ')
-                                    console_file.write(line)
-                                else:
-                                    shell += line + '\n'
-                                    console_file.write(get_time() + ' > ')
-                                    console_file.write(line)
-                                console_file.write('\n')
-                            console_file.flush()
-
-                            if shell:
-                                shell = shell.replace('\r', '')
-                                self.shell_buffer.set_document(
-                                    Document(self.shell_buffer.text + shell, None), True)
-                            if log:
-                                log = log.replace('\r', '')
-                                self.logger_buffer.set_document(
-                                    Document(self.logger_buffer.text + log, None), True)
-
-                        await asyncio.sleep(rtt_read_delay)
-
-        else:
-            channels_up = (
-                ('Terminal', self.shell_buffer),
-                ('Logger', self.logger_buffer)
-            )
-            cacheLines = {
-                'Terminal': '',
-                'Logger': ''
-            }
-
-            async def task_rtt_read():
-                cnt = 0
-                while prog.rtt_is_running:
-                    for channel, buffer in channels_up:
-                        with logger.catch(message='task_rtt_read', reraise=True):
-                            try:
-                                line = prog.rtt_read(channel)
-                            except NRFJProgRTTNoChannels:
-                                return
-                            except NRFJProgException as e:
-                                self.exit(e)
-                                return
-
-                            if line:
-                                slines = (
-                                    cacheLines[channel] + line).splitlines(keepends=True)
-                                cacheLines[channel] = ''
-                                for sline in slines:
-                                    p = sline[-1]
-                                    if p != '\r' and p != '\n':
-                                        cacheLines[channel] += sline
-                                        continue
-                                    console_file.write(
-                                        get_time() + (' # ' if channel == 'Logger' else ' > '))
-                                    console_file.write(sline)
-
-                                    coredump.feed_line(sline)
-                                    if coredump.has_end or coredump.has_error:
-                                        logger.info(
-                                            f'Writing coredump to file, size: {len(coredump.data)}')
-                                        coredump_file.open()
-                                        coredump_file.write(coredump.data)
-                                        coredump_file.flush()
-                                        coredump.reset()
-
-                                console_file.flush()
-
-                                line = line.replace('\r', '')
-                                changed = buffer._set_text(buffer.text + line)
-                                if changed:
-                                    if self.scroll_to_end:
-                                        buffer.cursor_position = len(
-                                            buffer.text)
-                                    buffer._text_changed()
-
-                            if coredump.has_begin:
-                                await asyncio.sleep(0.001)
-                            else:
-                                await asyncio.sleep(rtt_read_delay)
+        if latency is not None:
+            prog.set_rtt_latency(latency)
+
+        def process_old(channel, data, lines):
+            shell = ''
+            log = ''
+            text = ''
+            now = get_time()
+            for line in lines:
+                line = line.rstrip('\r\n')
+                if line.startswith('#'):
+                    log += line + '\n'
+                    text += f'{now} {line}\n'
+                else:
+                    shell += line + '\n'
+                    text += f'{now} > {line}\n'
+            console_file.write(text)
+            # Without Logger channel coredump comes in log lines (#CD:...)
+            feed_coredump(line for line in lines if line.startswith('#'))
+            items = []
+            if shell:
+                items.append((self.shell_scrollback, shell.replace('\r', '')))
+            if log:
+                items.append((self.logger_scrollback, log.replace('\r', '')))
+            return items
+
+        def feed_coredump(lines):
+            for sline in lines:
+                coredump.feed_line(sline)
+                if coredump.has_end or coredump.has_error:
+                    logger.info(
+                        f'Coredump saved to {coredump.output_path}, size: {coredump.size} B, {"failed" if coredump.has_error else "ok"}')
+                    coredump.reset()
+
+        scrollbacks = {'Terminal': self.shell_scrollback, 'Logger': self.logger_scrollback}
+
+        def process(channel, data, lines):
+            # Runs in the pump thread, the console file is written by its own background thread
+            prefix = get_time() + (' # ' if channel == 'Logger' else ' > ')
+            console_file.write(''.join(prefix + sline for sline in lines))
+
+            # Coredump is only read from Logger, shell responses would abort a dump in progress
+            if channel == 'Logger':
+                feed_coredump(lines)
+
+            text = data.decode('utf-8', errors='backslashreplace')
+            return [(scrollbacks[channel], text.replace('\r', ''))]
+
+        def on_rtt_data():
+            for scrollback, text in self.rtt_pump.drain():
+                scrollback.append(text)
+            if self.rtt_pump.exception:
+                self.exit(self.rtt_pump.exception)
+                return
+            self.app.invalidate()
 
         console_file.write(f'{ "*" * 80 }\n')
 
         loop = get_event_loop()
-        loop.create_task(task_rtt_read())
+        self.rtt_pump = RTTPump(prog, ('Terminal',) if is_old else ('Terminal', 'Logger'),
+                                process_old if is_old else process,
+                                lambda: loop.call_soon_threadsafe(on_rtt_data))
 
         def accept(buff):
+            if buff.text.startswith('/'):
+                self.filter_command(buff.text)
+                return None
+
             line = f'{buff.text}\n'.replace('\r', '')
             # self.shell_buffer.insert_text(line)
             console_file.write(f'{get_time()} < {line}')
-            text = self.shell_buffer.text + line
-            self.shell_buffer.set_document(Document(text, None), True)
+            self.shell_scrollback.append(line)
 
-            prog.rtt_write('Terminal', f'{buff.text}\n')
+            self.rtt_pump.write('Terminal', f'{buff.text}\n')
             return None
 
         self.input_field.accept_handler = accept
 
-        # try:
-        #     loop = get_running_loop()
-        # except RuntimeError:
-        #     loop = asyncio.new_event_loop()
-        #     asyncio.set_event_loop(loop)
-
-        loop.create_task(task_rtt_read())
-
-        self.app.run()
+        try:
+            # Pump is started by the running application, so errors can exit it
+            self.app.run(pre_run=self.rtt_pump.start)
+        finally:
+            self.rtt_pump.stop()
         prog.rtt_stop()
+        if coredump.abort():
+            logger.warning(f'Coredump incomplete on exit, saved to {coredump.output_path}, size: {coredump.size} B')
+        coredump.reset()
+
+    def filter_command(self, text):
+        '''Handle Device Log filter command of input field, shell commands never start with slash.
+
+        /level [dbg|inf|wrn|err], /module [NAME ...], /grep [REGEX], /filter (clears all),
+        command without argument disables its part of the filter.
+        '''
+        command, _, arg = text.partition(' ')
+        arg = arg.strip()
+        try:
+            if command == '/level':
+                self.logger_scrollback.set_filter(level=arg or None)
+            elif command == '/module':
+                self.logger_scrollback.set_filter(modules=arg.replace(',', ' ').split())
+            elif command == '/grep':
+                self.logger_scrollback.set_filter(regex=arg or None)
+            elif command == '/filter':
+                self.logger_scrollback.set_filter(level=None, modules=None, regex=None)
+            else:
+                raise ScrollbackException(f'Unknown command: {command} (use /level, /module, /grep or /filter)')
+        except ScrollbackException as e:
+            self.shell_scrollback.append(f'{e}\n')
+
+    def refresh(self):
+        self.shell_scrollback.refresh(self.scroll_to_end)
+        self.logger_scrollback.refresh(self.scroll_to_end)
 
     def exit(self, exception=None):
         self.exception = exception
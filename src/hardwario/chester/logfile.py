@@ -0,0 +1,202 @@
+import os
+import re
+import glob
+import gzip
+import time
+import shutil
+import threading
+from collections import deque
+from datetime import datetime
+from loguru import logger
+
+DEFAULT_LOG_MAX_SIZE = 64 * 1024 * 1024     # bytes before the file is rotated
+DEFAULT_LOG_KEEP = 5                        # rotated segments kept
+DEFAULT_LOG_FLUSH_INTERVAL = 0.5            # seconds between writes to disk
+DEFAULT_LOG_BUFFER = 16 * 1024 * 1024       # characters queued before text is dropped
+LOG_ROTATE_RETRY = 10                       # seconds before failed rotation is tried again
+
+
+class LogFileException(Exception):
+    pass
+
+
+def parse_size(value):
+    '''Parse size in bytes with optional K/M/G suffix.'''
+    m = re.match(r'^\s*(\d+)\s*([kKmMgG]?)[bB]?\s*$', str(value))
+    if not m:
+        raise LogFileException(f'Invalid size: {value}')
+    return int(m.group(1)) * 1024 ** ' KMG'.index(m.group(2).upper() or ' ')
+
+
+class Timestamp:
+    '''Current local time as YYYY-mm-dd HH:MM:SS.mmm, date and time part is formatted once per second.'''
+
+    def __init__(self):
+        self._second = None
+        self._prefix = ''
+
+    def __call__(self):
+        now = time.time()
+        second = int(now)
+        if second != self._second:
+            self._second = second
+            self._prefix = datetime.fromtimestamp(second).strftime('%Y-%m-%d %H:%M:%S')
+        return f'{self._prefix}.{int((now - second) * 1000):03d}'
+
+
+class LogWriter:
+    '''Append text to log file from background thread, rotated by size or time.
+
+    write() only queues text, the writer thread stores it in batches at most every
+    flush_interval seconds. Rotated file is renamed with date/time suffix and
+    optionally compressed with gzip, only the newest keep segments are preserved.
+    With index (LogIndex), written Logger lines are indexed by the writer thread.
+    '''
+
+    def __init__(self, file_path, max_size=DEFAULT_LOG_MAX_SIZE, rotate_time=None, keep=DEFAULT_LOG_KEEP,
+                 compress=False, flush_interval=DEFAULT_LOG_FLUSH_INTERVAL, max_buffer=DEFAULT_LOG_BUFFER, index=None):
+        self.file_path = file_path
+        self.index = index
+        self.max_size = max_size
+        self.rotate_time = rotate_time
+        self.keep = keep
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.dropped = 0
+        self._chunks = deque()
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._fd = None
+        self._rotate_after = 0
+        self._cleanup_lock = threading.Lock()
+        self._open()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='log-writer')
+        self._thread.start()
+
+    def _open(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.file_path)), exist_ok=True)
+        self._fd = open(self.file_path, 'ab')
+        self._size = self._fd.tell()
+        self._opened = time.time()
+        if self.index:
+            self.index.open_segment(self.file_path, self._size)
+
+    def write(self, text):
+        with self._cond:
+            if self._queued + len(text) > self.max_buffer:
+                self.dropped += len(text)
+                return
+            self._chunks.append(text)
+            self._queued += len(text)
+
+    def flush(self):
+        '''Request write of queued text without waiting for flush interval.'''
+        with self._cond:
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed:
+                    self._cond.wait(self.flush_interval)
+                text = ''.join(self._chunks)
+                self._chunks.clear()
+                self._queued = 0
+                dropped, self.dropped = self.dropped, 0
+                closed = self._closed
+            try:
+                if dropped:
+                    text += f'*** dropped {dropped} characters of log ***\n'
+                if text:
+                    self._write(text)
+            except Exception as e:
+                logger.warning(f'Log file {self.file_path}: {e}')
+            if closed:
+                break
+        self._fd.close()
+
+    def _write(self, text):
+        now = time.time()
+        due = (self.max_size and self._size >= self.max_size) or \
+            (self.rotate_time and self._size and now - self._opened >= self.rotate_time)
+        if due and now >= self._rotate_after:
+            try:
+                self._rotate()
+            except OSError as e:
+                # Writing continues to the base file, rotation is tried again later
+                self._rotate_after = now + LOG_ROTATE_RETRY
+                logger.warning(f'Log file {self.file_path} rotation failed: {e}')
+        data = text.encode('utf-8')
+        self._fd.write(data)
+        self._fd.flush()
+        if self.index:
+            self.index.add(data, self.file_path, self._size)
+        self._size += len(data)
+
+    def _rotate(self):
+        self._fd.close()
+        path = self._segment_path()
+        try:
+            os.rename(self.file_path, path)
+            if self.index:
+                self.index.rename(self.file_path, path)
+        finally:
+            self._open()
+        if self.compress:
+            # Compressed in own thread, writing continues to the new file meanwhile
+            threading.Thread(target=self._compress, args=(path,), daemon=True, name='log-compress').start()
+        else:
+            self._cleanup()
+
+    def _segment_path(self):
+        base, ext = os.path.splitext(self.file_path)
+        stamp = datetime.now().strftime('-%Y%m%d-%H%M%S')
+        i = 0
+        while True:
+            path = f'{base}{stamp}{f"-{i}" if i else ""}{ext}'
+            if not os.path.exists(path) and not os.path.exists(path + '.gz'):
+                return path
+            i += 1
+
+    def _compress(self, path):
+        try:
+            with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            if self.index:
+                self.index.rename(path, path + '.gz')
+            os.remove(path)
+        except Exception as e:
+            logger.warning(f'Log file {path}: {e}')
+        self._cleanup()
+
+    def _cleanup(self):
+        if not self.keep:
+            return
+        base, ext = os.path.splitext(self.file_path)
+        # Only names made by _segment_path, optionally compressed
+        name = re.compile(re.escape(os.path.basename(base)) + r'-\d{8}-\d{6}(?:-\d+)?' + re.escape(ext) + r'(?:\.gz)?')
+        with self._cleanup_lock:
+            segments = [path for path in glob.glob(glob.escape(base) + '-*' + glob.escape(ext) + '*')
+                        if name.fullmatch(os.path.basename(path))]
+            segments.sort(key=os.path.getmtime)
+            for path in segments[:-self.keep]:
+                try:
+                    os.remove(path)
+                    if self.index:
+                        self.index.remove(path)
+                except OSError:
+                    pass
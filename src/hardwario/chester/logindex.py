@@ -0,0 +1,186 @@
+import os
+import re
+import gzip
+import time
+import sqlite3
+import threading
+from datetime import datetime
+from loguru import logger
+
+# Log line formats of Logger channel, same as highlighted by console LogLexer
+LOG_PATTERN = r'^(\[.*?\].*?<(\w+)\>)(.*)'
+LOG_PATTERN_OLD = r'^(#.*?\d(?:\.\d+)? <(\w)\>)(.*)'
+
+LEVELS = ('dbg', 'inf', 'wrn', 'err')
+LEVEL_ALIASES = {'D': 'dbg', 'I': 'inf', 'W': 'wrn', 'E': 'err'}
+
+HOST_TIME_LEN = 23  # YYYY-mm-dd HH:MM:SS.mmm prefix of console file line
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS segment (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS log (
+    id INTEGER PRIMARY KEY,
+    host_time REAL NOT NULL,
+    device_time REAL,
+    level TEXT,
+    module TEXT,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS log_host_time ON log (host_time);
+CREATE INDEX IF NOT EXISTS log_level ON log (level, host_time);
+CREATE INDEX IF NOT EXISTS log_module ON log (module, host_time);
+CREATE INDEX IF NOT EXISTS log_segment ON log (segment, offset);
+'''
+
+_log_re = re.compile(LOG_PATTERN)
+_log_old_re = re.compile(LOG_PATTERN_OLD)
+_device_time_re = re.compile(r'\[(\d+):(\d+):(\d+)\.(\d+),(\d+)\]')
+_module_re = re.compile(r'^\s*([\w.-]+):')
+
+
+def parse_log_line(line):
+    '''Return (device_time, level, module) of Logger line or None if it is not a log line.'''
+    g = _log_re.match(line) or _log_old_re.match(line)
+    if not g:
+        return None
+    device_time = None
+    t = _device_time_re.match(g.group(1))
+    if t:
+        h, m, s, ms, us = (int(x) for x in t.groups())
+        device_time = h * 3600 + m * 60 + s + ms / 1e3 + us / 1e6
+    level = LEVEL_ALIASES.get(g.group(2), g.group(2).lower())
+    m = _module_re.match(g.group(3))
+    return device_time, level, m.group(1) if m else None
+
+
+class LogIndex:
+    '''SQLite index of Logger lines in console file segments, line text stays in the files.
+
+    Rows reference segment (file path) with byte offset and length of the line, segment
+    paths follow rotation and compression of the console file.
+    '''
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        # WAL lets queries run while console is writing
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._segments = {}
+        self._second = None
+        self._second_time = 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _segment_id(self, path):
+        if path not in self._segments:
+            self._db.execute('INSERT OR IGNORE INTO segment (path) VALUES (?)', (path,))
+            self._segments[path] = self._db.execute('SELECT id FROM segment WHERE path = ?', (path,)).fetchone()[0]
+        return self._segments[path]
+
+    def open_segment(self, path, size):
+        '''Drop rows of file which was replaced (shorter than indexed content).'''
+        with self._lock, self._db:
+            seg = self._segment_id(path)
+            end = self._db.execute('SELECT MAX(offset + length) FROM log WHERE segment = ?', (seg,)).fetchone()[0]
+            if end and end > size:
+                logger.debug(f'Log index: {path} was replaced, dropping its rows')
+                self._db.execute('DELETE FROM log WHERE segment = ?', (seg,))
+
+    def _host_time(self, stamp):
+        second = stamp[:19]
+        if second != self._second:
+            self._second = second
+            self._second_time = time.mktime(datetime.strptime(second, '%Y-%m-%d %H:%M:%S').timetuple())
+        return self._second_time + int(stamp[20:23]) / 1e3
+
+    def add(self, data, path, offset):
+        '''Index Logger lines of data (bytes of console file lines) written to path at offset.'''
+        rows = []
+        with self._lock:
+            seg = self._segment_id(path)
+            for line in data.splitlines(keepends=True):
+                length = len(line)
+                # Logger lines are stored as 'TIMESTAMP # line', old firmware as 'TIMESTAMP #line'
+                if line[HOST_TIME_LEN:HOST_TIME_LEN + 2] == b' #':
+                    text = line.decode('utf-8', errors='replace')
+                    body = text[HOST_TIME_LEN + 3:] if text[HOST_TIME_LEN + 2:HOST_TIME_LEN + 3] == ' ' else text[HOST_TIME_LEN + 1:]
+                    parsed = parse_log_line(body)
+                    if parsed:
+                        try:
+                            rows.append((self._host_time(text), *parsed, seg, offset, length))
+                        except ValueError:
+                            pass
+                offset += length
+            if rows:
+                with self._db:
+                    self._db.executemany('INSERT INTO log (host_time, device_time, level, module, segment, offset, length) '
+                                         'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def rename(self, path, new_path):
+        with self._lock, self._db:
+            self._segments.pop(path, None)
+            self._db.execute('DELETE FROM log WHERE segment IN (SELECT id FROM segment WHERE path = ?)', (new_path,))
+            self._db.execute('DELETE FROM segment WHERE path = ?', (new_path,))
+            self._db.execute('UPDATE segment SET path = ? WHERE path = ?', (new_path, path))
+
+    def remove(self, path):
+        with self._lock, self._db:
+            self._segments.pop(path, None)
+            self._db.execute('DELETE FROM log WHERE segment IN (SELECT id FROM segment WHERE path = ?)', (path,))
+            self._db.execute('DELETE FROM segment WHERE path = ?', (path,))
+
+    def query(self, levels=None, modules=None, since=None, until=None, regex=None, limit=None):
+        '''Yield (host_time, device_time, level, module, line) of matching lines ordered by host time.'''
+        where = []
+        params = []
+        if levels:
+            where.append(f'level IN ({",".join("?" * len(levels))})')
+            params.extend(levels)
+        if modules:
+            where.append(f'module IN ({",".join("?" * len(modules))})')
+            params.extend(modules)
+        if since is not None:
+            where.append('host_time >= ?')
+            params.append(since)
+        if until is not None:
+            where.append('host_time < ?')
+            params.append(until)
+        sql = 'SELECT host_time, device_time, level, module, path, offset, length FROM log JOIN segment ON segment.id = log.segment'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY host_time, log.id'
+        if limit and not regex:
+            sql += f' LIMIT {int(limit)}'
+        pattern = re.compile(regex) if regex else None
+
+        rows = self._db.execute(sql, params)
+        files = {}
+        count = 0
+        try:
+            for host_time, device_time, level, module, path, offset, length in rows:
+                f = files.get(path)
+                if f is None:
+                    if not os.path.exists(path):
+                        continue
+                    f = files[path] = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+                f.seek(offset)
+                line = f.read(length).decode('utf-8', errors='replace').rstrip('\r\n')
+                if pattern and not pattern.search(line):
+                    continue
+                yield host_time, device_time, level, module, line
+                count += 1
+                if limit and count >= limit:
+                    break
+        finally:
+            for f in files.values():
+                f.close()
@@ -0,0 +1,94 @@
+import json
+import time
+from loguru import logger
+from .nrfjprog import NRFJProg
+from .logfile import Timestamp
+from .logindex import parse_log_line
+
+FORMAT_TEXT = 'text'
+FORMAT_JSON = 'json'
+FORMATS = (FORMAT_TEXT, FORMAT_JSON)
+
+CHANNELS = ('Terminal', 'Logger')
+
+# Same line prefix as console file, so text output can be indexed and queried
+CHANNEL_PREFIX = {'Terminal': ' > ', 'Logger': ' # '}
+
+
+def format_lines(channel, lines, fmt, timestamp):
+    '''Return text of received lines (with line ends) in output format.'''
+    if fmt == FORMAT_TEXT:
+        prefix = timestamp() + CHANNEL_PREFIX[channel]
+        return ''.join(prefix + line if line.endswith('\n') else prefix + line + '\n' for line in lines)
+    now = round(time.time(), 3)
+    out = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        record = {'time': now, 'channel': channel, 'line': line}
+        if channel == 'Logger':
+            parsed = parse_log_line(line)
+            if parsed:
+                record['device_time'], record['level'], record['module'] = parsed
+        out.append(json.dumps(record) + '\n')
+    return ''.join(out)
+
+
+def stream_log(prog: NRFJProg, write, channels=None, fmt=FORMAT_TEXT, coredump=None, duration=None,
+               on_coredump=lambda coredump: None):
+    '''Read RTT channels (all available if None) and pass formatted complete lines to write until duration elapses.
+
+    Old firmware without Logger channel sends log lines starting with # to Terminal,
+    these are reported as Logger lines. Coredump is read from Logger lines only, dump
+    still in progress when streaming ends is reported as failed.
+    '''
+    available = prog.rtt_start()
+    if 'Terminal' not in available:
+        raise Exception('Not found RTT Terminal channel')
+    for channel in channels or ():
+        if channel not in available:
+            raise Exception(f'Not found RTT {channel} channel')
+    old = 'Logger' not in available
+    readers = [(ch, prog.rtt_reader(ch)) for ch in channels or CHANNELS if ch in available]
+    poller = prog.rtt_poller()
+    timestamp = Timestamp()
+    end = time.monotonic() + duration if duration else None
+
+    def feed_coredump(lines):
+        for line in lines:
+            coredump.feed_line(line)
+            if coredump.has_end or coredump.has_error:
+                logger.debug(f'Coredump {coredump.output_path} {coredump.size} B')
+                on_coredump(coredump)
+                coredump.reset()
+
+    try:
+        _stream(readers, old, write, fmt, timestamp, poller, end, feed_coredump if coredump else None)
+    finally:
+        if coredump and coredump.abort():
+            on_coredump(coredump)
+            coredump.reset()
+
+
+def _stream(readers, old, write, fmt, timestamp, poller, end, feed_coredump):
+    while end is None or time.monotonic() < end:
+        received = False
+        for channel, reader in readers:
+            if not reader.fill():
+                continue
+            received = True
+            lines = reader.buffered_lines(keepends=True)
+            if not lines:
+                continue
+            if old and channel == 'Terminal':
+                log = [line for line in lines if line.startswith('#')]
+                lines = [line for line in lines if not line.startswith('#')]
+                if log:
+                    write(format_lines('Logger', log, fmt, timestamp))
+                    if feed_coredump:
+                        feed_coredump(log)
+                if not lines:
+                    continue
+            write(format_lines(channel, lines, fmt, timestamp))
+            if feed_coredump and channel == 'Logger':
+                feed_coredump(lines)
+        poller.wait(received)
@@ -0,0 +1,147 @@
+import os
+import re
+import json
+import shutil
+import zipfile
+import tempfile
+from os.path import join
+from loguru import logger
+from .utils import DEFAULT_CACHE_PATH
+from .sync import file_sha256
+from .app import App
+
+MODEM_CACHE_PATH = join(DEFAULT_CACHE_PATH, 'lte')
+
+PACKAGE_PARTS = ('modem.zip', 'application.hex')
+
+MODEM_AT_COMMAND = 'at'  # shell command passing AT command to the modem
+MODEM_VERSION_COMMAND = 'AT+CGMR'
+MODEM_UUID_COMMAND = 'AT%XMODEMUUID'
+
+MODEM_RTT_TIMEOUT = 3  # seconds for booted LTE firmware to set up RTT
+
+MODEM_VERSION_RE = re.compile(r'mfw_nrf91\w\w_\d+\.\d+\.\d+(?:-[\w-]+)?', re.IGNORECASE)
+UUID_RE = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', re.IGNORECASE)
+
+
+class ModemException(Exception):
+    pass
+
+
+def modem_info(modem_zip):
+    '''Return {'version', 'uuid'} of modem firmware zip, parsed from file names and digest file, None if not found.'''
+    version = None
+    uuid = None
+    with zipfile.ZipFile(modem_zip) as zf:
+        texts = [os.path.basename(modem_zip)] + zf.namelist()
+        for name in zf.namelist():
+            if name.endswith('.txt'):
+                texts.append(zf.read(name).decode('utf-8', errors='replace'))
+    for text in texts:
+        if version is None:
+            m = MODEM_VERSION_RE.search(text)
+            if m:
+                version = m.group(0)
+        if uuid is None:
+            m = UUID_RE.search(text)
+            if m:
+                uuid = m.group(0).lower()
+    return {'version': version, 'uuid': uuid}
+
+
+def is_package(file_path):
+    '''Check whether file is LTE package zip (modem firmware zip with application hex).'''
+    if not file_path.endswith('.zip'):
+        return False
+    with zipfile.ZipFile(file_path) as zf:
+        return len(zf.namelist()) == len(PACKAGE_PARTS)
+
+
+def extract_package(file_path, cache_path=MODEM_CACHE_PATH):
+    '''Extract modem.zip and application.hex of LTE package into cache directory named by its SHA-256.
+
+    Returns dict with 'modem.zip', 'application.hex' paths and 'info' of the modem firmware.
+    '''
+    digest = file_sha256(file_path)
+    out_path = join(cache_path, digest)
+    info_path = join(out_path, 'info.json')
+
+    if not os.path.exists(info_path):
+        with zipfile.ZipFile(file_path) as zf:
+            namelist = zf.namelist()
+            if sorted(namelist) != sorted(PACKAGE_PARTS):
+                raise ModemException('Invalid file.')
+            os.makedirs(cache_path, exist_ok=True)
+            tmp_path = tempfile.mkdtemp(dir=cache_path, prefix='.tmp-')
+            try:
+                zf.extractall(tmp_path)
+                with open(join(tmp_path, 'info.json'), 'w') as f:
+                    json.dump(modem_info(join(tmp_path, 'modem.zip')), f)
+                try:
+                    os.rename(tmp_path, out_path)
+                except OSError:
+                    if not os.path.exists(info_path):  # Not extracted by another process meanwhile
+                        raise
+            finally:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        logger.debug(f'Extracted {file_path} to {out_path}')
+    else:
+        logger.debug(f'Using cached {out_path}')
+
+    result = {name: join(out_path, name) for name in PACKAGE_PARTS}
+    with open(info_path, 'r') as f:
+        result['info'] = json.load(f)
+    return result
+
+
+def read_modem_info(app):
+    '''Query running LTE firmware shell for modem firmware version and UUID, None if unknown.'''
+    version = None
+    uuid = None
+    try:
+        for line in app.shell(f'{MODEM_AT_COMMAND} {MODEM_VERSION_COMMAND}'):
+            m = MODEM_VERSION_RE.search(line)
+            if m:
+                version = m.group(0)
+        for line in app.shell(f'{MODEM_AT_COMMAND} {MODEM_UUID_COMMAND}'):
+            m = UUID_RE.search(line)
+            if m:
+                uuid = m.group(0).lower()
+    except Exception as e:
+        logger.debug(f'Modem firmware query failed: {e}')
+    return {'version': version, 'uuid': uuid}
+
+
+def modem_matches(package, device):
+    '''Compare modem info of package and device, by UUID if both known, otherwise by version.'''
+    if package.get('uuid') and device.get('uuid'):
+        return package['uuid'] == device['uuid']
+    if package.get('version') and device.get('version'):
+        return package['version'].lower() == device['version'].lower()
+    return False
+
+
+def modem_up_to_date(prog, info):
+    '''Boot installed LTE firmware and check whether it runs modem firmware of package info.
+
+    Erased device has no firmware to ask, so it is not checked. The connection is reopened
+    afterwards, programming must not run with the RTT session of the query started.
+    '''
+    if not info.get('version') and not info.get('uuid'):
+        return False
+    if not prog.has_firmware():
+        logger.debug('Application flash is blank, modem firmware is not checked')
+        return False
+    app = App(prog, require_logger=False, rtt_timeout=MODEM_RTT_TIMEOUT)
+    try:
+        app.reset()
+        device = read_modem_info(app)
+    except Exception as e:
+        logger.debug(f'Modem firmware query failed: {e}')
+        return False
+    finally:
+        prog.rtt_stop()
+        prog.close()
+        prog.open()
+    logger.debug(f'Modem firmware package {info}, device {device}')
+    return modem_matches(info, device)
@@ -0,0 +1,65 @@
+import os
+import time
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from loguru import logger
+from .nrfjprog import create_prog, BACKEND_JLINK, DEFAULT_JLINK_SPEED_KHZ, VERIFY_FULL
+from .modem import modem_up_to_date
+
+
+def _flash_probe(mcu, backend, sim_script, jlink_sn, jlink_speed, files, halt, diff, verify, modem, progress_queue):
+    '''Worker process, every probe uses its own pynrfjprog DLL instance.
+
+    With modem info of package, modem firmware (.zip) is skipped if the device already runs it.
+    '''
+    logger.remove()
+    start = time.time()
+
+    def progress(text):
+        if text:
+            progress_queue.put((jlink_sn, text))
+
+    try:
+        prog = create_prog(mcu, backend, sim_script, jlink_sn=jlink_sn, jlink_speed=jlink_speed)
+        with prog:
+            for file_path in files:
+                if modem and file_path.endswith('.zip') and modem_up_to_date(prog, modem):
+                    progress(f'Flash: {os.path.basename(file_path)} (up to date, skipped)')
+                    continue
+                progress(f'Flash: {os.path.basename(file_path)}')
+                prog.program(file_path, halt, progress=progress, diff=diff, verify=verify)
+        return jlink_sn, None, time.time() - start
+    except Exception as e:
+        return jlink_sn, str(e) or e.__class__.__name__, time.time() - start
+
+
+def flash_probes(mcu, serial_numbers, files, halt=False, jlink_speed=DEFAULT_JLINK_SPEED_KHZ,
+                 backend=BACKEND_JLINK, sim_script=None, progress=lambda serial_number, text: None, diff=False, verify=VERIFY_FULL, modem=None):
+    '''Program files to all probes concurrently, one process per probe.
+
+    Returns list of (serial number, error or None, elapsed seconds) in order of serial_numbers.
+    '''
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Manager() as manager, ProcessPoolExecutor(len(serial_numbers), mp_context=ctx) as pool:
+        progress_queue = manager.Queue()
+        futures = [pool.submit(_flash_probe, mcu, backend, sim_script, sn, jlink_speed, files, halt, diff, verify, modem, progress_queue)
+                   for sn in serial_numbers]
+        while True:
+            done = all(f.done() for f in futures)
+            try:
+                while True:
+                    progress(*progress_queue.get(timeout=0.1))
+            except queue.Empty:
+                pass
+            if done:
+                break
+        return [f.result() for f in futures]
+
+
+def format_summary(results):
+    '''Return lines of summary table of flash_probes results.'''
+    lines = [f'{"Probe":<12} {"Result":<6} {"Time":>8}  Error']
+    for serial_number, error, elapsed in results:
+        lines.append(f'{serial_number:<12} {"FAIL" if error else "OK":<6} {elapsed:>6.1f} s  {error or ""}'.rstrip())
+    return lines
@@ -1,14 +1,29 @@
 import time
+import random
+import threading
+from collections import deque
 from loguru import logger
 from pynrfjprog import HighLevel, APIError, LowLevel
 from pynrfjprog.Parameters import *
 from .pib import PIB
+from .utils import read_hex
 
 _api = None
 
 
 DEFAULT_JLINK_SPEED_KHZ = LowLevel.API._DEFAULT_JLINK_SPEED_KHZ
 
+BACKEND_JLINK = 'jlink'
+BACKEND_SIM = 'sim'
+
+VERIFY_FULL = 'full'        # read back everything written
+VERIFY_HASH = 'hash'        # hash of written ranges computed on target
+VERIFY_SAMPLED = 'sampled'  # read back first, last and random sample of pages
+VERIFY_NONE = 'none'
+VERIFY_MODES = (VERIFY_FULL, VERIFY_HASH, VERIFY_SAMPLED, VERIFY_NONE)
+VERIFY_SAMPLE_RATIO = 8     # every n-th page on average
+ERASE_ALL_MIN_PAGES = 4     # pages over which whole code flash is chip erased at once (takes about as long as few pages)
+
 
 class NRFJProgException(Exception):
     pass
@@ -18,6 +33,219 @@ class NRFJProgRTTNoChannels(NRFJProgException):
     pass
 
 
+DEFAULT_RTT_LATENCY_MS = 50
+DEFAULT_RTT_START_TIMEOUT = 10  # seconds to wait for firmware to set up RTT control block
+
+
+class RTTPoller:
+    '''Adaptive RTT polling delay, polls immediately while data is flowing and
+    backs off exponentially from min_delay up to max_delay when idle.'''
+
+    def __init__(self, max_delay=DEFAULT_RTT_LATENCY_MS / 1000, min_delay=0.001, factor=2):
+        self.max_delay = max_delay
+        self.min_delay = min(min_delay, max_delay)
+        self.factor = factor
+        self.delay = 0
+
+    def reset(self):
+        self.delay = 0
+
+    def update(self, has_data):
+        if has_data:
+            self.delay = 0
+        elif self.delay == 0:
+            self.delay = self.min_delay
+        else:
+            self.delay = min(self.delay * self.factor, self.max_delay)
+        return self.delay
+
+    def wait(self, has_data, timeout=None):
+        delay = self.update(has_data)
+        if timeout is not None:
+            delay = min(delay, max(0, timeout - time.time()))
+        if delay:
+            time.sleep(delay)
+
+
+class RTTReader:
+    '''Buffered reader of one RTT up channel with incremental line framing.
+
+    Raw data is appended to bytearray and consumed by moving read offset, the consumed
+    part is dropped once it is larger than the rest, lines are decoded only when returned.
+    '''
+
+    COMPACT_SIZE = 65536
+
+    def __init__(self, prog, channel, encoding='utf-8'):
+        self._prog = prog
+        self.channel = channel
+        self.encoding = encoding
+        self._poller = prog.rtt_poller()
+        self.clear()
+
+    def clear(self):
+        self._buffer = bytearray()
+        self._offset = 0
+        self._scan = 0
+
+    def __len__(self):
+        return len(self._buffer) - self._offset
+
+    def fill(self):
+        '''Read available data from the channel into buffer, returns received bytes.'''
+        data = self._prog.rtt_read(self.channel, encoding=None)
+        if data:
+            self._buffer += data
+        return data
+
+    def _compact(self):
+        if self._offset == len(self._buffer):
+            self.clear()
+        elif self._offset > self.COMPACT_SIZE and self._offset * 2 > len(self._buffer):
+            del self._buffer[:self._offset]
+            self._scan -= self._offset
+            self._offset = 0
+
+    def _decode(self, data):
+        return data.decode(self.encoding, errors='backslashreplace') if self.encoding else bytes(data)
+
+    def _next_line(self, keepends):
+        i = self._buffer.find(b'\n', self._scan)
+        if i < 0:
+            self._scan = len(self._buffer)
+            return None
+        end = i + 1
+        if not keepends:
+            while i > self._offset and self._buffer[i - 1] == 0x0d:
+                i -= 1
+        line = self._decode(self._buffer[self._offset:end if keepends else i])
+        self._offset = self._scan = end
+        self._compact()
+        return line
+
+    def readline(self, timeout=0, keepends=False):
+        '''Return next complete line or None when there is none within timeout (in seconds).'''
+        line = self._next_line(keepends)
+        if line is not None:
+            return line
+        timeout = time.time() + timeout
+        while True:
+            data = self.fill()
+            line = self._next_line(keepends)
+            if line is not None:
+                self._poller.reset()
+                return line
+            if time.time() >= timeout:
+                return None
+            self._poller.wait(data, timeout)
+
+    def readlines(self, keepends=False):
+        '''Read available data and return all complete lines, partial line stays buffered.'''
+        self.fill()
+        return self.buffered_lines(keepends)
+
+    def buffered_lines(self, keepends=False):
+        '''Return all complete lines already in buffer without reading the channel.'''
+        lines = []
+        while True:
+            line = self._next_line(keepends)
+            if line is None:
+                return lines
+            lines.append(line)
+
+    def read(self):
+        '''Read available data and return everything buffered including partial line (bytes).'''
+        self.fill()
+        data = bytes(self._buffer[self._offset:])
+        self.clear()
+        return data
+
+
+class RTTPump:
+    '''Background thread reading all RTT up channels in one cycle, all RTT calls of the session
+    (also writes queued by write) are made by this thread.
+
+    Received chunk is passed to process(channel, data, lines) in the pump thread, items it returns
+    are queued (deque append/popleft needs no lock) for drain in the UI thread. wake() is called
+    only when the queue was empty, so the UI is woken once per batch and never while idle.
+    '''
+
+    def __init__(self, prog, channels, process, wake):
+        self._prog = prog
+        self._readers = [(channel, prog.rtt_reader(channel)) for channel in channels]
+        self._process = process
+        self._wake = wake
+        self._poller = prog.rtt_poller()
+        self._queue = deque()
+        self._writes = deque()
+        self._woken = False
+        self._event = threading.Event()
+        self._running = False
+        self._thread = None
+        self.exception = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True, name='rtt-pump')
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._event.set()
+        if self._thread:
+            self._thread.join()
+
+    def write(self, channel, text):
+        '''Queue text for the down channel, written by the pump thread without waiting for poll delay.'''
+        self._writes.append((channel, text))
+        self._event.set()
+
+    def drain(self):
+        '''Return all queued items, call it from the UI thread when woken.'''
+        self._woken = False
+        queue = self._queue
+        items = []
+        while queue:
+            items.append(queue.popleft())
+        return items
+
+    def _push(self, items):
+        if items:
+            self._queue.extend(items)
+        if not self._woken:
+            self._woken = True
+            self._wake()
+
+    def _run(self):
+        try:
+            while self._running and self._prog.rtt_is_running():
+                while self._writes:
+                    self._prog.rtt_write(*self._writes.popleft())
+                received = False
+                items = []
+                for channel, reader in self._readers:
+                    data = reader.fill()
+                    if data:
+                        received = True
+                        items.extend(self._process(channel, data, reader.buffered_lines(keepends=True)) or ())
+                if items:
+                    self._push(items)
+                # Channels with data (e.g. coredump in progress) are drained without delay
+                delay = self._poller.update(received)
+                if delay:
+                    self._event.wait(delay)
+                    self._event.clear()
+        except NRFJProgRTTNoChannels:
+            pass
+        except NRFJProgException as e:
+            self.exception = e
+            self._push(None)
+        except Exception as e:
+            logger.exception('RTT pump')
+            self.exception = e
+            self._push(None)
+
+
 class NRFJProg(LowLevel.API):
 
     MCU_APP = 'app'
@@ -28,7 +256,7 @@ class NRFJProg(LowLevel.API):
         MCU_LTE: 'nRF91'
     }
 
-    def __init__(self, mcu, jlink_sn=None, jlink_speed=DEFAULT_JLINK_SPEED_KHZ, log=False, log_suffix=None):
+    def __init__(self, mcu, jlink_sn=None, jlink_speed=DEFAULT_JLINK_SPEED_KHZ, log=False, log_suffix=None, rtt_latency=DEFAULT_RTT_LATENCY_MS):
         if mcu not in self._mcu_lut:
             raise NRFJProgException(f'Unknown MCU type: {mcu}')
 
@@ -36,9 +264,11 @@ class NRFJProg(LowLevel.API):
         self.log = log
         self.log_suffix = log_suffix
         self._rtt_channels = None
+        self._rtt_readers = {}
         self._jlink_ip = None
         self.set_serial_number(jlink_sn)
         self.set_speed(jlink_speed)
+        self.set_rtt_latency(rtt_latency)
         self.is_opened = False
 
     def set_serial_number(self, serial_number):
@@ -66,6 +296,16 @@ class NRFJProg(LowLevel.API):
         else:
             raise NRFJProgException(f'Invalid J-Link remote host: {host}')
 
+    def set_rtt_latency(self, latency_ms):
+        '''Maximum RTT polling delay in ms when idle, lower means faster response and more CPU.'''
+        self._rtt_latency = int(latency_ms) if latency_ms is not None else DEFAULT_RTT_LATENCY_MS
+
+    def get_rtt_latency(self):
+        return self._rtt_latency
+
+    def rtt_poller(self):
+        return RTTPoller(self._rtt_latency / 1000)
+
     def get_serial_number(self):
         return self._jlink_sn
 
@@ -114,26 +354,90 @@ class NRFJProg(LowLevel.API):
     def reset(self):
         self.sys_reset()
 
-    def erase_flash(self):
+    def has_firmware(self):
+        '''Check whether code flash starts with vector table, erased device can not run firmware.'''
+        return bytes(self.read(0, 8)) != b'\xff' * 8
+
+    def erase_flash(self, ranges=None, progress=lambda x: None, skip_blank=None):
+        '''Erase pages of code flash covering (start, end) ranges, whole code flash if None (UICR is preserved).
+
+        With skip_blank (default only for ranges) blank pages are detected by reading coalesced runs
+        of pages and skipped. Whole code flash with more than ERASE_ALL_MIN_PAGES pages to erase is
+        erased by single chip erase, see erase_code.
+        '''
+        size, page_size = self.get_code_region()
+        if skip_blank is None:
+            skip_blank = ranges is not None
+        if ranges is None:
+            ranges = [(0, size)]
+        pages = set()
+        for start, end in ranges:
+            if start < 0 or end > size or start >= end:
+                raise NRFJProgException(f'Range 0x{start:08x}-0x{end:08x} is outside code flash.')
+            pages.update(range(start - start % page_size, end, page_size))
+        pages = sorted(pages)
+        whole = len(pages) == size // page_size
+
+        if skip_blank:
+            progress('Checking...')
+            blank = b'\xff' * page_size
+            used = []
+            for start, count in page_runs(pages, page_size):
+                data = bytes(self.read(start, count * page_size))
+                used.extend(start + i * page_size for i in range(count)
+                            if data[i * page_size:(i + 1) * page_size] != blank)
+            logger.debug(f'Erase: {len(used)} of {len(pages)} pages are not blank')
+            pages = used
+
+        if whole and len(pages) > ERASE_ALL_MIN_PAGES:
+            self.erase_code(progress)
+        else:
+            self.erase_pages(pages, page_size, progress)
+
+    def erase_code(self, progress=lambda x: None):
+        '''Erase whole code flash by chip erase, UICR is read before and written back.'''
+        address, size = self.get_uicr_region()
+        uicr = bytes(self.read(address, size))
+        progress('Erasing all pages...')
+        self.erase_all()
+        if uicr != b'\xff' * size:
+            self.write(address, uicr, True)
+
+    def erase_pages(self, addresses, page_size, progress=lambda x: None):
+        '''Erase pages at sorted addresses.'''
+        if not addresses:
+            progress('Erasing skipped (blank)')
+            return
         self.disable_bprot()
+        done = 0
+        for start, count in page_runs(addresses, page_size):
+            progress(f'Erasing {done} of {len(addresses)} pages...')
+            for i in range(count):
+                self.erase_page(start + i * page_size)
+            done += count
+
+    def get_code_region(self):
+        '''Return (size, page_size) of code flash.'''
         for des in self.read_memory_descriptors(False):
             if des.type == MemoryType.CODE:
-                page_size = des.size // des.num_pages
-                for addr in range(0, des.size, page_size):
-                    self.erase_page(addr)
+                return des.size, des.size // des.num_pages
+        raise NRFJProgException('Code descriptor not found.')
+
+    def program(self, file_path, halt=False, progress=lambda x: None, diff=False, verify=VERIFY_FULL):
+        if verify not in VERIFY_MODES:
+            raise NRFJProgException(f'Unknown verify mode: {verify}')
 
-    def program(self, file_path, halt=False, progress=lambda x: None):
         self.reset()
         self.halt()
 
-        progress('Erasing...')
-        self.erase_file(file_path, chip_erase_mode=EraseAction.ERASE_SECTOR)
+        if not (diff and self._program_diff(file_path, progress, verify)):
+            progress('Erasing...')
+            self.erase_file(file_path, chip_erase_mode=EraseAction.ERASE_SECTOR)
 
-        progress('Flashing...')
-        self.program_file(file_path)
+            progress('Flashing...')
+            self.program_file(file_path)
 
-        progress('Verifying...')
-        self.verify_file(file_path)
+            self._verify(file_path, verify, progress)
 
         if halt:
             progress('Resetting (HALT)...')
@@ -146,10 +450,75 @@ class NRFJProg(LowLevel.API):
 
         progress('Successfully completed')
 
+    def _verify(self, file_path, verify, progress, pages=None, page_size=None):
+        '''Verify programmed image, pages (page map) limits sampled and full verification to them.'''
+        if verify == VERIFY_NONE:
+            progress('Verifying skipped (none)')
+            return
+        progress(f'Verifying ({verify})...')
+        if verify == VERIFY_HASH or (pages is None and verify == VERIFY_FULL):
+            self.verify_file(file_path, VerifyAction.VERIFY_HASH if verify == VERIFY_HASH else VerifyAction.VERIFY_READ)
+            return
+
+        if pages is None:
+            if not str(file_path).lower().endswith('.hex'):
+                self.verify_file(file_path, VerifyAction.VERIFY_HASH)  # Sampling needs page map of hex
+                return
+            page_size = self.get_code_region()[1]
+            pages = page_map(read_hex(file_path), page_size)
+
+        addresses = sorted(pages)
+        if verify == VERIFY_SAMPLED and len(addresses) > 2:
+            sample = random.sample(addresses[1:-1], (len(addresses) - 2) // VERIFY_SAMPLE_RATIO)
+            addresses = sorted([addresses[0], addresses[-1]] + sample)
+        logger.debug(f'Verifying {len(addresses)} of {len(pages)} pages')
+
+        for start, count in page_runs(addresses, page_size):
+            data = bytes(self.read(start, count * page_size))
+            if data != b''.join(pages[start + i * page_size] for i in range(count)):
+                raise NRFJProgException(f'Verification failed at 0x{start:08x}')
+
+    def _program_diff(self, file_path, progress, verify=VERIFY_FULL):
+        '''Erase and write only pages which differ from the hex image, returns False
+        if the image can not be programmed this way (not hex or data outside code flash).'''
+        if not str(file_path).lower().endswith('.hex'):
+            return False
+        size, page_size = self.get_code_region()
+        pages = page_map(read_hex(file_path), page_size)
+        if not pages or max(pages) + page_size > size:
+            return False
+
+        progress('Comparing...')
+        changed = []
+        for start, count in page_runs(sorted(pages), page_size):
+            data = bytes(self.read(start, count * page_size))
+            for i in range(count):
+                addr = start + i * page_size
+                if data[i * page_size:(i + 1) * page_size] != pages[addr]:
+                    changed.append(addr)
+        logger.debug(f'Differential flash: {len(changed)} of {len(pages)} pages differ')
+
+        if not changed:
+            progress('Up to date, skipped')
+            return True
+
+        self.erase_pages(changed, page_size, progress)
+
+        progress('Flashing...')
+        for start, count in page_runs(changed, page_size):
+            self.write(start, b''.join(pages[start + i * page_size] for i in range(count)), True)
+
+        self._verify(file_path, verify, progress, {addr: pages[addr] for addr in changed}, page_size)
+        return True
+
     def get_uicr_address(self):
+        return self.get_uicr_region()[0]
+
+    def get_uicr_region(self):
+        '''Return (address, size) of UICR.'''
         for des in self.read_memory_descriptors(False):
             if des.type == MemoryType.UICR:
-                return des.start
+                return des.start, des.size
         raise NRFJProgException('UICR descriptor not found.')
 
     def write_uicr(self, buffer: bytes, halt=False):
@@ -168,20 +537,19 @@ class NRFJProg(LowLevel.API):
     def read_uicr(self):
         return bytes(self.read(self.get_uicr_address() + 0x80, 128))
 
-    def rtt_start(self):
+    def rtt_start(self, timeout=DEFAULT_RTT_START_TIMEOUT):
         if self._rtt_channels is not None:
             return self._rtt_channels
 
         super().rtt_start()
         logger.debug('RTT Start')
 
-        for _ in range(100):
-            if self.rtt_is_control_block_found():
-                logger.debug('RTT control block found')
-                break
+        end = time.time() + timeout
+        while not self.rtt_is_control_block_found():
+            if time.time() >= end:
+                raise NRFJProgException('Failed to find RTT block')
             time.sleep(0.1)
-        else:
-            raise NRFJProgException('Failed to find RTT block')
+        logger.debug('RTT control block found')
 
         channel_count = self.rtt_read_channel_count()
         logger.debug(f'RTT channel count {channel_count}')
@@ -209,6 +577,7 @@ class NRFJProg(LowLevel.API):
             }
 
         self._rtt_channels = channels
+        self._rtt_readers = {}
         return self._rtt_channels
 
     def rtt_stop(self):
@@ -217,17 +586,27 @@ class NRFJProg(LowLevel.API):
 
         # super().rtt_stop() #  WHY: if call rtt_stop then Can not found RTT start block after rtt_start, needs reset for work
         self._rtt_channels = None
+        self._rtt_readers = {}
         logger.debug('RTT Stop')
 
     def rtt_is_running(self):
         return self._rtt_channels is not None
 
+    def rtt_reader(self, channel):
+        '''Return buffered line reader of the up channel, shared for the RTT session.'''
+        if self._rtt_channels is None:
+            raise NRFJProgRTTNoChannels('Can not read, try call rtt_start first')
+        reader = self._rtt_readers.get(channel)
+        if reader is None:
+            reader = self._rtt_readers[channel] = RTTReader(self, channel)
+        return reader
+
     def rtt_write(self, channel, msg, encoding='utf-8'):
         if self._rtt_channels is None:
             raise NRFJProgRTTNoChannels('Can not write, try call rtt_start first')
         if isinstance(channel, str):
             channel = self._rtt_channels[channel]['down']['index']
-        logger.debug('channel: {} msg: {}', channel, repr(msg))
+        logger.debug('channel: {} length: {}', channel, len(msg))
         return super().rtt_write(channel, msg, encoding)
 
     def rtt_read(self, channel, length=None, encoding='utf-8'):
@@ -242,7 +621,7 @@ class NRFJProg(LowLevel.API):
         try:
             msg = super().rtt_read(channel, length, encoding=None)
             if msg:
-                logger.debug('channel: {} msg: {}', channel, repr(msg))
+                logger.debug('channel: {} length: {}', channel, len(msg))
             if encoding:
                 msg = msg.decode(encoding, errors="backslashreplace")
             return msg
@@ -272,9 +651,12 @@ class HighNRFJProg(HighLevel.DebugProbe):
         self.log = log
         self.log_suffix = log_suffix
 
+    def _get_api(self):
+        return get_api()
+
     def open(self):
         jlink_sn = self._jlink_sn
-        api = get_api()
+        api = self._get_api()
         if jlink_sn is None:
             probes = api.get_connected_probes()
             if not probes:
@@ -312,13 +694,17 @@ class HighNRFJProg(HighLevel.DebugProbe):
     def erase_all(self):
         self.erase(EraseAction.ERASE_ALL)
 
-    def erase_flash(self):
-        self.erase(EraseAction.ERASE_SECTOR,
-                   self.info.code_address, (self.info.code_size // 32))
+    def erase_flash(self, ranges=None):
+        '''Erase sectors covering (start, end) ranges, whole code flash if None.'''
+        if ranges is None:
+            ranges = [(self.info.code_address, self.info.code_address + self.info.code_size)]
+        for start, end in ranges:
+            self.erase(EraseAction.ERASE_SECTOR, start, end)
 
-    def program(self, hex_path):
+    def program(self, hex_path, verify=VERIFY_FULL):
+        # Sampled verification needs page access of NRFJProg, on-target hash is the closest
         program_options = ProgramOptions(
-            verify=VerifyAction.VERIFY_READ,
+            verify={VERIFY_FULL: VerifyAction.VERIFY_READ, VERIFY_NONE: VerifyAction.VERIFY_NONE}.get(verify, VerifyAction.VERIFY_HASH),
             erase_action=EraseAction.ERASE_SECTOR,
             qspi_erase_action=EraseAction.ERASE_NONE,
             reset=ResetAction.RESET_SYSTEM
@@ -333,6 +719,77 @@ class HighNRFJProg(HighLevel.DebugProbe):
         return self.read(self.info.uicr_address + 0x80, 128)
 
 
+def page_map(segments, page_size):
+    '''Map page address to expected page content (erased 0xff with image data) of (address, data) segments.'''
+    pages = {}
+    for addr, data in segments:
+        pos = addr
+        end = addr + len(data)
+        while pos < end:
+            page = pos - pos % page_size
+            n = min(end, page + page_size) - pos
+            if page not in pages:
+                pages[page] = bytearray(b'\xff' * page_size)
+            pages[page][pos - page:pos - page + n] = data[pos - addr:pos - addr + n]
+            pos += n
+    return pages
+
+
+def page_runs(addresses, page_size, max_pages=64):
+    '''Coalesce sorted page addresses to (start, count) runs of consecutive pages.'''
+    start = None
+    count = 0
+    for addr in addresses:
+        if start is not None and addr == start + count * page_size and count < max_pages:
+            count += 1
+            continue
+        if start is not None:
+            yield start, count
+        start, count = addr, 1
+    if start is not None:
+        yield start, count
+
+
+def image_ranges(file_path):
+    '''Return sorted (start, end) address ranges of hex file data, adjacent segments are merged.'''
+    ranges = []
+    for addr, data in sorted(read_hex(file_path)):
+        end = addr + len(data)
+        if ranges and addr <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+        else:
+            ranges.append((addr, end))
+    return ranges
+
+
+def parse_range(text):
+    '''Parse START-END or START+SIZE (hex or decimal with 0x prefix) into (start, end).'''
+    try:
+        if '+' in text:
+            start, size = text.split('+', 1)
+            return int(start, 0), int(start, 0) + int(size, 0)
+        start, end = text.split('-', 1)
+        return int(start, 0), int(end, 0)
+    except ValueError:
+        raise NRFJProgException(f'Invalid range: {text} (expected START-END or START+SIZE)')
+
+
+def create_prog(mcu, backend=BACKEND_JLINK, sim_script=None, **kwargs):
+    if backend == BACKEND_SIM:
+        from .sim import SimNRFJProg
+        return SimNRFJProg(mcu, script=sim_script, **kwargs)
+    return NRFJProg(mcu, **kwargs)
+
+
+def get_probes(backend=BACKEND_JLINK, sim_script=None):
+    '''Return serial numbers of connected J-Link probes.'''
+    if backend == BACKEND_SIM:
+        from .sim import load_script
+        return list(load_script(sim_script)['probes'])
+    with LowLevel.API(LowLevel.DeviceFamily.UNKNOWN) as api:
+        return api.enum_emu_snr() or []
+
+
 def get_api():
     global _api
     if _api is None:
@@ -0,0 +1,319 @@
+import re
+from collections import deque
+from prompt_toolkit.document import Document
+from .logindex import LEVELS, parse_log_line
+
+DEFAULT_SCROLLBACK = '10000'
+MAX_LINE_LENGTH = 65536   # characters of unterminated line kept, its start is dropped
+
+
+class ScrollbackException(Exception):
+    pass
+
+
+def parse_scrollback(value):
+    '''Parse scrollback limit, number of lines or size with K/M suffix, returns (max_lines, max_bytes).'''
+    m = re.match(r'^\s*(\d+)\s*([kKmM]?)[bB]?\s*$', str(value))
+    if not m:
+        raise ScrollbackException(f'Invalid scrollback limit: {value}')
+    n = int(m.group(1))
+    if not n:
+        raise ScrollbackException('Scrollback limit must be greater than zero')
+    unit = m.group(2).upper()
+    if unit == 'K':
+        return None, n * 1024
+    if unit == 'M':
+        return None, n * 1024 * 1024
+    if str(value).strip()[-1] in 'bB':
+        return None, n
+    return n, None
+
+
+class _Lines:
+    '''Complete lines stored as deque of text chunks with deque of line lengths.
+
+    Appending and removing the oldest lines do not touch the rest of the text,
+    chunks are joined (and replaced by the result) only when the text is read.
+    '''
+
+    def __init__(self):
+        self.size = 0
+        self._chunks = deque()
+        self._lengths = deque()
+        self._offset = 0    # removed characters of the first chunk
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def append(self, text, lengths):
+        if text:
+            self._chunks.append(text)
+            self._lengths.extend(lengths)
+            self.size += len(text)
+
+    def popleft(self):
+        '''Remove the oldest line, returns its length.'''
+        length = self._lengths.popleft()
+        self.size -= length
+        self._offset += length
+        chunks = self._chunks
+        while chunks and self._offset >= len(chunks[0]):
+            self._offset -= len(chunks.popleft())
+        return length
+
+    def text(self):
+        chunks = self._chunks
+        if not chunks:
+            return ''
+        if len(chunks) > 1 or self._offset:
+            first = chunks.popleft()[self._offset:]
+            chunks.appendleft(first)
+            text = ''.join(chunks)
+            chunks.clear()
+            chunks.append(text)
+            self._offset = 0
+        return chunks[0]
+
+    def clear(self):
+        self.size = 0
+        self._chunks.clear()
+        self._lengths.clear()
+        self._offset = 0
+
+
+class Scrollback:
+    '''Bounded line store behind read-only buffer of the console pane.
+
+    Appends only queue the new text, update and eviction of the oldest lines over
+    the limit depend on the size of new text only. The whole text is joined once
+    when the buffer document is rebuilt (at most once per render, see refresh).
+    Unterminated line is truncated from its start over the byte limit (or MAX_LINE_LENGTH).
+    '''
+
+    def __init__(self, buffer, max_lines=None, max_bytes=None):
+        self.buffer = buffer
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.evicted = 0
+        self._lines = _Lines()
+        self._partial = ''
+        self._pending = []
+        self._evicted_chars = 0
+
+    @property
+    def text(self):
+        return self._lines.text() + self._partial
+
+    def append(self, text):
+        if text:
+            self._pending.append(text)
+
+    def clear(self):
+        self._pending = []
+        self.evicted += len(self._lines)
+        self._lines.clear()
+        self._partial = ''
+        self.buffer.set_document(Document(''), True)
+
+    def _update(self):
+        '''Apply queued text, returns (new complete lines without line end, number of evicted lines).'''
+        text = self._partial + ''.join(self._pending)
+        self._pending = []
+        end = text.rfind('\n') + 1
+        self._partial = text[end:]
+        added = text[:end - 1].split('\n') if end else []
+        lines = self._lines
+        lines.append(text[:end], [len(line) + 1 for line in added])
+
+        cut = 0
+        evicted = 0
+        while len(lines) and self._over_limit(len(lines), lines.size + len(self._partial)):
+            cut += lines.popleft()
+            evicted += 1
+        self.evicted += evicted
+
+        limit = min(self.max_bytes or MAX_LINE_LENGTH, MAX_LINE_LENGTH)
+        if len(self._partial) > limit:
+            cut += len(self._partial) - limit
+            self._partial = self._partial[-limit:]
+
+        self._evicted_chars += cut
+        return added, evicted
+
+    def _over_limit(self, lines, size):
+        if self.max_lines and lines > self.max_lines:
+            return True
+        return bool(self.max_bytes and size > self.max_bytes)
+
+    def refresh(self, scroll_to_end=True):
+        '''Apply queued text to buffer, call it right before render.'''
+        if not self._pending:
+            return False
+        self._update()
+        self._set_document(self.text, self._evicted_chars, scroll_to_end)
+        self._evicted_chars = 0
+        return True
+
+    def _set_document(self, text, evicted_chars, scroll_to_end):
+        if scroll_to_end:
+            cursor = len(text)
+        else:
+            cursor = max(0, min(self.buffer.cursor_position - evicted_chars, len(text)))
+        self.buffer.set_document(Document(text, cursor), True)
+
+
+class LogScrollback(Scrollback):
+    '''Scrollback of Device Log with live filter by level, module and regex.
+
+    Level and module of each complete line are parsed once when the line arrives
+    and kept in an index aligned with the scrollback, so filter change is a single
+    pass over the index (regex is only tried on lines passing level and module).
+    Matching lines are kept in own line store, extended with new lines and evicted
+    together with the scrollback. Unterminated last line is shown in the filtered view
+    while it matches the filter with the text received so far.
+    '''
+
+    def __init__(self, buffer, max_lines=None, max_bytes=None):
+        super().__init__(buffer, max_lines, max_bytes)
+        self.level = None
+        self.modules = None
+        self.regex = None
+        self._index = deque()       # (level rank or -1, module) of line
+        self._matched = deque()     # line is in filtered view
+        self._shown = _Lines()      # lines of filtered view
+        self._shown_evicted_chars = 0
+        self._changed = False
+
+    @property
+    def filtering(self):
+        return self.level is not None or bool(self.modules) or self.regex is not None
+
+    @property
+    def shown(self):
+        return len(self._shown) if self.filtering else len(self._lines)
+
+    @property
+    def hidden(self):
+        return len(self._lines) - len(self._shown) if self.filtering else 0
+
+    @property
+    def filtered_text(self):
+        partial = self._partial
+        if partial and not self._filter([partial], [self._index_line(partial)])[0]:
+            partial = ''
+        return self._shown.text() + partial
+
+    def filter_text(self):
+        '''Return short description of active filter.'''
+        parts = []
+        if self.level is not None:
+            parts.append(f'{LEVELS[self.level]}+')
+        if self.modules:
+            parts.append(','.join(sorted(self.modules)))
+        if self.regex is not None:
+            parts.append(f'/{self.regex.pattern}/')
+        return ' '.join(parts)
+
+    def set_filter(self, level=..., modules=..., regex=...):
+        '''Change filter, arguments left out keep their value, None disables the part.
+
+        level is the lowest shown level name, modules is iterable of module names
+        and regex is searched in the line.
+        '''
+        if level is not ...:
+            if level is not None and level not in LEVELS:
+                raise ScrollbackException(f'Invalid level: {level} (use {", ".join(LEVELS)})')
+            self.level = LEVELS.index(level) if level is not None else None
+        if modules is not ...:
+            self.modules = frozenset(modules) if modules else None
+        if regex is not ...:
+            try:
+                self.regex = re.compile(regex) if regex else None
+            except re.error as e:
+                raise ScrollbackException(f'Invalid regex: {e}')
+        self._apply_filter()
+
+    def cycle_level(self):
+        '''Raise lowest shown level, after the highest one the level filter is disabled.'''
+        if self.level is None:
+            self.set_filter(level=LEVELS[1])
+        elif self.level + 1 < len(LEVELS):
+            self.set_filter(level=LEVELS[self.level + 1])
+        else:
+            self.set_filter(level=None)
+
+    def _filter(self, lines, index):
+        '''Return list of matching lines and deque of match flags.'''
+        lowest = -1 if self.level is None else self.level
+        modules = self.modules
+        search = self.regex.search if self.regex is not None else None
+        shown = []
+        matched = deque()
+        for line, (level, module) in zip(lines, index):
+            m = level >= lowest and (not modules or module in modules) and (search is None or search(line) is not None)
+            matched.append(m)
+            if m:
+                shown.append(line)
+        return shown, matched
+
+    def _show(self, lines):
+        if lines:
+            self._shown.append('\n'.join(lines) + '\n', [len(line) + 1 for line in lines])
+
+    def _apply_filter(self):
+        self._shown.clear()
+        if self.filtering:
+            text = self._lines.text()
+            shown, self._matched = self._filter(text[:-1].split('\n') if text else [], self._index)
+            self._show(shown)
+        else:
+            self._matched = deque([True] * len(self._lines))
+        self._changed = True
+
+    def clear(self):
+        super().clear()
+        self._index.clear()
+        self._matched.clear()
+        self._shown.clear()
+        self._shown_evicted_chars = 0
+
+    @staticmethod
+    def _index_line(line):
+        '''Return (level rank or -1, module) of line.'''
+        parsed = parse_log_line(line)
+        if parsed:
+            return LEVELS.index(parsed[1]) if parsed[1] in LEVELS else -1, parsed[2]
+        return -1, None
+
+    def _update(self):
+        added, evicted = super()._update()
+
+        index = [self._index_line(line) for line in added]
+        self._index.extend(index)
+        if self.filtering:
+            shown, matched = self._filter(added, index)
+            self._matched.extend(matched)
+            self._show(shown)
+        else:
+            self._matched.extend([True] * len(added))
+
+        for _ in range(evicted):
+            self._index.popleft()
+            if self._matched.popleft() and self.filtering:
+                self._shown_evicted_chars += self._shown.popleft()
+        return added, evicted
+
+    def refresh(self, scroll_to_end=True):
+        if not self._changed and (not self.filtering or not self._pending):
+            return super().refresh(scroll_to_end)
+        if self._pending:
+            self._update()
+        if self.filtering:
+            text, cut = self.filtered_text, self._shown_evicted_chars
+        else:
+            text, cut = self.text, self._evicted_chars
+        self._set_document(text, cut, scroll_to_end or self._changed)
+        self._evicted_chars = 0
+        self._shown_evicted_chars = 0
+        self._changed = False
+        return True
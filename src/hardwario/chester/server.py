@@ -0,0 +1,298 @@
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import socket
+import threading
+import http.client
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from loguru import logger
+from .nrfjprog import NRFJProgException, create_prog, get_probes, parse_range, BACKEND_JLINK, DEFAULT_JLINK_SPEED_KHZ, VERIFY_FULL
+from .pib import PIB, PIBException
+from .app import App
+
+DEFAULT_SERVE_ADDRESS = '127.0.0.1:8470'
+
+JOB_OPS = ('flash', 'erase', 'reset', 'pib_read', 'pib_write', 'uicr_read', 'uicr_write', 'shell')
+
+
+class ServerException(Exception):
+    pass
+
+
+def parse_address(address):
+    '''Return ('unix', path) or ('tcp', (host, port)) from unix:PATH, PATH with / or HOST:PORT.'''
+    if address.startswith('unix:'):
+        return 'unix', address[5:]
+    if '/' in address:
+        return 'unix', address
+    host, sep, port = address.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ServerException(f'Invalid address: {address}')
+    return 'tcp', (host or '127.0.0.1', int(port))
+
+
+class ProbeSession:
+    '''Open NRFJProg kept across jobs with own queue and worker thread, jobs of the probe run in order.
+
+    Probe is connected to one MCU at a time, job for the other MCU reconnects it.
+    '''
+
+    def __init__(self, jlink_sn, jlink_speed, backend, sim_script):
+        self.jlink_sn = jlink_sn
+        self.jlink_speed = jlink_speed
+        self.backend = backend
+        self.sim_script = sim_script
+        self.mcu = None
+        self.prog = None
+        self.queue = queue.Queue()
+        self.jobs = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.thread = threading.Thread(target=self._run, daemon=True, name=f'probe-{jlink_sn}')
+        self.thread.start()
+
+    def submit(self, job):
+        '''Queue job and wait for its result.'''
+        done = threading.Event()
+        item = {'job': job, 'done': done, 'queued': time.time()}
+        self.queue.put(item)
+        done.wait()
+        return item['result']
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def status(self):
+        return {
+            'mcu': self.mcu,
+            'jlink_sn': self.jlink_sn,
+            'opened': self.prog is not None and self.prog.is_opened,
+            'queued': self.queue.qsize(),
+            'jobs': self.jobs,
+            'failed': self.failed,
+            'busy': round(self.busy, 3),
+        }
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            start = time.time()
+            result = {'op': item['job'].get('op'), 'queued': round(start - item['queued'], 3)}
+            try:
+                self._connect(item['job'].get('mcu', 'app'))
+                if not self.prog.is_opened:
+                    self.prog.open()
+                result['result'] = self._execute(item['job'])
+                result['ok'] = True
+            except Exception as e:
+                result['ok'] = False
+                result['error'] = str(e) or e.__class__.__name__
+                self.failed += 1
+                if isinstance(e, NRFJProgException) and self.prog.is_opened:
+                    self.prog.close()  # Reconnect on next job
+            elapsed = time.time() - start
+            result['elapsed'] = round(elapsed, 3)
+            self.jobs += 1
+            self.busy += elapsed
+            item['result'] = result
+            item['done'].set()
+        if self.prog is not None and self.prog.is_opened:
+            self.prog.close()
+
+    def _connect(self, mcu):
+        if mcu == self.mcu:
+            return
+        if self.prog is not None and self.prog.is_opened:
+            self.prog.close()
+        logger.info(f'Session {self.jlink_sn} connect {mcu}')
+        self.prog = create_prog(mcu, self.backend, self.sim_script, jlink_sn=self.jlink_sn, jlink_speed=self.jlink_speed)
+        self.mcu = mcu
+
+    def _execute(self, job):
+        op = job.get('op')
+        prog = self.prog
+        if op == 'flash':
+            if not os.path.isabs(job['file']):
+                raise ServerException(f'File path must be absolute: {job["file"]}')
+            prog.rtt_stop()
+            verify = job.get('verify', VERIFY_FULL)
+            prog.program(job['file'], job.get('halt', False), diff=job.get('diff', False), verify=verify)
+            return {'verify': verify}
+        elif op == 'erase':
+            prog.rtt_stop()
+            if job.get('all'):
+                prog.erase_all()
+            else:
+                ranges = [parse_range(r) for r in job.get('ranges', [])]
+                prog.erase_flash(ranges or None)
+        elif op == 'reset':
+            prog.rtt_stop()
+            prog.reset()
+            if job.get('halt'):
+                prog.halt()
+            else:
+                prog.go()
+        elif op == 'pib_read':
+            return PIB(prog.read_uicr()).get_dict()
+        elif op == 'pib_write':
+            try:
+                pib = PIB(prog.read_uicr())  # Update only given fields
+            except PIBException:
+                pib = PIB()
+            for key, value in job.get('fields', {}).items():
+                setter = getattr(pib, f'set_{key}', None)
+                if setter is None:
+                    raise ServerException(f'Unknown PIB field: {key}')
+                setter(value)
+            prog.write_uicr(pib.get_buffer(), halt=job.get('halt', False))
+        elif op == 'uicr_read':
+            return prog.read_uicr().hex()
+        elif op == 'uicr_write':
+            prog.write_uicr(bytes.fromhex(job['data']), halt=job.get('halt', False))
+        elif op == 'shell':
+            return App(prog).shell(job['command'], job.get('timeout', 1))
+        else:
+            raise ServerException(f'Unknown job: {op}')
+
+
+class Server:
+    '''Jobs dispatcher, probe sessions are created on first use and stay open.'''
+
+    def __init__(self, backend=BACKEND_JLINK, sim_script=None, jlink_speed=DEFAULT_JLINK_SPEED_KHZ):
+        self.backend = backend
+        self.sim_script = sim_script
+        self.jlink_speed = jlink_speed
+        self.sessions = {}
+        self.default_jlink_sn = None
+        self.lock = threading.Lock()
+
+    def session(self, jlink_sn):
+        with self.lock:
+            if jlink_sn is None:
+                # Resolved once, listing probes opens own API instance next to the open sessions
+                if self.default_jlink_sn is None:
+                    probes = get_probes(self.backend, self.sim_script)
+                    if not probes:
+                        raise ServerException('No J-Link found (check USB cable)')
+                    self.default_jlink_sn = probes[0]
+                jlink_sn = self.default_jlink_sn
+            jlink_sn = int(jlink_sn)
+            if jlink_sn not in self.sessions:
+                logger.info(f'Open session {jlink_sn}')
+                self.sessions[jlink_sn] = ProbeSession(jlink_sn, self.jlink_speed, self.backend, self.sim_script)
+            return self.sessions[jlink_sn]
+
+    def submit(self, job):
+        if job.get('op') not in JOB_OPS:
+            raise ServerException(f'Unknown job: {job.get("op")}')
+        mcu = job.get('mcu', 'app')
+        session = self.session(job.get('jlink_sn'))
+        result = session.submit(job)
+        result['jlink_sn'] = session.jlink_sn
+        logger.info(f'Job {result["op"]} {mcu} {session.jlink_sn}: {"ok" if result["ok"] else result["error"]}, queued {result["queued"]} s, elapsed {result["elapsed"]} s')
+        return result
+
+    def status(self):
+        with self.lock:
+            return [s.status() for s in self.sessions.values()]
+
+    def close(self):
+        with self.lock:
+            for s in self.sessions.values():
+                s.close()
+            self.sessions.clear()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    '''POST /jobs with JSON job, GET /status.'''
+
+    def _send(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self._send(200, {'sessions': self.server.chester.status()})
+        else:
+            self._send(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            self._send(404, {'error': 'Not found'})
+            return
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            self._send(200, self.server.chester.submit(job))
+        except (ValueError, KeyError, ServerException) as e:
+            self._send(400, {'ok': False, 'error': str(e)})
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('unix', 0)
+
+
+def serve(address, server):
+    '''Serve jobs on address until interrupted.'''
+    kind, addr = parse_address(address)
+    if kind == 'unix':
+        if os.path.exists(addr):
+            os.remove(addr)
+        httpd = UnixHTTPServer(addr, RequestHandler)
+    else:
+        httpd = ThreadingHTTPServer(addr, RequestHandler)
+    httpd.chester = server
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    logger.info(f'Listening on {address}')
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        server.close()
+        if kind == 'unix' and os.path.exists(addr):
+            os.remove(addr)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self._path)
+
+
+def request(address, method, path, body=None, timeout=None):
+    '''Send request to running server and return decoded JSON response.'''
+    kind, addr = parse_address(address)
+    if kind == 'unix':
+        conn = UnixHTTPConnection(addr, timeout=timeout)
+    else:
+        conn = http.client.HTTPConnection(*addr, timeout=timeout)
+    try:
+        conn.request(method, path, json.dumps(body) if body is not None else None,
+                     {'Content-Type': 'application/json'})
+        return json.loads(conn.getresponse().read())
+    except OSError as e:
+        raise ServerException(f'Can not connect to {address} ({e})')
+    finally:
+        conn.close()
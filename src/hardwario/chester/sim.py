@@ -0,0 +1,744 @@
+import os
+import json
+import time
+import threading
+import hashlib
+from loguru import logger
+from pynrfjprog import HighLevel, APIError, LowLevel
+from pynrfjprog.Parameters import *
+from .pib import PIB
+from .nrfjprog import NRFJProg, HighNRFJProg, DEFAULT_JLINK_SPEED_KHZ, DEFAULT_RTT_LATENCY_MS
+from .modem import modem_info, MODEM_AT_COMMAND, MODEM_VERSION_COMMAND, MODEM_UUID_COMMAND
+from .utils import read_hex, COREDUMP_BEGIN_STR, COREDUMP_END_STR, COREDUMP_PREFIX_STR
+
+SIM_SCRIPT_ENV = 'CHESTER_SIM_SCRIPT'
+
+UICR_ADDRESS = 0x10001000
+UICR_SIZE = 0x1000
+RAM_ADDRESS = 0x20000000
+TRACE_PATTERN = bytes(range(256))
+
+# Defaults of the simulated target, every key can be overridden by the script (JSON file or dict).
+DEFAULT_SCRIPT = {
+    'latency': 0.0002,          # seconds spent in every probe call
+    'data_rate': 200000,        # SWD throughput for memory and RTT transfers in B/s
+    'code_size': 0x100000,
+    'page_size': 0x1000,
+    'ram_size': 0x40000,
+    'channels': {
+        'app': {
+            'Terminal': {'up': 1024, 'down': 256},
+            'Logger': {'up': 4096, 'down': 16},
+        },
+        'lte': {
+            'Terminal': {'up': 1024, 'down': 256},
+            'modem_trace': {'up': 65536},
+        },
+    },
+    'echo': False,              # echo received shell command lines
+    'prompt': '',               # prompt printed after every shell command
+    'shell_delay': 0.002,       # time the firmware needs to process one shell command
+    'shell': {},                # command -> response text (str or list of lines)
+    'log': None,                # {'rate': lines/s, 'lines': [...], 'channel': 'Logger'}
+    'coredump': None,           # {'at': s, 'size': B, 'every': s}
+    'trace': None,              # {'rate': B/s}
+    'replay': None,             # {'file': path, 'speed': 1.0 (0 = as fast as possible), 'loop': False}
+    'fs_blocks': 2048,
+    'pib': {                    # Product Information Block preloaded to UICR
+        'vendor_name': 'HARDWARIO',
+        'product_name': 'CHESTER-M',
+        'hw_variant': '',
+        'hw_revision': 'R3.2',
+        'serial_number': '2159000001',
+        'claim_token': '',
+        'ble_passkey': '123456',
+    },
+    'modem_update_time': 0,     # time needed for modem firmware update (.zip)
+    'modem': None,              # installed modem firmware {'version': ..., 'uuid': ...}, answers at AT+CGMR and at AT%XMODEMUUID
+    'page_erase_time': 0,       # time needed to erase one flash page (85 ms on nRF52840)
+    'probes': [1],              # serial numbers of connected J-Link probes
+}
+
+
+def load_script(script=None):
+    if script is None:
+        script = os.environ.get(SIM_SCRIPT_ENV)
+    if isinstance(script, str):
+        with open(script, 'r') as f:
+            script = json.load(f)
+    result = dict(DEFAULT_SCRIPT)
+    if script:
+        result.update(script)
+    return result
+
+
+class SimChannel:
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.buffer = bytearray()
+        self.pending = bytearray()
+        self.dropped = 0
+
+    def free(self):
+        return self.size - len(self.buffer)
+
+    def push(self, data, block=True):
+        '''Firmware side write, blocking writes wait in pending, the others are trimmed.'''
+        if block or self.pending:
+            self.pending += data
+        else:
+            n = min(self.free(), len(data))
+            self.buffer += data[:n]
+            self.dropped += len(data) - n
+        self.flush()
+
+    def flush(self):
+        if self.pending:
+            n = min(self.free(), len(self.pending))
+            if n:
+                self.buffer += self.pending[:n]
+                del self.pending[:n]
+
+    def pop(self, length):
+        data = self.buffer[:length]
+        del self.buffer[:length]
+        self.flush()
+        return data
+
+
+class SimTarget:
+    '''Simulated CHESTER SoC: flash, UICR, RTT channels and scripted firmware.'''
+
+    def __init__(self, mcu, script=None):
+        self.mcu = mcu
+        self.script = load_script(script)
+        self.family = 'NRF52' if mcu == NRFJProg.MCU_APP else 'NRF91'
+        self.lock = threading.RLock()
+        self.code_size = self.script['code_size']
+        self.page_size = self.script['page_size']
+        self.flash = bytearray(b'\xff' * self.code_size)
+        self.uicr = bytearray(b'\xff' * UICR_SIZE)
+        if self.script['pib']:
+            pib = PIB()
+            for name, value in self.script['pib'].items():
+                getattr(pib, f'set_{name}')(value)
+            buffer = pib.get_buffer()
+            self.uicr[0x80:0x80 + len(buffer)] = buffer
+        self.modem_fw = self.script['modem']
+        self.halted = False
+        self.files = {}
+        self.dirs = {'/', '/lfs1'}
+        self.stats = {'calls': 0, 'rtt_read': 0, 'rtt_write': 0, 'commands': 0}
+        self.reset()
+
+    def reset(self):
+        self.up = []
+        self.down = []
+        for name, ch in self.script['channels'][self.mcu].items():
+            self.up.append(SimChannel(name, ch.get('up', 0)))
+            self.down.append(SimChannel(name, ch.get('down', 0)))
+        self.boot_time = time.time()
+        self._shell_busy = 0
+        self._line = bytearray()
+        self._log_index = 0
+        self._trace_sent = 0
+        self._coredump_next = None
+        self._replay = []
+        self._replay_index = 0
+        if self.script['replay']:
+            self._replay = load_recording(self.script['replay']['file'])
+        if self.script['coredump']:
+            self._coredump_next = self.boot_time + self.script['coredump'].get('at', 0)
+
+    def channel(self, name, direction='up'):
+        for ch in self.up if direction == 'up' else self.down:
+            if ch.name == name:
+                return ch
+
+    def call(self, size=0):
+        '''Model the cost of one probe call transferring size bytes.'''
+        self.stats['calls'] += 1
+        delay = self.script['latency']
+        if size:
+            delay += size / self.script['data_rate']
+        if delay > 0:
+            time.sleep(delay)
+
+    def uptime(self):
+        return time.time() - self.boot_time
+
+    def write_line(self, channel, line, block=True):
+        ch = self.channel(channel)
+        if ch is not None:
+            ch.push(line.encode() + b'\r\n', block)
+
+    def tick(self):
+        now = time.time()
+        if self.halted:
+            return
+
+        log = self.script['log']
+        if log:
+            due = int((now - self.boot_time) * log.get('rate', 10))
+            lines = log.get('lines') or ['<inf> app: Log message {}']
+            ch = self.channel(log.get('channel', 'Logger'))
+            if ch is not None and ch.pending:
+                # Firmware is blocked on output (e.g. coredump), messages are lost
+                self._log_index = max(self._log_index, due)
+            while self._log_index < due:
+                line = lines[self._log_index % len(lines)].format(self._log_index)
+                if not line.startswith('['):
+                    line = f'[{device_time(self.uptime())}] {line}'
+                self.write_line(log.get('channel', 'Logger'), line, block=False)
+                self._log_index += 1
+
+        trace = self.script['trace']
+        if trace:
+            ch = self.channel('modem_trace')
+            due = int((now - self.boot_time) * trace.get('rate', 10000))
+            if ch is not None and due > self._trace_sent:
+                offset = self._trace_sent % 256
+                size = due - self._trace_sent
+                ch.push((TRACE_PATTERN * (size // 256 + 2))[offset:offset + size], block=False)
+                self._trace_sent = due
+
+        if self._replay:
+            self.replay(now)
+
+        if self._coredump_next is not None and now >= self._coredump_next:
+            self.coredump(self.script['coredump'].get('size', 4096))
+            every = self.script['coredump'].get('every')
+            self._coredump_next = now + every if every else None
+
+        self.shell_process(now)
+
+    def replay(self, now):
+        replay = self.script['replay']
+        speed = replay.get('speed', 1.0)
+        elapsed = (now - self.boot_time) * speed
+        while self._replay_index < len(self._replay):
+            t, channel, data = self._replay[self._replay_index]
+            ch = self.channel(channel)
+            if speed and t > elapsed:
+                break
+            if not speed and ch is not None and ch.pending:
+                break
+            if ch is not None:
+                ch.push(data)
+            self._replay_index += 1
+            if self._replay_index == len(self._replay) and replay.get('loop'):
+                self._replay_index = 0
+                self.boot_time = now
+                break
+
+    def coredump(self, size):
+        channel = 'Logger' if self.channel('Logger') else 'Terminal'
+        self.write_line(channel, COREDUMP_BEGIN_STR)
+        data = hashlib.sha256(b'coredump').digest() * (size // 32 + 1)
+        for i in range(0, size, 32):
+            self.write_line(channel, COREDUMP_PREFIX_STR + data[i:i + 32].hex())
+        self.write_line(channel, COREDUMP_END_STR)
+
+    def shell_process(self, now):
+        down = self.channel('Terminal', 'down')
+        if down is None:
+            return
+        while down.buffer and now >= self._shell_busy:
+            i = down.buffer.find(b'\n')
+            if i < 0:
+                self._line += down.pop(len(down.buffer))
+                break
+            self._line += down.pop(i + 1)
+            line = self._line.decode(errors='replace').strip('\r\n')
+            self._line = bytearray()
+            self._shell_busy = now + self.script['shell_delay']
+            self.stats['commands'] += 1
+            if self.script['echo']:
+                self.write_line('Terminal', line)
+            for out in self.shell_command(line.strip()):
+                self.write_line('Terminal', out)
+            if self.script['prompt']:
+                self.channel('Terminal').push(self.script['prompt'].encode())
+
+    def shell_command(self, line):
+        if not line:
+            return []
+        response = self.script['shell'].get(line)
+        if response is not None:
+            return response.splitlines() if isinstance(response, str) else response
+        argv = line.split()
+        if argv[0] == MODEM_AT_COMMAND and self.mcu == NRFJProg.MCU_LTE:
+            return self._at(' '.join(argv[1:]))
+        if argv[0] == 'fs' and len(argv) > 1:
+            handler = getattr(self, f'_fs_{argv[1]}', None)
+            if handler:
+                return handler(argv[2:])
+        return [f'{argv[0]}: command not found']
+
+    def _at(self, command):
+        if command == MODEM_VERSION_COMMAND:
+            return [self.modem_fw['version'], 'OK'] if self.modem_fw and self.modem_fw.get('version') else ['ERROR']
+        if command == MODEM_UUID_COMMAND:
+            return [f'%XMODEMUUID: {self.modem_fw["uuid"]}', 'OK'] if self.modem_fw and self.modem_fw.get('uuid') else ['ERROR']
+        return ['ERROR']
+
+    def _fs_ls(self, argv):
+        path = norm_path(argv[0] if argv else '/')
+        if path not in self.dirs:
+            return [f'Unable to open {path} (err -2)']
+        prefix = path.rstrip('/') + '/'
+        names = set()
+        for p in list(self.dirs) + list(self.files):
+            if p != path and p.startswith(prefix):
+                name = p[len(prefix):]
+                if '/' in name:
+                    names.add(name.split('/', 1)[0] + '/')
+                else:
+                    names.add(name + '/' if p in self.dirs else name)
+        return sorted(names)
+
+    def _fs_mkdir(self, argv):
+        path = norm_path(argv[0])
+        if path in self.dirs or path in self.files:
+            return ['Error creating dir[-17]']
+        self.dirs.add(path)
+        return []
+
+    def _fs_rm(self, argv):
+        path = norm_path(argv[0])
+        if path in self.files:
+            del self.files[path]
+        elif path in self.dirs and not self._fs_ls([path]):
+            self.dirs.remove(path)
+        else:
+            return [f'Failed to remove {path} (-2)']
+        return []
+
+    def _fs_trunc(self, argv):
+        path = norm_path(argv[0])
+        length = int(argv[1]) if len(argv) > 1 else 0
+        data = self.files.setdefault(path, bytearray())
+        del data[length:]
+        return []
+
+    def _fs_write(self, argv):
+        path = norm_path(argv[0])
+        offset = -1
+        start = 1
+        if len(argv) > 2 and argv[1] == '-o':
+            offset = int(argv[2])
+            start = 3
+        data = self.files.setdefault(path, bytearray())
+        buf = bytes(int(b, 16) & 0xff for b in argv[start:])
+        if offset < 0:
+            offset = len(data)
+        data[offset:offset + len(buf)] = buf
+        return []
+
+    def _fs_read(self, argv):
+        path = norm_path(argv[0])
+        if path not in self.files:
+            return [f'Failed to open {path} (-2)']
+        data = self.files[path]
+        count = int(argv[1]) if len(argv) > 1 else len(data)
+        offset = int(argv[2]) if len(argv) > 2 else 0
+        lines = [f'File size: {len(data)}']
+        end = min(len(data), offset + count)
+        for i in range(offset, end, 16):
+            chunk = data[i:min(i + 16, end)]
+            text = ''.join(chr(b) if 32 <= b <= 127 else '.' for b in chunk)
+            lines.append(f'{i:08X}  ' + ''.join(f'{b:02X} ' for b in chunk).ljust(48) + f' {text}')
+        return lines
+
+    def _fs_statvfs(self, argv):
+        used = sum((len(d) + 4095) // 4096 for d in self.files.values())
+        blocks = self.script['fs_blocks']
+        return [f'bsize 16, frsize 4096, blocks {blocks}, bfree {blocks - used}']
+
+
+def load_recording(file_path):
+    '''Load RTT recording, JSON lines with keys t, channel and data (hex).'''
+    records = []
+    with open(file_path, 'r') as f:
+        for line in f:
+            if line.strip():
+                r = json.loads(line)
+                records.append((r['t'], r['channel'], bytes.fromhex(r['data'])))
+    return records
+
+
+def norm_path(path):
+    path = '/' + path.strip('/')
+    while '//' in path:
+        path = path.replace('//', '/')
+    return path
+
+
+def device_time(uptime):
+    ms = int(uptime * 1000)
+    h, ms = divmod(ms, 3600000)
+    m, ms = divmod(ms, 60000)
+    s, ms = divmod(ms, 1000)
+    us = int(uptime * 1000000) % 1000
+    return f'{h:02d}:{m:02d}:{s:02d}.{ms:03d},{us:03d}'
+
+
+_targets = {}
+
+
+def get_target(mcu, serial_number=None, script=None):
+    key = (mcu, serial_number or 0)
+    if key not in _targets:
+        logger.debug('Creating simulated target {} {}', *key)
+        _targets[key] = SimTarget(mcu, script)
+    return _targets[key]
+
+
+def clear_targets():
+    _targets.clear()
+
+
+def _memory_descriptors(target):
+    def desc(type, start, size, num_pages, label):
+        return MemoryDescription(MemoryDescriptionStruct(
+            start=start, size=size, num_pages=num_pages, type=type, label=label.encode()))
+
+    return [
+        desc(MemoryType.CODE, 0, target.code_size, target.code_size // target.page_size, 'FLASH'),
+        desc(MemoryType.UICR, UICR_ADDRESS, UICR_SIZE, 1, 'UICR'),
+        desc(MemoryType.DATA_RAM, RAM_ADDRESS, target.script['ram_size'], 1, 'RAM'),
+    ]
+
+
+class SimAPI(LowLevel.API):
+    '''In-process replacement of the nrfjprog DLL calls used by NRFJProg.'''
+
+    def __init__(self, device_family, log=False, **kwargs):
+        self._device_family = device_family
+        self._log = log
+        self._sim_open = False
+
+    def _sim(self, size=0):
+        if self._target is None:
+            raise APIError.APIError(APIError.NrfjprogdllErr.EMULATOR_NOT_CONNECTED)
+        self._target.call(size)
+        return self._target
+
+    def open(self):
+        self._target = None
+        self._sim_open = True
+
+    def close(self):
+        self._target = None
+        self._sim_open = False
+
+    def is_open(self):
+        return self._sim_open
+
+    def connect_to_emu_with_snr(self, serial_number, jlink_speed_khz=DEFAULT_JLINK_SPEED_KHZ):
+        self._target = get_target(self.mcu, serial_number, self._sim_script)
+
+    def connect_to_emu_with_ip(self, ip, port, jlink_speed_khz=DEFAULT_JLINK_SPEED_KHZ):
+        self._target = get_target(self.mcu, f'{ip}:{port}', self._sim_script)
+
+    def connect_to_emu_without_snr(self, jlink_speed_khz=DEFAULT_JLINK_SPEED_KHZ):
+        self._target = get_target(self.mcu, None, self._sim_script)
+
+    def read_connected_emu_fwstr(self):
+        return 'J-Link simulator'
+
+    def read_device_family(self):
+        return self._sim().family
+
+    def select_family(self, family):
+        self._device_family = family
+
+    def sys_reset(self):
+        with self._sim().lock:
+            self._target.reset()
+
+    def halt(self):
+        self._sim().halted = True
+
+    def go(self):
+        self._sim().halted = False
+
+    def disable_bprot(self):
+        self._sim()
+
+    def read_memory_descriptors(self, read_page_sizes=True):
+        return _memory_descriptors(self._sim())
+
+    def erase_all(self):
+        target = self._sim()
+        target.flash[:] = b'\xff' * target.code_size
+        target.uicr[:] = b'\xff' * UICR_SIZE
+
+    def erase_page(self, addr):
+        _sim_erase_range(self._sim(), addr, addr + 1)
+
+    def erase_uicr(self):
+        self._sim().uicr[:] = b'\xff' * UICR_SIZE
+
+    def write(self, addr, data, control):
+        _sim_write(self._sim(len(data)), addr, data)
+
+    def read(self, addr, data_len):
+        return _sim_read(self._sim(data_len), addr, data_len)
+
+    def erase_file(self, file_path, chip_erase_mode=EraseAction.ERASE_ALL, qspi_erase_mode=EraseAction.ERASE_NONE):
+        target = self._sim()
+        if str(file_path).endswith('.zip'):
+            return
+        if chip_erase_mode == EraseAction.ERASE_ALL:
+            target.flash[:] = b'\xff' * target.code_size
+            return
+        for addr, data in read_hex(file_path):
+            _sim_erase_range(target, addr, addr + len(data))
+
+    def program_file(self, file_path):
+        _sim_program(self._sim(), file_path)
+
+    def verify_file(self, file_path, verify_action=VerifyAction.VERIFY_READ):
+        _sim_verify(self._sim(), file_path, verify_action)
+
+    def rtt_start(self):
+        self._sim()
+
+    def rtt_is_control_block_found(self):
+        return self._sim() is not None
+
+    def rtt_stop(self):
+        self._sim()
+
+    def rtt_read_channel_count(self):
+        target = self._sim()
+        return len(target.down), len(target.up)
+
+    def rtt_read_channel_info(self, channel_index, direction):
+        target = self._sim()
+        ch = (target.down if direction == RTTChannelDirection.DOWN_DIRECTION else target.up)[channel_index]
+        return ch.name, ch.size
+
+    def rtt_read(self, channel_index, length, encoding='utf-8'):
+        return _sim_rtt_read(self._target, channel_index, length, encoding)
+
+    def rtt_write(self, channel_index, msg, encoding='utf-8'):
+        return _sim_rtt_write(self._target, channel_index, msg, encoding)
+
+
+def _sim_erase_range(target, start, end):
+    pages = range(start - start % target.page_size, min(end, target.code_size), target.page_size)
+    if target.script['page_erase_time']:
+        time.sleep(len(pages) * target.script['page_erase_time'])
+    with target.lock:
+        for page in pages:
+            target.flash[page:page + target.page_size] = b'\xff' * target.page_size
+
+
+def _sim_write(target, addr, data):
+    # Flash write only clears bits, page has to be erased first to write other data
+    with target.lock:
+        if UICR_ADDRESS <= addr < UICR_ADDRESS + UICR_SIZE:
+            memory = target.uicr
+            addr -= UICR_ADDRESS
+        elif addr < target.code_size:
+            memory = target.flash
+        else:
+            raise APIError.APIError(APIError.NrfjprogdllErr.INVALID_PARAMETER)
+        n = len(data)
+        value = int.from_bytes(memory[addr:addr + n], 'little') & int.from_bytes(bytes(data), 'little')
+        memory[addr:addr + n] = value.to_bytes(n, 'little')
+
+
+def _sim_read(target, addr, data_len):
+    with target.lock:
+        if UICR_ADDRESS <= addr < UICR_ADDRESS + UICR_SIZE:
+            addr -= UICR_ADDRESS
+            return bytearray(target.uicr[addr:addr + data_len])
+        if addr < target.code_size:
+            return bytearray(target.flash[addr:addr + data_len])
+        raise APIError.APIError(APIError.NrfjprogdllErr.INVALID_PARAMETER)
+
+
+def _sim_program(target, file_path):
+    file_path = str(file_path)
+    if file_path.endswith('.zip'):
+        if target.mcu != NRFJProg.MCU_LTE:
+            raise APIError.APIError(APIError.NrfjprogdllErr.INVALID_DEVICE_FOR_OPERATION)
+        target.modem_fw = modem_info(file_path)
+        if target.script['modem_update_time']:
+            time.sleep(target.script['modem_update_time'])
+        return
+    for addr, data in read_hex(file_path):
+        target.call(len(data))
+        _sim_write(target, addr, data)
+
+
+def _sim_verify(target, file_path, verify_action=VerifyAction.VERIFY_READ):
+    if str(file_path).endswith('.zip'):
+        return
+    for addr, data in read_hex(file_path):
+        # Hash is computed on target, only the digest is transferred
+        target.call(32 if verify_action == VerifyAction.VERIFY_HASH else len(data))
+        if _sim_read(target, addr, len(data)) != data:
+            raise APIError.APIError(APIError.NrfjprogdllErr.VERIFY_ERROR)
+
+
+def _sim_rtt_read(target, channel_index, length, encoding):
+    if target is None:
+        raise APIError.APIError(APIError.NrfjprogdllErr.EMULATOR_NOT_CONNECTED)
+    with target.lock:
+        target.tick()
+        data = target.up[channel_index].pop(length)
+        target.stats['rtt_read'] += 1
+    target.call(len(data))
+    return data.decode(encoding) if encoding else data
+
+
+def _sim_rtt_write(target, channel_index, msg, encoding):
+    if target is None:
+        raise APIError.APIError(APIError.NrfjprogdllErr.EMULATOR_NOT_CONNECTED)
+    msg = msg.encode(encoding) if encoding else bytes(msg)
+    with target.lock:
+        target.tick()
+        ch = target.down[channel_index]
+        n = min(ch.free(), len(msg))
+        ch.buffer += msg[:n]
+        target.stats['rtt_write'] += 1
+    target.call(n)
+    return n
+
+
+class SimNRFJProg(NRFJProg, SimAPI):
+    '''NRFJProg backed by a simulated target instead of J-Link, selected by --backend sim.'''
+
+    def __init__(self, mcu, jlink_sn=None, jlink_speed=DEFAULT_JLINK_SPEED_KHZ, log=False, log_suffix=None, rtt_latency=DEFAULT_RTT_LATENCY_MS, script=None):
+        super().__init__(mcu, jlink_sn=jlink_sn, jlink_speed=jlink_speed, log=log, log_suffix=log_suffix, rtt_latency=rtt_latency)
+        self._sim_script = script
+        self._target = None
+
+    @property
+    def target(self):
+        return self._target
+
+
+class SimHighAPI:
+    '''Stand-in for HighLevel.API listing the simulated probes.'''
+
+    def __init__(self, serial_numbers=(1,)):
+        self._serial_numbers = list(serial_numbers)
+
+    def is_open(self):
+        return True
+
+    def get_connected_probes(self):
+        return self._serial_numbers
+
+    def register_probe(self, probe):
+        pass
+
+    def deregister_probe(self, probe):
+        pass
+
+
+class SimDebugProbe(HighLevel.DebugProbe):
+    '''In-process replacement of the HighLevel.DebugProbe calls used by HighNRFJProg.'''
+
+    def __init__(self, api, snr, coprocessor=None, jlink_arm_dll_path=None, log=True, log_suffix=None, clock_speed=None):
+        self._api = api
+        self._target = get_target(self.mcu, snr, self._sim_script)
+
+    def close(self):
+        self._target = None
+
+    def get_device_info(self):
+        target = self._target
+        target.call()
+        nrf52 = target.family == 'NRF52'
+        return DeviceInfo(DeviceInfoStruct(
+            device_family=DeviceFamily.NRF52 if nrf52 else DeviceFamily.NRF91,
+            device_type=DeviceVersion.NRF52840_xxAA_REV2 if nrf52 else DeviceVersion.NRF9160_xxAA_REV2,
+            code_address=0,
+            code_page_size=target.page_size,
+            code_size=target.code_size,
+            uicr_address=UICR_ADDRESS,
+            info_page_size=UICR_SIZE,
+            data_ram_address=RAM_ADDRESS,
+            ram_size=target.script['ram_size']))
+
+    def erase(self, erase_action=EraseAction.ERASE_ALL, start_address=0, end_address=0):
+        target = self._target
+        target.call()
+        if erase_action in (EraseAction.ERASE_ALL, EraseAction.ERASE_SECTOR_AND_UICR):
+            target.uicr[:] = b'\xff' * UICR_SIZE
+        if erase_action == EraseAction.ERASE_ALL:
+            target.flash[:] = b'\xff' * target.code_size
+        elif erase_action != EraseAction.ERASE_NONE and start_address < target.code_size:
+            _sim_erase_range(target, start_address, end_address)
+
+    def program(self, hex_path, program_options=None):
+        target = self._target
+        if program_options is not None and program_options.erase_action == EraseAction.ERASE_ALL:
+            self.erase(EraseAction.ERASE_ALL)
+        elif not str(hex_path).endswith('.zip'):
+            for addr, data in read_hex(hex_path):
+                _sim_erase_range(target, addr, addr + len(data))
+        _sim_program(target, hex_path)
+        if program_options is not None and program_options.verify != VerifyAction.VERIFY_NONE:
+            _sim_verify(target, hex_path, program_options.verify)
+        target.reset()
+
+    def verify(self, hex_path, verify_action=VerifyAction.VERIFY_READ):
+        _sim_verify(self._target, hex_path, verify_action)
+
+    def read(self, address, data_len=4):
+        self._target.call(data_len)
+        data = _sim_read(self._target, address, data_len)
+        return int.from_bytes(data, 'little') if data_len == 4 else data
+
+    def write(self, address, data):
+        if isinstance(data, int):
+            data = data.to_bytes(4, 'little')
+        self._target.call(len(data))
+        _sim_write(self._target, address, data)
+
+    def reset(self, reset_action=ResetAction.RESET_SYSTEM):
+        self._target.call()
+        self._target.reset()
+
+    def rtt_start(self):
+        self._target.call()
+
+    def rtt_is_control_block_found(self):
+        return True
+
+    def rtt_stop(self):
+        self._target.call()
+
+    def rtt_read_channel_count(self):
+        return len(self._target.down), len(self._target.up)
+
+    def rtt_read_channel_info(self, channel_index, direction):
+        ch = (self._target.down if direction == RTTChannelDirection.DOWN_DIRECTION else self._target.up)[channel_index]
+        return ch.name, ch.size
+
+    def rtt_read(self, channel_index, length, encoding='utf-8'):
+        return _sim_rtt_read(self._target, channel_index, length, encoding)
+
+    def rtt_write(self, channel_index, msg, encoding='utf-8'):
+        return _sim_rtt_write(self._target, channel_index, msg, encoding)
+
+
+class SimHighNRFJProg(HighNRFJProg, SimDebugProbe):
+    '''HighNRFJProg backed by a simulated target.'''
+
+    def __init__(self, mcu, jlink_sn=None, clock_speed=None, log=False, log_suffix=None, script=None):
+        super().__init__(mcu, jlink_sn=jlink_sn, clock_speed=clock_speed, log=log, log_suffix=log_suffix)
+        self._sim_script = script
+        self._target = None
+
+    def _get_api(self):
+        return SimHighAPI(load_script(self._sim_script)['probes'])
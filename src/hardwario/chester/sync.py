@@ -0,0 +1,59 @@
+import os
+import json
+import hashlib
+from os.path import join, expanduser
+
+DEFAULT_MANIFEST_PATH = expanduser('~/.hardwario/chester/sync')
+
+
+def file_sha256(file_path):
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def local_tree(src):
+    '''Return (dirs, files) of directory, relative paths with / separator, files map to (size, sha256).'''
+    dirs = set()
+    files = {}
+    for root, dirnames, filenames in os.walk(src):
+        rel = os.path.relpath(root, src).replace(os.sep, '/')
+        prefix = '' if rel == '.' else rel + '/'
+        for d in dirnames:
+            dirs.add(prefix + d)
+        for f in filenames:
+            file_path = join(root, f)
+            files[prefix + f] = (os.path.getsize(file_path), file_sha256(file_path))
+    return dirs, files
+
+
+class SyncManifest:
+    '''Files uploaded to one device (by PIB serial number) with their size and SHA-256.'''
+
+    def __init__(self, serial_number, path=DEFAULT_MANIFEST_PATH):
+        self.file_path = join(path, f'{serial_number}.json')
+        self.files = {}
+        if os.path.exists(self.file_path):
+            with open(self.file_path, 'r') as f:
+                self.files = json.load(f)
+
+    def match(self, path, size, sha256):
+        return self.files.get(path) == {'size': size, 'sha256': sha256}
+
+    def set(self, path, size, sha256):
+        self.files[path] = {'size': size, 'sha256': sha256}
+
+    def remove(self, path):
+        self.files.pop(path, None)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        tmp = self.file_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.files, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.file_path)
@@ -0,0 +1,495 @@
+import os
+import json
+import time
+import zlib
+import lzma
+import socket
+import threading
+from collections import deque
+from loguru import logger
+
+DEFAULT_SINK_BUFFER = 8 * 1024 * 1024   # bytes queued per sink before data is dropped
+DEFAULT_FLUSH_INTERVAL = 0.5            # seconds between file flushes
+STATUS_INTERVAL = 0.5                   # seconds between status line updates
+DEFAULT_INDEX_INTERVAL = 1              # seconds between index entries of segmented files
+DEFAULT_CLIENT_BUFFER = 4 * 1024 * 1024  # bytes queued per TCP client before data is dropped
+DEFAULT_REPLAY_BACKLOG = 1024 * 1024    # bytes of recent trace sent to newly connected client
+
+COMPRESS_NONE = 'none'
+COMPRESS_GZIP = 'gzip'
+COMPRESS_LZMA = 'lzma'
+COMPRESS_SUFFIX = {COMPRESS_NONE: '', COMPRESS_GZIP: '.gz', COMPRESS_LZMA: '.xz'}
+
+
+class TraceSink:
+    '''Consumer of trace data running in own writer thread fed through bounded byte queue.
+
+    put() never blocks, data which does not fit into the queue is dropped and counted.
+    Subclasses implement write() called with batches of queued data, it returns False if data was discarded.
+    '''
+
+    name = 'sink'
+
+    def __init__(self, max_buffer=DEFAULT_SINK_BUFFER):
+        self.max_buffer = max_buffer
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self._chunks = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f'trace-{self.name}')
+        self._thread.start()
+
+    def put(self, data):
+        with self._cond:
+            if self.queued + len(data) > self.max_buffer:
+                self.dropped += len(data)
+                return False
+            self._chunks.append(data)
+            self.queued += len(data)
+            self._cond.notify()
+        return True
+
+    def close(self, timeout=5):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._chunks and not self._closed:
+                    if not self._cond.wait(self.idle_timeout()):
+                        break
+                if not self._chunks and self._closed:
+                    break
+                data = b''.join(self._chunks)
+                self._chunks.clear()
+                self.queued = 0
+            try:
+                if not data:
+                    self.idle()
+                elif self.write(data) is False:
+                    self._discard(len(data))
+                else:
+                    self.written += len(data)
+            except Exception as e:
+                self.errors += 1
+                self._discard(len(data))
+                logger.warning(f'Trace {self.name}: {e}')
+        try:
+            self.finish()
+        except Exception as e:
+            logger.warning(f'Trace {self.name}: {e}')
+
+    def _discard(self, size):
+        with self._cond:
+            self.dropped += size
+
+    def idle_timeout(self):
+        return None
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def idle(self):
+        pass
+
+    def finish(self):
+        pass
+
+
+class FileSink(TraceSink):
+    '''Write trace to file, flushed at most every flush_interval seconds.'''
+
+    name = 'file'
+
+    def __init__(self, file_path, flush_interval=DEFAULT_FLUSH_INTERVAL, **kwargs):
+        super().__init__(**kwargs)
+        self.file_path = file_path
+        self.flush_interval = flush_interval
+        self._fd = open(file_path, 'wb', buffering=1 << 20)
+        self._flushed = time.monotonic()
+        self._dirty = False
+
+    def idle_timeout(self):
+        return self.flush_interval if self._dirty else None
+
+    def write(self, data):
+        self._fd.write(data)
+        self._dirty = True
+        if time.monotonic() - self._flushed >= self.flush_interval:
+            self.idle()
+
+    def idle(self):
+        self._fd.flush()
+        self._flushed = time.monotonic()
+        self._dirty = False
+
+    def finish(self):
+        self._fd.close()
+
+
+class SegmentedFileSink(TraceSink):
+    '''Write trace to numbered segment files rotated by size or time, optionally compressed.
+
+    Data is written in blocks of about index_interval seconds, every block is an independent
+    gzip member or xz stream (concatenated as the formats allow). The side index (JSON lines,
+    file_path + '.index') maps host time of block start to segment and its offset, so a time
+    window can be extracted by decompressing only the blocks it spans.
+    '''
+
+    name = 'file'
+
+    def __init__(self, file_path, compress=COMPRESS_NONE, rotate_size=None, rotate_time=None, keep=None,
+                 index_interval=DEFAULT_INDEX_INTERVAL, flush_interval=DEFAULT_FLUSH_INTERVAL, **kwargs):
+        super().__init__(**kwargs)
+        self.file_path = file_path
+        self.index_path = file_path + '.index'
+        self.compress = compress
+        self.rotate_size = rotate_size
+        self.rotate_time = rotate_time
+        self.keep = keep
+        self.index_interval = index_interval
+        self.flush_interval = flush_interval
+        self.segments = []
+        self.position = 0
+        self._index = open(self.index_path, 'w')
+        self._entries = deque()     # (segment name, index line) of kept segments, only with keep
+        self._fd = None
+        self._segment_time = 0
+        self._block = False
+        self._block_time = 0
+        self._compressor = None
+        self._dirty = False
+
+    def _segment_path(self, number):
+        root, ext = os.path.splitext(self.file_path)
+        return f'{root}.{number:04d}{ext}{COMPRESS_SUFFIX[self.compress]}'
+
+    def _rotate(self, now):
+        if self._fd:
+            self._end_block()
+            self._fd.close()
+        path = self._segment_path(len(self.segments) + 1)
+        self.segments.append(path)
+        self._fd = open(path, 'wb', buffering=1 << 20)
+        self._segment_time = now
+        if self.keep and len(self.segments) > self.keep:
+            old = self.segments[-self.keep - 1]
+            if os.path.exists(old):
+                os.remove(old)
+            self._prune_index(os.path.basename(old))
+
+    def _prune_index(self, segment):
+        '''Rewrite index without entries of removed segment.'''
+        entries = self._entries
+        while entries and entries[0][0] == segment:
+            entries.popleft()
+        self._index.close()
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.writelines(line for _, line in entries)
+        os.replace(tmp_path, self.index_path)
+        self._index = open(self.index_path, 'a')
+
+    def _begin_block(self, now):
+        self._block = True
+        self._block_time = now
+        if self.compress == COMPRESS_GZIP:
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        elif self.compress == COMPRESS_LZMA:
+            self._compressor = lzma.LZMACompressor(preset=3)
+        entry = {'time': round(now, 6), 'segment': os.path.basename(self.segments[-1]),
+                 'offset': self._fd.tell(), 'position': self.position}
+        line = json.dumps(entry) + '\n'
+        if self.keep:
+            self._entries.append((entry['segment'], line))
+        self._index.write(line)
+
+    def _end_block(self):
+        if self._compressor:
+            self._fd.write(self._compressor.flush())
+            self._compressor = None
+        self._block = False
+
+    def write(self, data):
+        now = time.time()
+        if self._fd is None or (self.rotate_size and self._fd.tell() >= self.rotate_size) or \
+                (self.rotate_time and now - self._segment_time >= self.rotate_time):
+            self._rotate(now)
+        elif self._block and now - self._block_time >= self.index_interval:
+            self._end_block()
+        if not self._block:
+            self._begin_block(now)
+        self._fd.write(self._compressor.compress(data) if self._compressor else data)
+        self.position += len(data)
+        self._dirty = True
+
+    def idle_timeout(self):
+        return self.flush_interval if self._dirty else None
+
+    def idle(self):
+        # Complete block so all received data is on disk in decodable form
+        if self._block:
+            self._end_block()
+        if self._fd:
+            self._fd.flush()
+        self._index.flush()
+        self._dirty = False
+
+    def finish(self):
+        if self._fd:
+            self._end_block()
+            self._fd.close()
+        self._index.close()
+
+
+def read_trace_index(index_path):
+    with open(index_path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def extract_trace(index_path, start=None, end=None):
+    '''Yield trace data of blocks overlapping time window [start, end) (seconds since epoch) from segmented capture.'''
+    entries = read_trace_index(index_path)
+    base = os.path.dirname(index_path)
+    for i, entry in enumerate(entries):
+        following = entries[i + 1] if i + 1 < len(entries) else None
+        if end is not None and entry['time'] >= end:
+            break
+        if start is not None and following and following['time'] <= start:
+            continue
+        path = os.path.join(base, entry['segment'])
+        if not os.path.exists(path):
+            logger.warning(f'Missing trace segment {entry["segment"]}')
+            continue
+        with open(path, 'rb') as f:
+            f.seek(entry['offset'])
+            if following and following['segment'] == entry['segment']:
+                data = f.read(following['offset'] - entry['offset'])
+            else:
+                data = f.read()
+        if path.endswith(COMPRESS_SUFFIX[COMPRESS_GZIP]):
+            data = zlib.decompressobj(31).decompress(data)
+        elif path.endswith(COMPRESS_SUFFIX[COMPRESS_LZMA]):
+            data = lzma.LZMADecompressor().decompress(data)
+        yield data
+
+
+class SocketSink(TraceSink):
+    '''Send trace to TCP server, reconnects after connection loss, data meanwhile is dropped.'''
+
+    name = 'tcp'
+
+    def __init__(self, host, port, reconnect_interval=1, **kwargs):
+        super().__init__(**kwargs)
+        self.address = (host, port)
+        self.reconnect_interval = reconnect_interval
+        self._socket = socket.create_connection(self.address)
+        self._next_connect = 0
+
+    def write(self, data):
+        if self._socket is None:
+            if time.monotonic() < self._next_connect:
+                return False
+            self._next_connect = time.monotonic() + self.reconnect_interval
+            self._socket = socket.create_connection(self.address, timeout=self.reconnect_interval)
+            self._socket.settimeout(None)
+            logger.info(f'Trace {self.name}: reconnected to {self.address[0]}:{self.address[1]}')
+        try:
+            self._socket.sendall(data)
+        except OSError:
+            self._socket.close()
+            self._socket = None
+            self._next_connect = time.monotonic() + self.reconnect_interval
+            raise
+
+    def finish(self):
+        if self._socket:
+            self._socket.close()
+
+
+class ClientSink(TraceSink):
+    '''Connected TCP client of TraceServer, disconnected on send error.'''
+
+    name = 'client'
+
+    def __init__(self, sock, address, **kwargs):
+        super().__init__(**kwargs)
+        self.socket = sock
+        self.address = address
+        self.connected = True
+
+    def write(self, data):
+        if not self.connected:
+            return False
+        try:
+            self.socket.sendall(data)
+        except OSError:
+            self.connected = False
+            logger.info(f'Trace client {self.address[0]}:{self.address[1]} disconnected')
+            return False
+
+    def finish(self):
+        self.socket.close()
+
+
+class TraceServer:
+    '''Listen for TCP clients and fan out trace to all of them, sink of TracePipeline.
+
+    Every client has own bounded buffer and writer thread, so a stalled client does not
+    block the reader or other clients. Newly connected client gets up to backlog bytes
+    of most recent trace first.
+    '''
+
+    name = 'listen'
+
+    def __init__(self, host, port, backlog=DEFAULT_REPLAY_BACKLOG, max_buffer=DEFAULT_CLIENT_BUFFER):
+        self.backlog = backlog
+        self.max_buffer = max_buffer
+        self.clients = []
+        self._totals = {'written': 0, 'dropped': 0, 'errors': 0}
+        self._recent = deque()
+        self._recent_size = 0
+        self._lock = threading.Lock()
+        self._socket = socket.create_server((host, port))
+        self.address = self._socket.getsockname()
+        self._thread = None
+
+    def _total(self, name):
+        with self._lock:
+            return self._totals[name] + sum(getattr(c, name) for c in self.clients)
+
+    @property
+    def written(self):
+        return self._total('written')
+
+    @property
+    def dropped(self):
+        return self._total('dropped')
+
+    @property
+    def errors(self):
+        return self._total('errors')
+
+    @property
+    def queued(self):
+        return self._total('queued')
+
+    def start(self):
+        self._thread = threading.Thread(target=self._accept, daemon=True, name='trace-listen')
+        self._thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self._socket.accept()
+            except OSError:
+                break
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = ClientSink(sock, address, max_buffer=self.max_buffer)
+            with self._lock:
+                if self._recent:
+                    client.put(b''.join(self._recent))
+                client.start()
+                self.clients.append(client)
+            logger.info(f'Trace client {address[0]}:{address[1]} connected')
+
+    def put(self, data):
+        with self._lock:
+            if self.backlog:
+                self._recent.append(data)
+                self._recent_size += len(data)
+                while self._recent_size - len(self._recent[0]) >= self.backlog:
+                    self._recent_size -= len(self._recent.popleft())
+            for client in self.clients:
+                client.put(data)
+            self._collect()
+
+    def _collect(self):
+        '''Remove disconnected clients, their counters are kept in totals.'''
+        for client in [c for c in self.clients if not c.connected]:
+            self.clients.remove(client)
+            client.close(0)
+            for name in self._totals:
+                self._totals[name] += getattr(client, name)
+
+    def close(self, timeout=5):
+        self._socket.close()
+        with self._lock:
+            for client in self.clients:
+                client.connected = False
+                try:
+                    client.socket.shutdown(socket.SHUT_RDWR)  # Unblock pending send
+                except OSError:
+                    pass
+            self._collect()
+
+
+class TracePipeline:
+    '''Fan out trace data from RTT reader to sinks without blocking the reader.'''
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+        self.received = 0
+        self.start_time = time.monotonic()
+        self._rate_time = self.start_time
+        self._rate_bytes = 0
+        self.rate = 0.0
+        for sink in self.sinks:
+            sink.start()
+
+    def feed(self, data):
+        if not data:
+            return
+        self.received += len(data)
+        for sink in self.sinks:
+            sink.put(data)
+
+    @property
+    def dropped(self):
+        return sum(sink.dropped for sink in self.sinks)
+
+    def update_rate(self):
+        now = time.monotonic()
+        if now - self._rate_time >= STATUS_INTERVAL:
+            self.rate = (self.received - self._rate_bytes) / (now - self._rate_time)
+            self._rate_time = now
+            self._rate_bytes = self.received
+            return True
+        return False
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+class StatusLine:
+    '''Single terminal line rewritten in place at most every interval seconds.'''
+
+    def __init__(self, interval=STATUS_INTERVAL, echo=print):
+        self.interval = interval
+        self.echo = echo
+        self._len = 0
+        self._time = 0
+
+    def update(self, text, force=False):
+        now = time.monotonic()
+        if not force and now - self._time < self.interval:
+            return
+        self._time = now
+        self.echo(f"\r{text}{' ' * max(0, self._len - len(text))}", end='', flush=True)
+        self._len = len(text)
+
+    def newline(self):
+        if self._len:
+            self.echo()
+            self._len = 0
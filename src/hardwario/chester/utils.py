@@ -5,6 +5,7 @@ import click
 import time
 import requests
 import binascii
+from datetime import datetime
 from loguru import logger
 
 
@@ -66,14 +67,74 @@ COREDUMP_PREFIX_STR = "#CD:"
 COREDUMP_BEGIN_STR = COREDUMP_PREFIX_STR + "BEGIN#"
 COREDUMP_END_STR = COREDUMP_PREFIX_STR + "END#"
 COREDUMP_ERROR_STR = COREDUMP_PREFIX_STR + "ERROR CANNOT DUMP#"
+COREDUMP_INCOMPLETE_SUFFIX = '.incomplete'
+
+
+def timestamped_path(file_path):
+    '''Insert current date/time before extension, e.g. dump.bin -> dump-20240101-120000.bin.'''
+    base, ext = os.path.splitext(file_path)
+    base += datetime.now().strftime('-%Y%m%d-%H%M%S')
+    path = base + ext
+    i = 1
+    while os.path.exists(path):
+        path = f'{base}-{i}{ext}'
+        i += 1
+    return path
 
 
 class Coredump:
-    def __init__(self):
-        self.has_begin = False
-        self.has_end = False
-        self.has_error = False
-        self.data = b''
+    '''Coredump decoder, with file_path each dump is streamed to its own timestamped file.
+
+    File of failed or interrupted dump gets COREDUMP_INCOMPLETE_SUFFIX.
+    '''
+
+    def __init__(self, file_path=None):
+        self.file_path = file_path
+        self.output_path = None
+        self._fd = None
+        self.reset()
+
+    @property
+    def in_progress(self):
+        return self.has_begin and not self.has_end and not self.has_error
+
+    @property
+    def rate(self):
+        elapsed = time.time() - self.start_time if self.start_time else 0
+        return self.size / elapsed if elapsed > 0 else 0
+
+    def _begin(self):
+        if self.in_progress:
+            self._finish(error=True)
+            logger.warning(f'Coredump interrupted by next one, incomplete dump saved to {self.output_path or "memory"}')
+        self.reset()
+        self.has_begin = True
+        self.start_time = time.time()
+        if self.file_path:
+            self.output_path = timestamped_path(os.path.expanduser(self.file_path))
+            self._fd = open(self.output_path, 'wb', buffering=1 << 16)
+
+    def _finish(self, error=False):
+        self.has_end = True
+        self.has_error = self.has_error or error
+        if self._fd:
+            self._fd.close()
+            self._fd = None
+            if self.has_error:
+                path = self.output_path + COREDUMP_INCOMPLETE_SUFFIX
+                i = 1
+                while os.path.exists(path):
+                    path = f'{self.output_path}-{i}{COREDUMP_INCOMPLETE_SUFFIX}'
+                    i += 1
+                os.rename(self.output_path, path)
+                self.output_path = path
+
+    def abort(self):
+        '''Finish dump in progress as failed (e.g. reading stopped), returns True if there was one.'''
+        if not self.in_progress:
+            return False
+        self._finish(error=True)
+        return True
 
     def feed_line(self, line: str):
         line = line.strip()
@@ -81,16 +142,15 @@ class Coredump:
             return
 
         if line.find(COREDUMP_BEGIN_STR) >= 0:
-            self.has_begin = True
-            self.data = b''
+            self._begin()
             return
 
         elif line.find(COREDUMP_END_STR) >= 0:
-            self.has_end = True
+            self._finish()
             return
 
         elif line.find(COREDUMP_ERROR_STR) >= 0:
-            self.has_error = True
+            self._finish(error=True)
             return
 
         if not self.has_begin:
@@ -98,8 +158,7 @@ class Coredump:
 
         prefix_idx = line.find(COREDUMP_PREFIX_STR)
         if prefix_idx < 0:
-            self.has_end = True
-            self.has_error = True
+            self._finish(error=True)
             return
 
         if self.has_end:
@@ -108,39 +167,57 @@ class Coredump:
         hex_str = line[prefix_idx + len(COREDUMP_PREFIX_STR):]
 
         try:
-            self.data += binascii.unhexlify(hex_str)
+            chunk = binascii.unhexlify(hex_str)
         except Exception as e:
             logger.error("Cannot parse coredump hex_str: {}".format(hex_str))
-            self.has_error = True
-            self.has_end = True
+            self._finish(error=True)
+            return
+
+        self.size += len(chunk)
+        if self._fd:
+            self._fd.write(chunk)
+        else:
+            self.data += chunk
 
     def reset(self):
+        if self._fd:
+            self._fd.close()
+            self._fd = None
         self.has_begin = False
         self.has_end = False
         self.has_error = False
-        self.data = b''
-
-
-def rtt_read_line(prog, channel, timeout, cache={'Terminal': '', 'Logger': ''}):
-    timeout = time.time() + timeout
-    while time.time() < timeout:
-        i = cache[channel].find('\n')
-        if i > -1:
-            line = cache[channel][:i]
-            cache[channel] = cache[channel][i + 1:]
-            return line
-
-        data = prog.rtt_read(channel)
-        if data:
-            cache[channel] += data
-
-        i = cache[channel].find('\n')
-        if i < 0:
-            continue
-
-        line = cache[channel][:i]
-        cache[channel] = cache[channel][i + 1:]
-        return line
+        self.start_time = None
+        self.size = 0
+        self.data = bytearray()
+
+
+def read_hex(file_path):
+    '''Parse Intel HEX file into list of (address, bytearray) segments.'''
+    segments = []
+    base = 0
+    with open(file_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line.startswith(':'):
+                continue
+            record = bytes.fromhex(line[1:])
+            length = record[0]
+            address = (record[1] << 8) | record[2]
+            record_type = record[3]
+            data = record[4:4 + length]
+            if record_type == 0x00:
+                address += base
+                if segments and segments[-1][0] + len(segments[-1][1]) == address:
+                    segments[-1][1].extend(data)
+                else:
+                    segments.append((address, bytearray(data)))
+            elif record_type == 0x01:
+                break
+            elif record_type == 0x02:
+                base = ((data[0] << 8) | data[1]) * 16
+            elif record_type == 0x04:
+                base = ((data[0] << 8) | data[1]) << 16
+    return segments
 
 
 def bytes_to_human(size):
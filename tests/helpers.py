@@ -0,0 +1,17 @@
+def write_hex(file_path, segments):
+    '''Write (address, data) segments to Intel HEX file.'''
+
+    def record(address, record_type, data=b''):
+        body = bytes([len(data), (address >> 8) & 0xff, address & 0xff, record_type]) + bytes(data)
+        return ':' + (body + bytes([-sum(body) & 0xff])).hex().upper() + '\n'
+
+    with open(file_path, 'w') as f:
+        base = None
+        for address, data in segments:
+            for i in range(0, len(data), 16):
+                addr = address + i
+                if addr >> 16 != base:
+                    base = addr >> 16
+                    f.write(record(0, 0x04, base.to_bytes(2, 'big')))
+                f.write(record(addr & 0xffff, 0x00, data[i:i + 16]))
+        f.write(record(0, 0x01))
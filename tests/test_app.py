@@ -0,0 +1,186 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from hardwario.chester.sim import SimNRFJProg, clear_targets
+from hardwario.chester.app import App
+from hardwario.chester.nrfjprog import NRFJProgException
+from hardwario.chester.sync import SyncManifest
+
+ANSI_PROMPT = '\x1b[1;32muart:~$ \x1b[m'
+
+
+class TestAppFsEcho(unittest.TestCase):
+    '''File transfer with shell echo on and ANSI colored prompt.'''
+
+    def setUp(self):
+        self.prog = SimNRFJProg('app', script={'echo': True, 'prompt': ANSI_PROMPT})
+        self.prog.open()
+        self.app = App(self.prog)
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.prog.close()
+        shutil.rmtree(self.tmp)
+
+    def test_upload_bulk(self):
+        data = os.urandom(20000)
+        src = os.path.join(self.tmp, 'src.bin')
+        with open(src, 'wb') as f:
+            f.write(data)
+        self.app.fs_write_file(src, '/data.bin', 'bulk')
+        self.assertEqual(bytes(self.prog.target.files['/data.bin']), data)
+
+    def test_download_after_legacy_upload(self):
+        data = os.urandom(500)
+        src = os.path.join(self.tmp, 'src.bin')
+        with open(src, 'wb') as f:
+            f.write(data)
+        # Echo of legacy writes is still queued when the download starts
+        self.app.fs_write_file(src, '/data.bin', 'legacy')
+        dst = os.path.join(self.tmp, 'data.bin')
+        self.assertEqual(self.app.fs_read_file('/data.bin', dst), len(data))
+        with open(dst, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_download(self):
+        data = os.urandom(5000)
+        self.prog.target.files['/data.bin'] = bytearray(data)
+        dst = os.path.join(self.tmp, 'data.bin')
+        # Prompt printed after this command prefixes echo of the next one
+        self.assertIn('data.bin', self.app.fs_ls('/'))
+        self.assertEqual(self.app.fs_read_file('/data.bin', dst), len(data))
+        with open(dst, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+
+class TestAppShell(unittest.TestCase):
+
+    def setUp(self):
+        clear_targets()
+        self.prog = SimNRFJProg('app', script={'echo': True, 'prompt': ANSI_PROMPT, 'latency': 0,
+                                               'shell': {'info': ['Version: v1.0.0', '', 'Uptime: 5 s']}})
+        self.prog.open()
+        self.app = App(self.prog)
+
+    def tearDown(self):
+        self.prog.close()
+        clear_targets()
+
+    def test_response(self):
+        self.assertEqual(self.app.shell('info'), ['Version: v1.0.0', '', 'Uptime: 5 s'])
+        self.assertEqual(self.app.shell('foo'), ['foo: command not found'])
+
+    def test_no_idle_wait(self):
+        self.app.shell('info')
+        start = time.time()
+        for _ in range(5):
+            self.app.shell('info')
+        # Response ends by the sentinel, not by waiting for idle output
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_timeout(self):
+        self.app.shell('info')
+        self.prog.target.halted = True  # Firmware does not respond
+        start = time.time()
+        with self.assertRaisesRegex(NRFJProgException, 'Timeout waiting on end of response to: info'):
+            self.app.shell('info', timeout=0.2)
+        self.assertLess(time.time() - start, 2)
+
+
+class TestSyncManifest(unittest.TestCase):
+
+    def test_round_trip(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            manifest = SyncManifest(2159000001, tmp)
+            manifest.set('/lfs1/a.txt', 5, 'aa')
+            manifest.set('/lfs1/b.txt', 7, 'bb')
+            manifest.remove('/lfs1/b.txt')
+            manifest.save()
+            manifest = SyncManifest(2159000001, tmp)
+            self.assertTrue(manifest.match('/lfs1/a.txt', 5, 'aa'))
+            self.assertFalse(manifest.match('/lfs1/a.txt', 5, 'ab'))
+            self.assertFalse(manifest.match('/lfs1/b.txt', 7, 'bb'))
+            self.assertEqual(os.listdir(tmp), ['2159000001.json'])
+        finally:
+            shutil.rmtree(tmp)
+
+
+class TestAppSync(unittest.TestCase):
+
+    def setUp(self):
+        clear_targets()
+        self.prog = SimNRFJProg('app', script={'latency': 0, 'data_rate': 1e12, 'shell_delay': 0})
+        self.prog.open()
+        self.app = App(self.prog)
+        self.files = self.prog.target.files
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        self.write('a.txt', b'alpha')
+        self.write('sub/b.bin', os.urandom(300))
+        os.makedirs(os.path.join(self.src, 'empty'))
+
+    def tearDown(self):
+        self.prog.close()
+        clear_targets()
+        shutil.rmtree(self.tmp)
+
+    def write(self, rel, data):
+        path = os.path.join(self.src, *rel.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def sync(self, **kwargs):
+        return self.app.fs_sync(self.src, '/lfs1/sync', SyncManifest(1, os.path.join(self.tmp, 'manifest')), **kwargs)
+
+    def test_walk(self):
+        self.sync()
+        self.assertEqual(self.app.fs_walk('/lfs1/sync'),
+                         ({'/lfs1/sync', '/lfs1/sync/sub', '/lfs1/sync/empty'}, {'/lfs1/sync/a.txt', '/lfs1/sync/sub/b.bin'}))
+        self.assertEqual(self.app.fs_walk('/lfs1/missing'), (set(), set()))
+
+    def test_up_to_date(self):
+        result = self.sync()
+        self.assertEqual(result, {'upload': ['/lfs1/sync/a.txt', '/lfs1/sync/sub/b.bin'], 'skip': [], 'delete': []})
+        self.assertEqual(bytes(self.files['/lfs1/sync/a.txt']), b'alpha')
+        self.assertIn('/lfs1/sync/empty', self.prog.target.dirs)
+        result = self.sync()
+        self.assertEqual(result, {'upload': [], 'skip': ['/lfs1/sync/a.txt', '/lfs1/sync/sub/b.bin'], 'delete': []})
+
+    def test_changed(self):
+        self.sync()
+        self.write('a.txt', b'alpha2')
+        self.assertEqual(self.sync()['upload'], ['/lfs1/sync/a.txt'])
+        self.assertEqual(bytes(self.files['/lfs1/sync/a.txt']), b'alpha2')
+        # File changed on the device is uploaded again although manifest matches
+        del self.files['/lfs1/sync/sub/b.bin'][10:]
+        self.assertEqual(self.sync()['upload'], ['/lfs1/sync/sub/b.bin'])
+
+    def test_delete(self):
+        self.sync()
+        self.app.fs_mkdir('/lfs1/sync/old')
+        self.files['/lfs1/sync/old/c.txt'] = bytearray(b'old')
+        self.files['/lfs1/sync/d.txt'] = bytearray(b'old')
+        self.assertEqual(self.sync()['delete'], [])
+        self.assertIn('/lfs1/sync/d.txt', self.files)
+        result = self.sync(delete=True)
+        self.assertEqual(result['delete'], ['/lfs1/sync/d.txt', '/lfs1/sync/old/c.txt', '/lfs1/sync/old'])
+        self.assertEqual(sorted(self.files), ['/lfs1/sync/a.txt', '/lfs1/sync/sub/b.bin'])
+        self.assertNotIn('/lfs1/sync/old', self.prog.target.dirs)
+
+    def test_dry_run(self):
+        self.files['/lfs1/sync/d.txt'] = bytearray(b'old')
+        self.prog.target.dirs.add('/lfs1/sync')
+        result = self.sync(delete=True, dry_run=True)
+        self.assertEqual(result, {'upload': ['/lfs1/sync/a.txt', '/lfs1/sync/sub/b.bin'], 'skip': [],
+                                  'delete': ['/lfs1/sync/d.txt']})
+        self.assertEqual(list(self.files), ['/lfs1/sync/d.txt'])
+        self.assertEqual(self.prog.target.dirs, {'/', '/lfs1', '/lfs1/sync'})
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'manifest')))
+
+
+if __name__ == '__main__':
+    unittest.main()
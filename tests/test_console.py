@@ -0,0 +1,48 @@
+import unittest
+from prompt_toolkit.buffer import Buffer
+from prompt_toolkit.document import Document
+from hardwario.chester.console import LogLexer, log_level_color_lut
+from hardwario.chester.logindex import LOG_PATTERN
+from hardwario.chester.scrollback import LogScrollback
+
+LINES = [
+    '[00:00:01.000,000] <inf> app: Started',
+    '[00:00:02.000,000] <err> lte: Attach failed',
+    '[00:00:03.000,000] <wrn> app: Low battery',
+]
+
+
+class TestLogLexer(unittest.TestCase):
+
+    def lex(self, lexer, text):
+        get_line = lexer.lex_document(Document(text))
+        return [get_line(i)[0][0] for i in range(len(text.splitlines()))]
+
+    def test_filter_change(self):
+        lexer = LogLexer(LOG_PATTERN)
+        scrollback = LogScrollback(Buffer(read_only=True))
+        scrollback.append(''.join(line + '\n' for line in LINES))
+        scrollback.refresh()
+        self.assertEqual(self.lex(lexer, scrollback.text), [log_level_color_lut[c] for c in ('inf', 'err', 'wrn')])
+        # Line numbers of filtered view no longer match the scrollback
+        scrollback.set_filter(level='wrn')
+        scrollback.refresh()
+        self.assertEqual(self.lex(lexer, scrollback.filtered_text), [log_level_color_lut[c] for c in ('err', 'wrn')])
+        scrollback.set_filter(modules=['app'], level=None)
+        scrollback.refresh()
+        self.assertEqual(self.lex(lexer, scrollback.filtered_text), [log_level_color_lut[c] for c in ('inf', 'wrn')])
+
+    def test_cache_size(self):
+        lexer = LogLexer(LOG_PATTERN)
+        lexer.CACHE_SIZE = 2
+        self.lex(lexer, '\n'.join(LINES))
+        self.assertEqual(list(lexer._cache), LINES[1:])
+
+    def test_module_colors(self):
+        lexer = LogLexer(LOG_PATTERN, module_colors={'lte': '#123456'})
+        tokens = lexer.lex_document(Document(LINES[1]))(0)
+        self.assertIn(('#123456', 'lte'), tokens)
+
+
+if __name__ == '__main__':
+    unittest.main()
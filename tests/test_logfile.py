@@ -0,0 +1,122 @@
+import os
+import re
+import gzip
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from hardwario.chester.logfile import LogWriter, LogFileException, parse_size
+
+
+class TestParseSize(unittest.TestCase):
+
+    def test_units(self):
+        self.assertEqual(parse_size('100'), 100)
+        self.assertEqual(parse_size('4k'), 4096)
+        self.assertEqual(parse_size('2 MB'), 2 * 1024 * 1024)
+        self.assertEqual(parse_size('1G'), 1024 ** 3)
+
+    def test_invalid(self):
+        for value in ('', 'abc', '1T', '-5'):
+            with self.assertRaises(LogFileException):
+                parse_size(value)
+
+
+class TestLogWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'console.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def segments(self):
+        def order(name):
+            m = re.match(r'console-(\d{8}-\d{6})(?:-(\d+))?\.log', name)
+            return (m.group(1), int(m.group(2) or 0)) if m else (name, 0)
+        return sorted((name for name in os.listdir(self.tmp) if name != 'console.log'), key=order)
+
+    def read_all(self):
+        data = b''
+        for name in self.segments() + ['console.log']:
+            opener = gzip.open if name.endswith('.gz') else open
+            with opener(os.path.join(self.tmp, name), 'rb') as f:
+                data += f.read()
+        return data.decode()
+
+    def write_batches(self, writer, count, size=100):
+        text = ''
+        for i in range(count):
+            batch = f'{i:04d}'.ljust(size - 1, '.') + '\n'
+            text += batch
+            writer.write(batch)
+            writer.flush()
+            while writer._queued:
+                time.sleep(0.001)
+        return text
+
+    def test_size_rotation(self):
+        with LogWriter(self.path, max_size=250, keep=None) as writer:
+            text = self.write_batches(writer, 9)
+        # Rotation happens before the batch which follows reaching max_size
+        self.assertEqual(len(self.segments()), 2)
+        self.assertEqual(os.path.getsize(self.path), 300)
+        self.assertEqual(self.read_all(), text)
+
+    def test_time_rotation(self):
+        with LogWriter(self.path, max_size=None, rotate_time=0.05, keep=None) as writer:
+            text = self.write_batches(writer, 1)
+            time.sleep(0.06)
+            text += self.write_batches(writer, 1)
+        self.assertEqual(len(self.segments()), 1)
+        self.assertEqual(self.read_all(), text)
+
+    def test_keep_matches_only_segments(self):
+        unrelated = ['console-notes.log', 'console-20200101-000000.log.bak', 'console-backup.log']
+        for name in unrelated:
+            with open(os.path.join(self.tmp, name), 'w') as f:
+                f.write('keep me')
+        with LogWriter(self.path, max_size=100, keep=2) as writer:
+            for _ in range(5):
+                self.write_batches(writer, 1)
+                time.sleep(0.01)  # Distinct modification times
+        names = self.segments()
+        for name in unrelated:
+            self.assertIn(name, names)
+        self.assertEqual(len(names), len(unrelated) + 2)
+
+    def test_gzip(self):
+        with LogWriter(self.path, max_size=100, keep=None, compress=True) as writer:
+            text = self.write_batches(writer, 3)
+        deadline = time.time() + 5
+        while any(not name.endswith('.gz') for name in self.segments()) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.segments()), 2)
+        self.assertTrue(all(name.endswith('.gz') for name in self.segments()))
+        self.assertEqual(self.read_all(), text)
+
+    def test_rotation_failure(self):
+        with LogWriter(self.path, max_size=100, keep=None) as writer:
+            with mock.patch('os.rename', side_effect=PermissionError('in use')):
+                text = self.write_batches(writer, 3)
+            self.assertEqual(self.segments(), [])
+            # Writing continued to the base file, rotation is retried later
+            writer._rotate_after = 0
+            text += self.write_batches(writer, 1)
+        self.assertEqual(len(self.segments()), 1)
+        self.assertEqual(os.path.getsize(self.path), 100)
+        self.assertEqual(self.read_all(), text)
+
+    def test_dropped(self):
+        writer = LogWriter(self.path, max_buffer=10, flush_interval=10)
+        writer.write('0123456789')
+        writer.write('overflow')
+        writer.close()
+        with open(self.path) as f:
+            self.assertEqual(f.read(), '0123456789*** dropped 8 characters of log ***\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from hardwario.chester.logfile import LogWriter
+from hardwario.chester.logindex import LogIndex, parse_log_line
+
+HOST_TIME = '2024-01-01 12:00:{:02d}.{:03d}'
+
+
+def host_time(second, ms=0):
+    return time.mktime(datetime(2024, 1, 1, 12, 0, second).timetuple()) + ms / 1e3
+
+
+def console_line(second, level, module, message):
+    return f'{HOST_TIME.format(second, 0)} # [00:00:{second:02d}.000,000] <{level}> {module}: {message}\n'
+
+
+LINES = [
+    console_line(1, 'inf', 'app', 'Started'),
+    f'{HOST_TIME.format(1, 500)} < status\n',   # Shell line, not indexed
+    console_line(2, 'err', 'lte', 'Attach failed'),
+    console_line(3, 'wrn', 'app', 'Low battery'),
+    console_line(4, 'dbg', 'app', 'Tick'),
+    console_line(5, 'err', 'app', 'Sensor failed'),
+]
+
+
+class TestParseLogLine(unittest.TestCase):
+
+    def test_formats(self):
+        self.assertEqual(parse_log_line('[00:01:02.003,004] <wrn> lte_v2: Message'), (62.003004, 'wrn', 'lte_v2'))
+        self.assertEqual(parse_log_line('#12.5 <E> Message'), (None, 'err', None))
+        self.assertIsNone(parse_log_line('uart:~$ status'))
+
+
+class TestLogIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'console.log')
+        self.index = LogIndex(os.path.join(self.tmp, 'console.db'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmp)
+
+    def add(self, lines):
+        data = ''.join(lines).encode()
+        with open(self.path, 'ab') as f:
+            offset = f.tell()
+            f.write(data)
+        self.index.add(data, self.path, offset)
+
+    def messages(self, **kwargs):
+        return [line.rsplit(': ', 1)[1] for *_, line in self.index.query(**kwargs)]
+
+    def test_query(self):
+        self.add(LINES[:3])
+        self.add(LINES[3:])
+        self.assertEqual(self.messages(), ['Started', 'Attach failed', 'Low battery', 'Tick', 'Sensor failed'])
+        self.assertEqual(self.messages(levels=['err']), ['Attach failed', 'Sensor failed'])
+        self.assertEqual(self.messages(levels=['err', 'wrn'], modules=['app']), ['Low battery', 'Sensor failed'])
+        self.assertEqual(self.messages(since=host_time(2), until=host_time(4)), ['Attach failed', 'Low battery'])
+        self.assertEqual(self.messages(regex='fail', limit=1), ['Attach failed'])
+        self.assertEqual(self.messages(modules=['ble']), [])
+
+    def test_row(self):
+        self.add(LINES[2:3])
+        self.assertEqual(list(self.index.query()), [(host_time(2), 2.0, 'err', 'lte', LINES[2].rstrip('\n'))])
+
+    def test_replaced_segment(self):
+        self.add(LINES)
+        os.remove(self.path)
+        self.index.open_segment(self.path, 0)
+        self.assertEqual(self.messages(), [])
+
+    def test_rotation(self):
+        with LogWriter(self.path, max_size=200, keep=None, compress=True, index=self.index) as writer:
+            for line in LINES:
+                writer.write(line)
+                writer.flush()
+                while writer._queued:
+                    time.sleep(0.001)
+        deadline = time.time() + 5
+        while any(name.endswith('.log') and name != 'console.log' for name in os.listdir(self.tmp)) \
+                and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(any(name.endswith('.log.gz') for name in os.listdir(self.tmp)))
+        # Lines of rotated segments are read by offset from the compressed files
+        self.assertEqual([line + '\n' for *_, line in self.index.query()], [line for line in LINES if ' # ' in line])
+        self.assertEqual(self.messages(levels=['err'], since=host_time(2)), ['Attach failed', 'Sensor failed'])
+
+
+if __name__ == '__main__':
+    unittest.main()
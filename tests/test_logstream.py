@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+from hardwario.chester.logstream import stream_log, FORMAT_JSON
+from hardwario.chester.sim import SimNRFJProg, clear_targets
+from hardwario.chester.utils import Coredump
+
+OLD_CHANNELS = {'app': {'Terminal': {'up': 1024, 'down': 256}}}
+
+
+def collect(dumps):
+    # Coredump is reset after the callback
+    return lambda coredump: dumps.append((coredump.output_path, coredump.size, coredump.has_error))
+
+
+class TestStreamLog(unittest.TestCase):
+
+    def setUp(self):
+        clear_targets()
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.prog.close()
+        clear_targets()
+        shutil.rmtree(self.tmp)
+
+    def open(self, script):
+        self.prog = SimNRFJProg('app', script=dict(script, latency=0))
+        self.prog.open()
+        self.prog.reset()
+
+    def test_missing_channel(self):
+        self.open({'channels': OLD_CHANNELS})
+        with self.assertRaisesRegex(Exception, 'Logger'):
+            stream_log(self.prog, lambda text: None, ['Logger'], duration=0.1)
+
+    def test_old_firmware(self):
+        self.open({'channels': OLD_CHANNELS, 'coredump': {'at': 0.1, 'size': 256}})
+        out = []
+        dumps = []
+        stream_log(self.prog, out.append, fmt=FORMAT_JSON, coredump=Coredump(os.path.join(self.tmp, 'dump.bin')),
+                   duration=0.5, on_coredump=collect(dumps))
+        # Coredump comes in # lines of Terminal, reported and collected as Logger lines
+        self.assertIn('"channel": "Logger", "line": "#CD:BEGIN#"', ''.join(out))
+        self.assertEqual([dump[1:] for dump in dumps], [(256, False)])
+
+    def test_incomplete_coredump(self):
+        self.open({})
+        coredump = Coredump(os.path.join(self.tmp, 'dump.bin'))
+        self.prog.rtt_start()
+        self.prog.target.write_line('Logger', '#CD:BEGIN#')
+        self.prog.target.write_line('Logger', '#CD:0011')
+        dumps = []
+        stream_log(self.prog, lambda text: None, coredump=coredump, duration=0.2, on_coredump=collect(dumps))
+        self.assertEqual([dump[1:] for dump in dumps], [(2, True)])
+        self.assertTrue(dumps[0][0].endswith('.bin.incomplete'))
+        self.assertEqual(os.listdir(self.tmp), [os.path.basename(dumps[0][0])])
+
+
+if __name__ == '__main__':
+    unittest.main()
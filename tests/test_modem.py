@@ -0,0 +1,46 @@
+import unittest
+from hardwario.chester.app import App
+from hardwario.chester.modem import read_modem_info, modem_matches, modem_up_to_date, MODEM_VERSION_COMMAND
+from hardwario.chester.sim import SimNRFJProg, clear_targets
+
+MODEM = {'version': 'mfw_nrf9160_1.3.4', 'uuid': '0b5ab2cd-1a2b-4c3d-9e8f-0123456789ab'}
+
+
+class TestModemQuery(unittest.TestCase):
+    '''Simulated LTE firmware answers AT commands only through the at shell command.'''
+
+    def setUp(self):
+        clear_targets()
+        self.prog = SimNRFJProg('lte', script={'latency': 0, 'modem': MODEM})
+        self.prog.open()
+
+    def tearDown(self):
+        self.prog.close()
+        clear_targets()
+
+    def test_read_modem_info(self):
+        app = App(self.prog, require_logger=False)
+        self.assertEqual(read_modem_info(app), MODEM)
+        self.assertIn('command not found', ' '.join(app.shell(MODEM_VERSION_COMMAND)))
+
+    def test_up_to_date(self):
+        self.prog.target.flash[:8] = bytes(8)
+        self.assertTrue(modem_up_to_date(self.prog, MODEM))
+        self.assertTrue(self.prog.is_opened)
+        self.assertFalse(modem_up_to_date(self.prog, dict(MODEM, uuid='ffffffff-1a2b-4c3d-9e8f-0123456789ab')))
+
+    def test_blank_flash(self):
+        resets = []
+        self.prog.reset = lambda: resets.append(True)
+        self.assertFalse(modem_up_to_date(self.prog, MODEM))
+        self.assertEqual(resets, [])
+
+    def test_modem_matches(self):
+        self.assertTrue(modem_matches(MODEM, {'version': None, 'uuid': MODEM['uuid']}))
+        self.assertFalse(modem_matches(MODEM, dict(MODEM, uuid='other')))
+        self.assertTrue(modem_matches({'version': 'MFW_NRF9160_1.3.4', 'uuid': None}, MODEM))
+        self.assertFalse(modem_matches({'version': None, 'uuid': None}, MODEM))
+
+
+if __name__ == '__main__':
+    unittest.main()
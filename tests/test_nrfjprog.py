@@ -0,0 +1,434 @@
+import os
+import time
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+from pynrfjprog import APIError
+from pynrfjprog.Parameters import VerifyAction
+from hardwario.chester.nrfjprog import NRFJProgException, RTTPoller, RTTPump, page_map, page_runs, image_ranges, \
+    parse_range, VERIFY_FULL, VERIFY_HASH, VERIFY_SAMPLED, VERIFY_NONE
+from hardwario.chester.sim import SimNRFJProg, clear_targets, UICR_ADDRESS
+from .helpers import write_hex
+
+FAST_SCRIPT = {'latency': 0, 'data_rate': 1e12}
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.001)
+    return condition()
+
+
+class SimTestCase(unittest.TestCase):
+
+    SCRIPT = FAST_SCRIPT
+
+    def setUp(self):
+        clear_targets()
+        self.prog = SimNRFJProg('app', script=self.SCRIPT)
+        self.prog.open()
+        self.target = self.prog.target
+        self.page_size = self.target.page_size
+
+    def tearDown(self):
+        self.prog.close()
+        clear_targets()
+
+    def fill_page(self, page, value):
+        start = page * self.page_size
+        self.target.flash[start:start + self.page_size] = bytes([value]) * self.page_size
+
+    def page(self, page):
+        start = page * self.page_size
+        return bytes(self.target.flash[start:start + self.page_size])
+
+    def count_calls(self, name):
+        calls = []
+        method = getattr(self.prog, name)
+
+        def wrapper(*args):
+            calls.append(args)
+            return method(*args)
+
+        setattr(self.prog, name, wrapper)
+        return calls
+
+
+class ImageTestCase(SimTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.progress = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        super().tearDown()
+
+    def image(self, pages, name='app.hex', extra=()):
+        '''Write hex file with random content of pages, returns its path.'''
+        segments = [(page * self.page_size, random.Random(page).randbytes(self.page_size)) for page in pages]
+        path = os.path.join(self.tmp, name)
+        write_hex(path, segments + list(extra))
+        return path
+
+
+class TestEraseFlash(SimTestCase):
+
+    def test_whole_flash_chip_erase(self):
+        for page in range(0, 40, 3):
+            self.fill_page(page, 0x55)
+        uicr = bytes(range(128))
+        self.prog.write_uicr(uicr)
+        erased = self.count_calls('erase_page')
+        reads = self.count_calls('read')
+        self.prog.erase_flash()
+        self.assertEqual(erased, [])
+        self.assertEqual(bytes(self.target.flash), b'\xff' * self.target.code_size)
+        self.assertEqual(self.prog.read_uicr(), uicr)
+        # No blank check read back of code flash
+        self.assertTrue(all(address >= self.target.code_size for address, _ in reads))
+
+    def test_whole_flash_blank_check_few_pages(self):
+        self.fill_page(1, 0x11)
+        self.fill_page(7, 0x22)
+        erased = self.count_calls('erase_page')
+        self.prog.erase_flash(skip_blank=True)
+        self.assertEqual(erased, [(1 * self.page_size,), (7 * self.page_size,)])
+        self.assertEqual(self.page(1), b'\xff' * self.page_size)
+        self.assertEqual(self.page(7), b'\xff' * self.page_size)
+
+    def test_whole_flash_all_blank(self):
+        erased = self.count_calls('erase_page')
+        chip = self.count_calls('erase_all')
+        self.prog.erase_flash(skip_blank=True)
+        self.assertEqual(erased, [])
+        self.assertEqual(chip, [])
+
+    def test_range_skips_blank(self):
+        for page in (2, 5, 9):
+            self.fill_page(page, 0x33)
+        erased = self.count_calls('erase_page')
+        self.prog.erase_flash([(self.page_size + 1, 8 * self.page_size)])
+        self.assertEqual(erased, [(2 * self.page_size,), (5 * self.page_size,)])
+        self.assertEqual(self.page(2), b'\xff' * self.page_size)
+        self.assertEqual(self.page(9), b'\x33' * self.page_size)
+
+    def test_range_no_blank_check(self):
+        erased = self.count_calls('erase_page')
+        self.prog.erase_flash([(0, 3 * self.page_size)], skip_blank=False)
+        self.assertEqual(len(erased), 3)
+
+    def test_range_outside(self):
+        with self.assertRaises(NRFJProgException):
+            self.prog.erase_flash([(0, self.target.code_size + 1)])
+        with self.assertRaises(NRFJProgException):
+            self.prog.erase_flash([(self.page_size, self.page_size)])
+
+
+class TestPageHelpers(unittest.TestCase):
+
+    def test_page_map(self):
+        pages = page_map([(0x0ffe, b'\x01\x02\x03\x04'), (0x1010, b'\x05')], 0x1000)
+        self.assertEqual(sorted(pages), [0x0000, 0x1000])
+        self.assertEqual(bytes(pages[0x0000]), b'\xff' * 0xffe + b'\x01\x02')
+        self.assertEqual(bytes(pages[0x1000]), b'\x03\x04' + b'\xff' * 14 + b'\x05' + b'\xff' * (0x1000 - 17))
+
+    def test_page_runs(self):
+        addresses = [0x0000, 0x1000, 0x2000, 0x5000, 0x6000, 0x9000]
+        self.assertEqual(list(page_runs(addresses, 0x1000)), [(0x0000, 3), (0x5000, 2), (0x9000, 1)])
+        self.assertEqual(list(page_runs(addresses, 0x1000, max_pages=2)),
+                         [(0x0000, 2), (0x2000, 1), (0x5000, 2), (0x9000, 1)])
+        self.assertEqual(list(page_runs([], 0x1000)), [])
+
+    def test_image_ranges(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'app.hex')
+            write_hex(path, [(0x2000, b'\x00' * 16), (0x0, b'\x00' * 32), (0x20, b'\x00' * 8), (0x10008, b'\x00')])
+            self.assertEqual(image_ranges(path), [(0x0, 0x28), (0x2000, 0x2010), (0x10008, 0x10009)])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range('0x1000-0x3000'), (0x1000, 0x3000))
+        self.assertEqual(parse_range('0x1000+0x2000'), (0x1000, 0x3000))
+        self.assertEqual(parse_range('4096+4096'), (4096, 8192))
+        for text in ('0x1000', '0x1000-end', 'abc+1'):
+            with self.assertRaises(NRFJProgException):
+                parse_range(text)
+
+
+class TestProgramDiff(ImageTestCase):
+
+    def test_blank_target(self):
+        path = self.image([0, 1, 4])
+        erased = self.count_calls('erase_page')
+        self.prog.program(path, progress=self.progress.append, diff=True)
+        self.assertEqual(erased, [(0,), (self.page_size,), (4 * self.page_size,)])
+        self.assertEqual(self.page(4), random.Random(4).randbytes(self.page_size))
+
+    def test_changed_pages_only(self):
+        self.prog.program(self.image([0, 1, 2, 3]), diff=True)
+        path = self.image([0, 1, 2, 3])
+        self.fill_page(2, 0x00)  # Differs from the image
+        erased = self.count_calls('erase_page')
+        writes = self.count_calls('write')
+        self.prog.program(path, progress=self.progress.append, diff=True)
+        self.assertEqual(erased, [(2 * self.page_size,)])
+        self.assertEqual([(address, len(data)) for address, data, _ in writes], [(2 * self.page_size, self.page_size)])
+        self.assertEqual(self.page(2), random.Random(2).randbytes(self.page_size))
+
+    def test_up_to_date(self):
+        path = self.image([0, 1])
+        self.prog.program(path, diff=True)
+        erased = self.count_calls('erase_page')
+        writes = self.count_calls('write')
+        self.prog.program(path, progress=self.progress.append, diff=True)
+        self.assertEqual((erased, writes), ([], []))
+        self.assertIn('Up to date, skipped', self.progress)
+
+    def fallback(self, path):
+        erased = self.count_calls('erase_page')
+        files = self.count_calls('program_file')
+        self.prog.program(path, progress=self.progress.append, diff=True)
+        self.assertEqual((erased, files), ([], [(path,)]))
+        self.assertNotIn('Comparing...', self.progress)
+
+    def test_fallback_not_hex(self):
+        self.fallback(self.image([0], name='app.ihex'))
+        self.assertEqual(self.page(0), random.Random(0).randbytes(self.page_size))
+
+    def test_fallback_uicr(self):
+        path = self.image([0], extra=[(UICR_ADDRESS, b'\x00\x11\x22\x33')])
+        self.fallback(path)
+        self.assertEqual(bytes(self.target.uicr[:4]), b'\x00\x11\x22\x33')
+
+
+class TestVerify(ImageTestCase):
+
+    PAGES = range(18)
+
+    def setUp(self):
+        super().setUp()
+        self.path = self.image(self.PAGES)
+        self.prog.program(self.path, verify=VERIFY_NONE)
+
+    def verify(self, mode):
+        self.progress = []
+        self.prog._verify(self.path, mode, self.progress.append)
+
+    def test_none(self):
+        self.fill_page(0, 0x00)
+        reads = self.count_calls('read')
+        self.verify(VERIFY_NONE)
+        self.assertEqual(reads, [])
+        self.assertEqual(self.progress, ['Verifying skipped (none)'])
+
+    def test_full(self):
+        files = self.count_calls('verify_file')
+        self.verify(VERIFY_FULL)
+        self.assertEqual(files, [(self.path, VerifyAction.VERIFY_READ)])
+        self.target.flash[5 * self.page_size + 100] ^= 0x01
+        with self.assertRaises(APIError.APIError):
+            self.verify(VERIFY_FULL)
+
+    def test_hash(self):
+        files = self.count_calls('verify_file')
+        self.verify(VERIFY_HASH)
+        self.assertEqual(files, [(self.path, VerifyAction.VERIFY_HASH)])
+
+    def test_sampled(self):
+        reads = self.count_calls('read')
+        self.verify(VERIFY_SAMPLED)
+        # First, last and (18 - 2) // 8 random pages
+        self.assertEqual(sum(length for _, length in reads), 4 * self.page_size)
+        self.assertIn(0, [address for address, _ in reads])
+
+    def test_sampled_corrupted(self):
+        for page in (0, 17):
+            with self.subTest(page=page):
+                # First and last page are always verified
+                self.target.flash[page * self.page_size] ^= 0x01
+                with self.assertRaisesRegex(NRFJProgException, 'Verification failed'):
+                    self.verify(VERIFY_SAMPLED)
+                self.target.flash[page * self.page_size] ^= 0x01
+        for page in range(1, 17):
+            self.target.flash[page * self.page_size + 7] ^= 0x01
+        with self.assertRaisesRegex(NRFJProgException, 'Verification failed'):
+            self.verify(VERIFY_SAMPLED)
+
+    def test_sampled_diff_changed_only(self):
+        self.fill_page(3, 0x00)
+        self.fill_page(9, 0x00)
+        reads = self.count_calls('read')
+        self.prog.program(self.path, diff=True, verify=VERIFY_SAMPLED)
+        # Comparison reads whole image, verification only the two changed pages
+        self.assertEqual(reads[-2:], [(3 * self.page_size, self.page_size), (9 * self.page_size, self.page_size)])
+
+    def test_unknown_mode(self):
+        with self.assertRaises(NRFJProgException):
+            self.prog.program(self.path, verify='fast')
+
+
+class TestRTTPoller(unittest.TestCase):
+
+    def test_backoff(self):
+        poller = RTTPoller(max_delay=0.05, min_delay=0.001)
+        delays = [poller.update(False) for _ in range(8)]
+        self.assertEqual(delays, [0.001, 0.002, 0.004, 0.008, 0.016, 0.032, 0.05, 0.05])
+        # Data resets to immediate polling and backoff starts again from min_delay
+        self.assertEqual(poller.update(True), 0)
+        self.assertEqual(poller.update(False), 0.001)
+        poller.reset()
+        self.assertEqual(poller.delay, 0)
+
+    def test_min_over_max(self):
+        poller = RTTPoller(max_delay=0.001, min_delay=0.01)
+        self.assertEqual([poller.update(False) for _ in range(3)], [0.001] * 3)
+
+    def test_wait_timeout(self):
+        poller = RTTPoller(max_delay=10, min_delay=10)
+        start = time.time()
+        poller.wait(False, start + 0.05)
+        self.assertLess(time.time() - start, 1)
+        poller.wait(False, start)  # Timeout passed, does not sleep
+        self.assertLess(time.time() - start, 1)
+
+
+class TestRTTReader(SimTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.prog.rtt_start()
+        self.reader = self.prog.rtt_reader('Terminal')
+
+    def push(self, data):
+        self.target.channel('Terminal').push(data)
+
+    def test_split_chunks(self):
+        self.push(b'hel')
+        self.assertEqual(self.reader.readlines(), [])
+        self.push(b'lo\r')
+        self.assertEqual(self.reader.readlines(), [])
+        self.push(b'\nwor')
+        self.assertEqual(self.reader.readlines(), ['hello'])
+        self.push(b'ld\n\r\n')
+        self.assertEqual(self.reader.readlines(), ['world', ''])
+        self.assertEqual(len(self.reader), 0)
+
+    def test_split_character(self):
+        data = 'příliš\n'.encode()
+        self.push(data[:2])
+        self.assertEqual(self.reader.readlines(), [])
+        self.push(data[2:])
+        self.assertEqual(self.reader.readlines(), ['příliš'])
+
+    def test_keepends(self):
+        self.push(b'one\r\ntwo\nthree')
+        self.assertEqual(self.reader.readlines(keepends=True), ['one\r\n', 'two\n'])
+        self.assertEqual(len(self.reader), len('three'))
+
+    def test_readline(self):
+        self.push(b'first\nsec')
+        self.assertEqual(self.reader.readline(), 'first')
+        # Partial line is not returned on timeout and stays buffered
+        self.assertIsNone(self.reader.readline(timeout=0.05))
+        timer = threading.Timer(0.05, self.push, (b'ond\r\n',))
+        timer.start()
+        self.assertEqual(self.reader.readline(timeout=5), 'second')
+        timer.join()
+
+    def test_read(self):
+        self.push(b'line\npartial')
+        self.assertEqual(self.reader.readline(), 'line')
+        self.push(b' more')
+        self.assertEqual(self.reader.read(), b'partial more')
+        self.assertEqual(len(self.reader), 0)
+        self.assertEqual(self.reader.readlines(), [])
+
+    def test_compact(self):
+        self.reader.COMPACT_SIZE = 16
+        self.push(b''.join(b'line %04d\n' % i for i in range(5)) + b'tail')
+        self.assertEqual(self.reader.readlines(), [f'line {i:04d}' for i in range(5)])
+        # Consumed lines are dropped from the buffer, partial line moves to its start
+        self.assertEqual((bytes(self.reader._buffer), self.reader._offset), (b'tail', 0))
+        self.push(b' end\n')
+        self.assertEqual(self.reader.readlines(), ['tail end'])
+        self.assertEqual((len(self.reader._buffer), self.reader._offset, self.reader._scan), (0, 0, 0))
+
+
+class TestRTTPump(SimTestCase):
+
+    SCRIPT = dict(FAST_SCRIPT, shell_delay=0, shell={'one': 'ONE', 'two': 'TWO', 'three': 'THREE'})
+
+    def setUp(self):
+        super().setUp()
+        self.prog.rtt_start()
+        self.wakes = 0
+        self.items = []
+
+    def tearDown(self):
+        self.pump.stop()
+        super().tearDown()
+
+    def wake(self):
+        self.wakes += 1
+
+    def start(self, process=lambda channel, data, lines: [(channel, line) for line in lines]):
+        self.pump = RTTPump(self.prog, ('Terminal', 'Logger'), process, self.wake)
+        self.pump.start()
+
+    def drain(self, count):
+        self.assertTrue(wait_for(lambda: self.items.extend(self.pump.drain()) or len(self.items) >= count))
+        return self.items
+
+    def test_write_order(self):
+        self.start()
+        for command in ('one', 'two', 'three'):
+            self.pump.write('Terminal', command + '\n')
+        self.assertEqual(self.drain(3), [('Terminal', 'ONE\r\n'), ('Terminal', 'TWO\r\n'), ('Terminal', 'THREE\r\n')])
+
+    def test_wake_once(self):
+        self.start()
+        for i in range(3):
+            self.target.write_line('Logger', f'line {i}')
+            self.assertTrue(wait_for(lambda: len(self.pump._queue) == i + 1))
+        # Queue was not drained in between, UI is woken only for the first batch
+        self.assertEqual(self.wakes, 1)
+        self.assertEqual(len(self.pump.drain()), 3)
+        self.target.write_line('Logger', 'line 3')
+        self.assertTrue(wait_for(lambda: self.wakes == 2))
+        self.assertEqual(self.pump.drain(), [('Logger', 'line 3\r\n')])
+
+    def test_process_error(self):
+        def process(channel, data, lines):
+            raise ValueError('bad data')
+
+        self.start(process)
+        self.target.write_line('Terminal', 'line')
+        self.pump._thread.join(5)
+        self.assertFalse(self.pump._thread.is_alive())
+        self.assertIsInstance(self.pump.exception, ValueError)
+        self.assertEqual((self.wakes, self.pump.drain()), (1, []))
+
+    def test_probe_error(self):
+        self.prog._target = None  # Probe disconnected
+        self.start()
+        self.pump._thread.join(5)
+        self.assertIsInstance(self.pump.exception, NRFJProgException)
+        self.assertEqual(self.wakes, 1)
+
+    def test_rtt_stop(self):
+        self.start()
+        self.prog.rtt_stop()
+        self.pump._thread.join(5)
+        self.assertFalse(self.pump._thread.is_alive())
+        self.assertIsNone(self.pump.exception)
+
+
+if __name__ == '__main__':
+    unittest.main()
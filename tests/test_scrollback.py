@@ -0,0 +1,169 @@
+import unittest
+from prompt_toolkit.buffer import Buffer
+from hardwario.chester.scrollback import Scrollback, LogScrollback, ScrollbackException, _Lines, parse_scrollback, \
+    MAX_LINE_LENGTH
+
+
+def log_line(level, module, i):
+    return f'[00:00:{i:02d}.000,000] <{level}> {module}: Message {i}\n'
+
+
+class TestParseScrollback(unittest.TestCase):
+
+    def test_values(self):
+        self.assertEqual(parse_scrollback('10000'), (10000, None))
+        self.assertEqual(parse_scrollback(' 500 '), (500, None))
+        self.assertEqual(parse_scrollback('64k'), (None, 64 * 1024))
+        self.assertEqual(parse_scrollback('2MB'), (None, 2 * 1024 * 1024))
+        self.assertEqual(parse_scrollback('100b'), (None, 100))
+
+    def test_invalid(self):
+        for value in ('', '0', '10x', '-5', '1.5M'):
+            with self.assertRaises(ScrollbackException):
+                parse_scrollback(value)
+
+
+class TestLines(unittest.TestCase):
+
+    def test_popleft_across_chunks(self):
+        lines = _Lines()
+        lines.append('a\nbb\n', [2, 3])
+        lines.append('ccc\n', [4])
+        self.assertEqual((len(lines), lines.size), (3, 9))
+        self.assertEqual(lines.popleft(), 2)
+        self.assertEqual(lines.text(), 'bb\nccc\n')
+        # Chunks are joined once by text()
+        self.assertEqual(list(lines._chunks), ['bb\nccc\n'])
+        self.assertEqual(lines.popleft(), 3)
+        self.assertEqual(lines.popleft(), 4)
+        self.assertEqual((len(lines), lines.size, lines.text()), (0, 0, ''))
+
+
+class TestScrollback(unittest.TestCase):
+
+    def setUp(self):
+        self.buffer = Buffer(read_only=True)
+
+    def lines(self, start, end):
+        return ''.join(f'line {i}\n' for i in range(start, end))
+
+    def test_max_lines(self):
+        scrollback = Scrollback(self.buffer, max_lines=3)
+        scrollback.append(self.lines(0, 2))
+        scrollback.append(self.lines(2, 5) + 'partial')
+        self.assertTrue(scrollback.refresh())
+        self.assertEqual(self.buffer.text, self.lines(2, 5) + 'partial')
+        self.assertEqual(scrollback.evicted, 2)
+        self.assertFalse(scrollback.refresh())  # Nothing queued
+
+    def test_max_bytes(self):
+        scrollback = Scrollback(self.buffer, max_bytes=20)
+        scrollback.append(self.lines(0, 4))
+        scrollback.refresh()
+        # Partial line counts to the limit too
+        self.assertEqual(self.buffer.text, self.lines(2, 4))
+        scrollback.append('partial')
+        scrollback.refresh()
+        self.assertEqual(self.buffer.text, self.lines(3, 4) + 'partial')
+        self.assertEqual(scrollback.evicted, 3)
+
+    def test_partial_cap(self):
+        scrollback = Scrollback(self.buffer)
+        scrollback.append('x' * MAX_LINE_LENGTH + 'tail')
+        scrollback.refresh()
+        self.assertEqual(len(self.buffer.text), MAX_LINE_LENGTH)
+        self.assertTrue(self.buffer.text.endswith('xtail'))
+        scrollback.append('\n')
+        scrollback.refresh()
+        self.assertEqual(len(self.buffer.text), MAX_LINE_LENGTH + 1)
+
+        scrollback = Scrollback(Buffer(read_only=True), max_bytes=10)
+        scrollback.append('0123456789abc')
+        scrollback.refresh()
+        self.assertEqual(scrollback.text, '3456789abc')
+
+    def test_cursor_kept(self):
+        scrollback = Scrollback(self.buffer, max_lines=4)
+        scrollback.append(self.lines(0, 4))
+        scrollback.refresh()
+        self.buffer.cursor_position = self.buffer.text.index('line 2')
+        scrollback.append(self.lines(4, 6))
+        scrollback.refresh(scroll_to_end=False)
+        # Cursor stays on the same line after eviction of the two oldest lines
+        self.assertEqual(self.buffer.text, self.lines(2, 6))
+        self.assertEqual(self.buffer.cursor_position, 0)
+        scrollback.append(self.lines(6, 7))
+        scrollback.refresh()
+        self.assertEqual(self.buffer.cursor_position, len(self.buffer.text))
+
+    def test_cursor_evicted(self):
+        scrollback = Scrollback(self.buffer, max_lines=2)
+        scrollback.append(self.lines(0, 2))
+        scrollback.refresh()
+        self.buffer.cursor_position = self.buffer.text.index('line 1')
+        scrollback.append(self.lines(2, 5))
+        scrollback.refresh(scroll_to_end=False)
+        # Line of cursor was evicted, cursor moves to the start
+        self.assertEqual(self.buffer.cursor_position, 0)
+
+    def test_clear(self):
+        scrollback = Scrollback(self.buffer)
+        scrollback.append(self.lines(0, 3) + 'partial')
+        scrollback.refresh()
+        scrollback.clear()
+        self.assertEqual((self.buffer.text, scrollback.text, scrollback.evicted), ('', '', 3))
+
+
+class TestLogScrollback(unittest.TestCase):
+
+    def setUp(self):
+        self.buffer = Buffer(read_only=True)
+
+    def test_filter(self):
+        scrollback = LogScrollback(self.buffer)
+        scrollback.append(log_line('inf', 'app', 1) + log_line('err', 'lte', 2) + log_line('dbg', 'app', 3))
+        scrollback.set_filter(level='inf')
+        scrollback.refresh()
+        self.assertEqual(self.buffer.text, log_line('inf', 'app', 1) + log_line('err', 'lte', 2))
+        self.assertEqual((scrollback.shown, scrollback.hidden), (2, 1))
+        scrollback.set_filter(level=None, regex='Message 3')
+        scrollback.refresh()
+        self.assertEqual(self.buffer.text, log_line('dbg', 'app', 3))
+        scrollback.set_filter(regex=None)
+        scrollback.refresh()
+        self.assertFalse(scrollback.filtering)
+        self.assertEqual(scrollback.shown, 3)
+
+    def test_filtered_partial_line(self):
+        scrollback = LogScrollback(self.buffer)
+        scrollback.set_filter(level='wrn')
+        scrollback.append(log_line('err', 'app', 1) + '[00:00:02.000,000] <err> app: Half')
+        scrollback.refresh()
+        self.assertEqual(self.buffer.text, log_line('err', 'app', 1) + '[00:00:02.000,000] <err> app: Half')
+        scrollback.append(' done\n[00:00:03.000,000] <inf> app: Hidden')
+        scrollback.refresh()
+        self.assertEqual(self.buffer.text, log_line('err', 'app', 1) + '[00:00:02.000,000] <err> app: Half done\n')
+
+    def test_filtered_eviction(self):
+        scrollback = LogScrollback(self.buffer, max_lines=4)
+        scrollback.set_filter(modules=['app'])
+        scrollback.append(''.join(log_line('inf', 'app' if i % 2 else 'lte', i) for i in range(4)))
+        scrollback.refresh()
+        # Cursor on the last shown line stays on it after the first shown line is evicted
+        self.buffer.cursor_position = self.buffer.text.index('Message 3')
+        scrollback.append(log_line('inf', 'lte', 4) + log_line('inf', 'lte', 5))
+        scrollback.refresh(scroll_to_end=False)
+        self.assertEqual(self.buffer.text, log_line('inf', 'app', 3))
+        self.assertEqual(self.buffer.text[self.buffer.cursor_position:], 'Message 3\n')
+        self.assertEqual(scrollback._evicted_chars, 0)
+
+        scrollback.set_filter(modules=None)
+        scrollback.refresh()
+        self.buffer.cursor_position = self.buffer.text.index('Message 5')
+        scrollback.append(log_line('inf', 'app', 6))
+        scrollback.refresh(scroll_to_end=False)
+        self.assertEqual(self.buffer.text[self.buffer.cursor_position:], 'Message 5\n' + log_line('inf', 'app', 6))
+
+
+if __name__ == '__main__':
+    unittest.main()
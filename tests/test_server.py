@@ -0,0 +1,98 @@
+import time
+import threading
+import unittest
+from http.server import ThreadingHTTPServer
+from hardwario.chester.nrfjprog import BACKEND_SIM
+from hardwario.chester.server import Server, ProbeSession, RequestHandler, ServerException, request, parse_address
+from hardwario.chester.sim import clear_targets
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        clear_targets()
+        self.server = Server(BACKEND_SIM)
+
+    def tearDown(self):
+        self.server.close()
+        clear_targets()
+
+    def test_one_session_per_probe(self):
+        execute = ProbeSession._execute
+        state = {'active': 0, 'max': 0}
+        lock = threading.Lock()
+
+        def tracked(session, job):
+            with lock:
+                state['active'] += 1
+                state['max'] = max(state['max'], state['active'])
+            try:
+                time.sleep(0.02)
+                return execute(session, job)
+            finally:
+                with lock:
+                    state['active'] -= 1
+
+        ProbeSession._execute = tracked
+        try:
+            results = []
+            threads = [threading.Thread(target=lambda mcu=mcu: results.append(
+                self.server.submit({'op': 'uicr_read', 'mcu': mcu, 'jlink_sn': 1}))) for mcu in ('app', 'lte') * 4]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            ProbeSession._execute = execute
+
+        self.assertEqual(state['max'], 1)
+        self.assertTrue(all(r['ok'] for r in results))
+        status = self.server.status()
+        self.assertEqual(len(status), 1)
+        self.assertEqual(status[0]['jlink_sn'], 1)
+        self.assertEqual(status[0]['jobs'], 8)
+
+    def test_switch_mcu(self):
+        data = bytes(range(128))
+        self.assertTrue(self.server.submit({'op': 'uicr_write', 'mcu': 'app', 'jlink_sn': 1, 'data': data.hex()})['ok'])
+        self.assertNotEqual(self.server.submit({'op': 'uicr_read', 'mcu': 'lte', 'jlink_sn': 1})['result'], data.hex())
+        self.assertEqual(self.server.submit({'op': 'uicr_read', 'mcu': 'app', 'jlink_sn': 1})['result'], data.hex())
+        self.assertEqual(self.server.status()[0]['mcu'], 'app')
+
+    def test_relative_file(self):
+        result = self.server.submit({'op': 'flash', 'jlink_sn': 1, 'file': 'fw.hex'})
+        self.assertFalse(result['ok'])
+        self.assertIn('absolute', result['error'])
+
+    def test_unknown_op(self):
+        with self.assertRaises(ServerException):
+            self.server.submit({'op': 'format'})
+
+    def test_status_http(self):
+        httpd = ThreadingHTTPServer(('127.0.0.1', 0), RequestHandler)
+        httpd.chester = self.server
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        address = f'127.0.0.1:{httpd.server_address[1]}'
+        try:
+            self.assertTrue(request(address, 'POST', '/jobs', {'op': 'uicr_read', 'jlink_sn': 2})['ok'])
+            self.assertFalse(request(address, 'POST', '/jobs', {'op': 'flash', 'jlink_sn': 2, 'file': 'fw.hex'})['ok'])
+            self.assertIn('error', request(address, 'POST', '/jobs', {'op': 'format'}))
+            sessions = request(address, 'GET', '/status')['sessions']
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+        self.assertEqual(len(sessions), 1)
+        self.assertEqual(sessions[0]['jobs'], 2)
+        self.assertEqual(sessions[0]['failed'], 1)
+        self.assertEqual(sessions[0]['queued'], 0)
+
+    def test_parse_address(self):
+        self.assertEqual(parse_address('unix:/tmp/s'), ('unix', '/tmp/s'))
+        self.assertEqual(parse_address(':8470'), ('tcp', ('127.0.0.1', 8470)))
+        with self.assertRaises(ServerException):
+            parse_address('localhost')
+
+
+if __name__ == '__main__':
+    unittest.main()
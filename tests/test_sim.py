@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pynrfjprog import APIError
+from hardwario.chester.app import App
+from hardwario.chester.pib import PIB
+from hardwario.chester.sim import SimNRFJProg, clear_targets, UICR_ADDRESS, UICR_SIZE
+from .helpers import write_hex
+from .test_nrfjprog import SimTestCase, FAST_SCRIPT
+
+
+class TestSimMemory(SimTestCase):
+
+    def test_regions(self):
+        self.assertEqual(self.prog.get_code_region(), (self.target.code_size, self.page_size))
+        self.assertEqual(self.prog.get_uicr_region(), (UICR_ADDRESS, UICR_SIZE))
+
+    def test_write_read(self):
+        self.prog.write(0x1010, b'\x01\x02\x03\x04', True)
+        self.assertEqual(bytes(self.prog.read(0x100e, 8)), b'\xff\xff\x01\x02\x03\x04\xff\xff')
+
+    def test_write_only_clears_bits(self):
+        self.prog.write(0x1000, b'\x0f\xf0', True)
+        self.prog.write(0x1000, b'\xf3\x3f', True)
+        self.assertEqual(bytes(self.prog.read(0x1000, 2)), b'\x03\x30')
+        self.prog.erase_page(0x1000)
+        self.prog.write(0x1000, b'\xf3\x3f', True)
+        self.assertEqual(bytes(self.prog.read(0x1000, 2)), b'\xf3\x3f')
+
+    def test_erase_page(self):
+        for page in range(3):
+            self.fill_page(page, 0x00)
+        # Any address inside the page erases the whole page and only it
+        self.prog.erase_page(self.page_size + 0x123)
+        self.assertEqual(self.page(0), b'\x00' * self.page_size)
+        self.assertEqual(self.page(1), b'\xff' * self.page_size)
+        self.assertEqual(self.page(2), b'\x00' * self.page_size)
+
+    def test_erase_all(self):
+        self.fill_page(5, 0x00)
+        self.prog.write(UICR_ADDRESS, b'\x00' * 4, True)
+        self.prog.erase_all()
+        self.assertEqual(bytes(self.target.flash), b'\xff' * self.target.code_size)
+        self.assertEqual(bytes(self.target.uicr), b'\xff' * UICR_SIZE)
+
+    def test_uicr(self):
+        self.fill_page(0, 0x00)
+        buffer = bytes(range(128))
+        self.prog.write_uicr(buffer)
+        self.assertEqual(self.prog.read_uicr(), buffer)
+        self.prog.erase_uicr()
+        self.assertEqual(bytes(self.target.uicr), b'\xff' * UICR_SIZE)
+        self.assertEqual(self.page(0), b'\x00' * self.page_size)
+
+    def test_pib(self):
+        pib = PIB(self.prog.read_uicr())
+        self.assertEqual(pib.get_serial_number(), '2159000001')
+        self.assertEqual(pib.get_product_name(), 'CHESTER-M')
+
+    def test_out_of_range(self):
+        with self.assertRaises(APIError.APIError):
+            self.prog.read(self.target.code_size, 4)
+        with self.assertRaises(APIError.APIError):
+            self.prog.write(self.target.code_size, b'\x00', True)
+
+    def test_program_hex(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'app.hex')
+            segments = [(0x0, bytes(range(64))), (0x11000, b'\xa5' * 40)]
+            write_hex(path, segments)
+            self.fill_page(0x11, 0x00)  # Programming erases pages of the image
+            self.prog.program(path)
+            for address, data in segments:
+                self.assertEqual(bytes(self.prog.read(address, len(data))), data)
+            self.assertEqual(self.page(0x11)[40:], b'\xff' * (self.page_size - 40))
+        finally:
+            shutil.rmtree(tmp)
+
+
+class TestSimFs(unittest.TestCase):
+
+    def setUp(self):
+        clear_targets()
+        self.prog = SimNRFJProg('app', script=dict(FAST_SCRIPT, shell_delay=0))
+        self.prog.open()
+        self.app = App(self.prog)
+
+    def tearDown(self):
+        self.prog.close()
+        clear_targets()
+
+    def test_fs(self):
+        files = self.prog.target.files
+        self.app.fs_mkdir('/lfs1/dir')
+        with self.assertRaisesRegex(Exception, '-17'):
+            self.app.fs_mkdir('/lfs1/dir')
+        files['/lfs1/dir/a.txt'] = bytearray(b'hello')
+        self.assertEqual(self.app.fs_ls('/lfs1'), ['dir/'])
+        self.assertEqual(self.app.fs_ls('/lfs1/dir'), ['a.txt'])
+        self.assertEqual(self.app.fs_file_size('/lfs1/dir/a.txt'), 5)
+        # Directory with file is not removed
+        with self.assertRaisesRegex(Exception, 'Failed to remove'):
+            self.app.fs_rm('/lfs1/dir')
+        self.assertIn('/lfs1/dir', self.prog.target.dirs)
+        self.app.fs_rm('/lfs1/dir/a.txt')
+        self.app.fs_rm('/lfs1/dir')
+        self.assertEqual(self.app.fs_ls('/lfs1'), [])
+        self.assertEqual(files, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import os
+import time
+import random
+import shutil
+import socket
+import threading
+import tempfile
+import unittest
+from hardwario.chester.trace import SegmentedFileSink, FileSink, TraceServer, extract_trace, read_trace_index, \
+    COMPRESS_NONE, COMPRESS_GZIP, COMPRESS_LZMA
+
+
+def chunk(i, size=1000):
+    # Incompressible, so segments of compressed capture rotate by size too
+    return random.Random(i).getrandbits(size * 8).to_bytes(size, 'little')
+
+
+class TestSegmentedFileSink(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'trace.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def capture(self, count, **kwargs):
+        sink = SegmentedFileSink(self.path, index_interval=0, **kwargs)
+        sink.start()
+        data = b''
+        for i in range(count):
+            sink.put(chunk(i))
+            data += chunk(i)
+            while sink.queued:  # Separate writes, each block gets own index entry
+                time.sleep(0.001)
+        sink.close()
+        self.assertEqual((sink.written, sink.dropped, sink.errors), (len(data), 0, 0))
+        return data
+
+    def files(self):
+        return sorted(os.listdir(self.tmp))
+
+    def test_round_trip(self):
+        for compress in (COMPRESS_NONE, COMPRESS_GZIP, COMPRESS_LZMA):
+            with self.subTest(compress=compress):
+                data = self.capture(20, compress=compress, rotate_size=4096)
+                self.assertGreater(len(self.files()), 2)
+                self.assertEqual(b''.join(extract_trace(self.path + '.index')), data)
+                shutil.rmtree(self.tmp)
+                os.mkdir(self.tmp)
+
+    def test_single_compressed_segment(self):
+        data = self.capture(5, compress=COMPRESS_GZIP)
+        self.assertEqual(self.files(), ['trace.0001.bin.gz', 'trace.bin.index'])
+        self.assertEqual(b''.join(extract_trace(self.path + '.index')), data)
+
+    def test_time_window(self):
+        data = self.capture(10, compress=COMPRESS_GZIP, rotate_size=3000)
+        entries = read_trace_index(self.path + '.index')
+        self.assertEqual(len(entries), 10)
+        self.assertEqual([e['position'] for e in entries], list(range(0, len(data), 1000)))
+        window = b''.join(extract_trace(self.path + '.index', entries[3]['time'], entries[6]['time']))
+        self.assertEqual(window, data[3000:6000])
+
+    def test_keep(self):
+        data = self.capture(20, compress=COMPRESS_LZMA, rotate_size=2500, keep=2)
+        segments = [name for name in self.files() if not name.endswith('.index')]
+        self.assertEqual(len(segments), 2)
+        entries = read_trace_index(self.path + '.index')
+        # Index is rewritten without entries of removed segments
+        self.assertEqual(sorted({e['segment'] for e in entries}), segments)
+        extracted = b''.join(extract_trace(self.path + '.index'))
+        self.assertEqual(extracted, data[entries[0]['position']:])
+        self.assertEqual(len(extracted), sum(1000 for _ in entries))
+
+
+class TestFileSink(unittest.TestCase):
+
+    def test_drop_over_buffer(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'trace.bin')
+            sink = FileSink(path, max_buffer=1500)
+            self.assertTrue(sink.put(chunk(1)))
+            self.assertFalse(sink.put(chunk(2)))  # Writer thread is not started, queue is full
+            sink.start()
+            sink.close()
+            self.assertEqual((sink.written, sink.dropped), (1000, 1000))
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), chunk(1))
+        finally:
+            shutil.rmtree(tmp)
+
+
+class TestTraceServer(unittest.TestCase):
+
+    def setUp(self):
+        self.sockets = []
+
+    def tearDown(self):
+        self.server.close()
+        for sock in self.sockets:
+            sock.close()
+
+    def start(self, **kwargs):
+        self.server = TraceServer('127.0.0.1', 0, **kwargs)
+        self.server.start()
+
+    def connect(self, rcvbuf=None):
+        sock = socket.socket()
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        sock.connect(self.server.address)
+        self.sockets.append(sock)
+        count = len(self.sockets)
+        deadline = time.time() + 5
+        while len(self.server.clients) < count and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(len(self.server.clients), count)
+        return sock
+
+    def receive(self, sock, size):
+        sock.settimeout(5)
+        data = b''
+        while len(data) < size:
+            received = sock.recv(size - len(data))
+            if not received:
+                break
+            data += received
+        return data
+
+    def test_backlog(self):
+        self.start(backlog=2500)
+        for i in range(5):
+            self.server.put(chunk(i))
+        sock = self.connect()
+        self.server.put(chunk(5))
+        # Whole recent chunks covering the backlog are replayed first
+        self.assertEqual(self.receive(sock, 4000), b''.join(chunk(i) for i in range(2, 6)))
+
+    def test_no_backlog(self):
+        self.start(backlog=0)
+        self.server.put(chunk(0))
+        sock = self.connect()
+        self.server.put(chunk(1))
+        self.assertEqual(self.receive(sock, 1000), chunk(1))
+
+    def test_stalled_client(self):
+        self.start(backlog=0, max_buffer=256 * 1024)
+        self.connect(rcvbuf=4096)  # Never reads
+        fast = self.connect()
+        stalled_client, fast_client = self.server.clients
+        data = chunk(0, 64 * 1024) * 160
+        received = []
+        reader = threading.Thread(target=lambda: received.append(self.receive(fast, len(data))))
+        reader.start()
+        for i in range(0, len(data), 64 * 1024):
+            self.server.put(data[i:i + 64 * 1024])
+            while fast_client.queued > fast_client.max_buffer // 2:
+                time.sleep(0.001)
+        reader.join(10)
+        self.assertEqual(received, [data])
+        self.assertEqual(fast_client.dropped, 0)
+        self.assertGreater(stalled_client.dropped, 0)
+        self.assertEqual(self.server.dropped, stalled_client.dropped)
+
+
+if __name__ == '__main__':
+    unittest.main()
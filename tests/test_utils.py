@@ -0,0 +1,142 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from hardwario.chester.utils import Coredump, read_hex, timestamped_path, COREDUMP_BEGIN_STR, COREDUMP_END_STR, \
+    COREDUMP_ERROR_STR, COREDUMP_PREFIX_STR
+from .helpers import write_hex
+
+DUMP = bytes(range(256)) * 4
+
+
+def dump_lines(data, chunk=32):
+    return [COREDUMP_PREFIX_STR + data[i:i + chunk].hex() for i in range(0, len(data), chunk)]
+
+
+class TestCoredump(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'dump.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def feed(self, coredump, lines):
+        for line in lines:
+            coredump.feed_line(line)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_memory(self):
+        coredump = Coredump()
+        self.feed(coredump, ['[00:00:01.000,000] <inf> app: Before', COREDUMP_BEGIN_STR])
+        self.assertTrue(coredump.in_progress)
+        self.feed(coredump, dump_lines(DUMP) + [COREDUMP_END_STR])
+        self.assertFalse(coredump.in_progress)
+        self.assertEqual((bytes(coredump.data), coredump.size, coredump.has_error), (DUMP, len(DUMP), False))
+        self.assertIsNone(coredump.output_path)
+
+    def test_file(self):
+        coredump = Coredump(self.path)
+        self.feed(coredump, [COREDUMP_BEGIN_STR] + dump_lines(DUMP) + [COREDUMP_END_STR])
+        self.assertRegex(os.path.basename(coredump.output_path), r'^dump-\d{8}-\d{6}\.bin$')
+        self.assertEqual(self.read(coredump.output_path), DUMP)
+        # Data is streamed to the file, not kept in memory
+        self.assertEqual((coredump.size, coredump.data), (len(DUMP), bytearray()))
+
+        first = coredump.output_path
+        self.feed(coredump, [COREDUMP_BEGIN_STR] + dump_lines(DUMP[:64]) + [COREDUMP_END_STR])
+        self.assertNotEqual(coredump.output_path, first)
+        self.assertEqual(self.read(coredump.output_path), DUMP[:64])
+        self.assertEqual(len(os.listdir(self.tmp)), 2)
+
+    def test_error(self):
+        coredump = Coredump(self.path)
+        self.feed(coredump, [COREDUMP_BEGIN_STR] + dump_lines(DUMP[:64]) + [COREDUMP_ERROR_STR])
+        self.assertTrue(coredump.has_error)
+        self.assertTrue(coredump.output_path.endswith('.bin.incomplete'))
+        self.assertEqual(self.read(coredump.output_path), DUMP[:64])
+
+    def test_bad_line(self):
+        coredump = Coredump(self.path)
+        self.feed(coredump, [COREDUMP_BEGIN_STR] + dump_lines(DUMP[:32]) + [COREDUMP_PREFIX_STR + 'xyz'])
+        self.assertTrue(coredump.has_error)
+        self.assertTrue(coredump.output_path.endswith('.incomplete'))
+
+    def test_interrupted(self):
+        coredump = Coredump(self.path)
+        self.feed(coredump, [COREDUMP_BEGIN_STR] + dump_lines(DUMP[:32]))
+        first = coredump.output_path
+        self.feed(coredump, [COREDUMP_BEGIN_STR] + dump_lines(DUMP) + [COREDUMP_END_STR])
+        self.assertEqual(self.read(first + '.incomplete'), DUMP[:32])
+        self.assertEqual(self.read(coredump.output_path), DUMP)
+        self.assertFalse(coredump.has_error)
+
+    def test_abort(self):
+        coredump = Coredump(self.path)
+        self.assertFalse(coredump.abort())
+        self.feed(coredump, [COREDUMP_BEGIN_STR] + dump_lines(DUMP[:96]))
+        self.assertTrue(coredump.abort())
+        self.assertFalse(coredump.abort())
+        self.assertTrue(coredump.has_error)
+        self.assertEqual(os.listdir(self.tmp), [os.path.basename(coredump.output_path)])
+        self.assertEqual(self.read(coredump.output_path), DUMP[:96])
+
+    def test_incomplete_name_taken(self):
+        coredump = Coredump(self.path)
+        self.feed(coredump, [COREDUMP_BEGIN_STR])
+        with open(coredump.output_path + '.incomplete', 'w'):
+            pass
+        coredump.abort()
+        self.assertTrue(coredump.output_path.endswith('-1.incomplete'))
+
+
+class TestTimestampedPath(unittest.TestCase):
+
+    def test_unique(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            first = timestamped_path(os.path.join(tmp, 'dump.bin'))
+            self.assertTrue(re.match(r'dump-\d{8}-\d{6}\.bin$', os.path.basename(first)))
+            open(first, 'w').close()
+            second = timestamped_path(os.path.join(tmp, 'dump.bin'))
+            self.assertNotEqual(second, first)
+            self.assertFalse(os.path.exists(second))
+        finally:
+            shutil.rmtree(tmp)
+
+
+class TestReadHex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'app.hex')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_segments(self):
+        segments = [(0x0, bytes(range(40))), (0x1000, b'\xaa' * 20), (0x10001000, b'\x55' * 4)]
+        write_hex(self.path, segments)
+        self.assertEqual(read_hex(self.path), segments)
+
+    def test_extended_segment_address(self):
+        with open(self.path, 'w') as f:
+            f.write(':020000021000EC\n')    # Base 0x10000
+            f.write(':0400100001020304E2\n')
+            f.write(':00000001FF\n')
+            f.write(':010000009966\n')      # After end of file record
+        self.assertEqual(read_hex(self.path), [(0x10010, b'\x01\x02\x03\x04')])
+
+    def test_contiguous_across_records(self):
+        # Segment continues over 64 KiB boundary (new extended linear address record)
+        write_hex(self.path, [(0xfff0, bytes(range(32)))])
+        self.assertEqual(read_hex(self.path), [(0xfff0, bytes(range(32)))])
+
+
+if __name__ == '__main__':
+    unittest.main()